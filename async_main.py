@@ -0,0 +1,388 @@
+"""Asyncio server with the endpoints of main.py, index and database calls run on a bounded thread pool"""
+__author__ = "Vitali Muladze"
+
+import argparse
+import asyncio
+import contextlib
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+from aiohttp import web
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from apps import create_app
+from commons import (INDEX_FREE_ENDPOINTS, authenticate, check_n_results, check_search_knobs, collection_registry,
+                     faiss_index, join_keys, key_arguments, lookup_keys, metrics, replication, request_seconds,
+                     result_cache, token_cache, wire_format)
+from models.faiss_database import FaissIndex
+from models.token_cache import CachedUser
+from resources.auth import login_user, register_user
+from resources.metrics import METRICS_MIMETYPE
+from source.configuration import application_config, messages
+
+# Flask application only provides the database session and the logger
+flask_application = create_app(application_config)
+logger = flask_application.logger
+
+
+class BlockingCalls:
+    def __init__(self, n_threads: int, max_pending: int):
+        """
+        Thread pool for calls which would block the event loop,
+        calls beyond the limit are refused instead of queueing without bound
+        :param n_threads: number of threads
+        :param max_pending: maximum number of calls waiting for or running in a thread
+        """
+        self.executor = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix='AsyncServer')
+        self.max_pending = max_pending
+        # Only changed in the event loop thread
+        self.pending = 0
+
+    async def run(self, function, *args):
+        """
+        Run a function in a thread with an application context
+        :return: result of the function or 503 response if too many calls are pending
+        """
+        if self.pending >= self.max_pending:
+            return error_response(503, messages.SERVER_BUSY, {"Retry-After": "1"})
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, self._in_context, function, *args)
+        finally:
+            self.pending -= 1
+
+    @staticmethod
+    def _in_context(function, *args):
+        """Call the function with access to the database"""
+        with flask_application.app_context():
+            return function(*args)
+
+
+blocking_calls = BlockingCalls(application_config.ASYNC_THREADS, application_config.ASYNC_MAX_PENDING)
+metrics.gauge('faiss_server_async_pending_calls', 'Calls waiting for or running in the threads of the asyncio server',
+              lambda: blocking_calls.pending)
+
+
+def error_response(status: int, message: str, headers: dict = None) -> web.Response:
+    """Make an error response in the format of flask_restful abort"""
+    return web.json_response({"message": message}, status=status, headers=headers)
+
+
+def parse_json(body: bytes) -> dict or None:
+    """Decode a json object body"""
+    try:
+        decoded = json.loads(body)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    return decoded if isinstance(decoded, dict) else None
+
+
+@contextlib.contextmanager
+def collection_index(name: str or None):
+    """
+    Get the index of a collection, it is not evicted before the block ends
+    :param name: collection name, None for the default index
+    :return: context manager of the index or error status
+    """
+    if name is None:
+        yield faiss_index
+        return
+    with collection_registry.use(name) as index:
+        yield index
+
+
+def search_call(body: bytes, content_type: str, query, accept: str) -> web.Response:
+    """
+    Parse, run and serialize a search in a thread
+    :param body: request body
+    :param content_type: mimetype of the body
+    :param query: query arguments
+    :param accept: Accept header
+    :return: response
+    """
+    binary = content_type in wire_format.BINARY_MIMETYPES
+    decoded = None if binary else parse_json(body)
+    # Stored vectors of image ids or keys are searched instead of sent ones
+    by_ids = (query.get("image_ids") is not None if binary
+              else decoded is not None and (decoded.get("image_ids") is not None or decoded.get("keys") is not None))
+    if not by_ids and (not body or (not binary and (decoded is None or not decoded.get("features_vectors")))):
+        return error_response(400, messages.NO_VECTOR_SPECIFIED)
+    # Named collection or the default index
+    with collection_index(query.get("collection") if binary
+                          else decoded.get("collection", query.get("collection"))) as index:
+        if type(index) == str:
+            return error_response(400, index)
+        return search_in(index, binary, by_ids, decoded, body, content_type, query, accept)
+
+
+def search_in(index: FaissIndex, binary: bool, by_ids: bool, decoded: dict or None, body: bytes, content_type: str,
+              query, accept: str) -> web.Response:
+    """Run and serialize a parsed search in the index of a collection"""
+    if binary:
+        n_results = wire_format.parse_int(query.get("n_results"), 10)
+        search_knobs = {"nprobe": wire_format.parse_int(query.get("nprobe")),
+                        "ef_search": wire_format.parse_int(query.get("ef_search"))}
+        radius = query.get("radius")
+        id_filter = {"allow_ids": wire_format.parse_id_list(query.get("allow_ids")),
+                     "deny_ids": wire_format.parse_id_list(query.get("deny_ids"))}
+    else:
+        n_results = decoded.get("n_results", 10)
+        search_knobs = {"nprobe": decoded.get("nprobe"), "ef_search": decoded.get("ef_search")}
+        radius = decoded.get("radius")
+        id_filter = {"allow_ids": decoded.get("allow_ids"), "deny_ids": decoded.get("deny_ids")}
+    if check_n_results(n_results):
+        return error_response(400, messages.INVALID_N_RESULTS)
+    if check_search_knobs(search_knobs):
+        return error_response(400, messages.INVALID_SEARCH_KNOBS)
+    vector_array = None
+    if by_ids and binary:
+        query_ids = wire_format.parse_id_list(query.get("image_ids"))
+    elif by_ids and decoded.get("keys") is not None:
+        query_ids = lookup_keys(index, decoded.get("keys"))
+    elif by_ids:
+        query_ids = decoded.get("image_ids")
+    elif binary:
+        vector_array = wire_format.parse_vectors(body, content_type, index.dimension)
+        if type(vector_array) != str:
+            vector_array = vector_array[0]
+    else:
+        vector_array = index.to_vector_array(decoded.get("features_vectors"))
+    if messages.INVALID_IDS in id_filter.values():
+        return error_response(400, messages.INVALID_IDS)
+    id_filter = {key: image_ids for key, image_ids in id_filter.items() if image_ids is not None}
+    if by_ids and type(query_ids) == str:
+        return error_response(400, query_ids)
+    if type(vector_array) == str:
+        return error_response(400, vector_array)
+    if by_ids:
+        result_or_status_message = index.search_by_ids(query_ids, n_results=n_results, radius=radius,
+                                                       **search_knobs, **id_filter)
+    elif radius is not None:
+        result_or_status_message = index.range_search(vector_array, radius, **search_knobs, **id_filter)
+    elif id_filter or index is not faiss_index:
+        result_or_status_message = index.search(vector_array, n_results=n_results, **search_knobs, **id_filter)
+    else:
+        result_or_status_message = result_cache.search(vector_array, n_results=n_results, **search_knobs)
+    if type(result_or_status_message) == str:
+        return error_response(400, result_or_status_message)
+    # Send results in binary if the client accepts it
+    mimetype = wire_format.accepted_mimetype(parse_accept_header(accept, MIMEAccept))
+    if radius is not None:
+        lims, result_indices, distances = result_or_status_message
+        if mimetype:
+            return web.Response(body=wire_format.encode_results(result_indices, distances, mimetype, lims),
+                                content_type=mimetype,
+                                headers={"X-Result-Shape": f"{lims.shape[0] - 1},{result_indices.shape[0]}"})
+        # Every query has its own number of results
+        return web.json_response({"indices": [row.tolist() for row in numpy.split(result_indices, lims[1:-1])],
+                                  "distances": [row.tolist() for row in numpy.split(distances, lims[1:-1])],
+                                  **join_keys(index, result_indices, lims)})
+    result_indices, distances = result_or_status_message
+    if mimetype:
+        return web.Response(body=wire_format.encode_results(result_indices, distances, mimetype),
+                            content_type=mimetype,
+                            headers={"X-Result-Shape": ','.join(str(size) for size in result_indices.shape)})
+
+    return web.json_response({"indices": result_indices.tolist(), "distances": distances.tolist(),
+                              **join_keys(index, result_indices)})
+
+
+def write_call(method: str, body: bytes, content_type: str, query) -> web.Response:
+    """
+    Parse and run an insertion or update in a thread
+    :param method: insert or update
+    :param body: request body
+    :param content_type: mimetype of the body
+    :param query: query arguments
+    :return: response
+    """
+    binary = content_type in wire_format.BINARY_MIMETYPES
+    decoded = None if binary else parse_json(body)
+    if not body or (not binary and (decoded is None or not decoded.get("features_vectors"))):
+        return error_response(400, messages.NO_VECTOR_SPECIFIED)
+    # Named collection or the default index
+    with collection_index(query.get("collection") if binary
+                          else decoded.get("collection", query.get("collection"))) as index:
+        if type(index) == str:
+            return error_response(400, index)
+        return write_in(index, method, binary, decoded, body, content_type, query)
+
+
+def write_in(index: FaissIndex, method: str, binary: bool, decoded: dict or None, body: bytes, content_type: str,
+             query) -> web.Response:
+    """Run a parsed insertion or update in the index of a collection"""
+    if binary:
+        # Float32 matrix and int64 ids are read from the body without copying them
+        parsed_or_status_message = wire_format.parse_vectors(body, content_type, index.dimension,
+                                                             with_ids=query.get("with_ids", "false") == "true")
+        if type(parsed_or_status_message) == str:
+            return error_response(400, parsed_or_status_message)
+        features_vectors, image_ids = parsed_or_status_message
+    else:
+        features_vectors = index.to_vector_array(decoded.get("features_vectors"))
+        image_ids = decoded.get("image_ids", None)
+        if type(features_vectors) == str:
+            return error_response(400, features_vectors)
+    # String keys and payloads instead of image ids
+    keys_or_status_message = key_arguments(index, decoded)
+    if type(keys_or_status_message) == str:
+        return error_response(400, keys_or_status_message)
+    if method == 'insert':
+        result_or_status_message = index.insert(features_vectors=features_vectors, image_ids=image_ids,
+                                                **keys_or_status_message)
+    else:
+        result_or_status_message = index.update(features_vectors=features_vectors, image_ids=image_ids,
+                                                **keys_or_status_message)
+    if type(result_or_status_message) == str:
+        return error_response(400, result_or_status_message)
+
+    return web.json_response({"indices": result_or_status_message})
+
+
+def account_call(function, body: bytes) -> web.Response:
+    """
+    Register or log in a user in a thread, password hashing is slow on purpose
+    :param function: register_user or login_user
+    :param body: json body with username and password
+    :return: response
+    """
+    decoded = parse_json(body)
+    if decoded is None:
+        return error_response(400, messages.BAD_JSON_BODY)
+    result_or_error = function(decoded.get('username'), decoded.get('password'))
+    if isinstance(result_or_error, tuple):
+        return error_response(*result_or_error)
+
+    return web.json_response(result_or_error)
+
+
+async def authorize(request: web.Request) -> web.Response or None:
+    """
+    Check the token of a request
+    :return: error response or None if the user is active
+    """
+    token = request.headers.get('Authorization')
+    # Cached tokens are checked in the event loop, the others need the database
+    if token and token_cache.get(token) is not None:
+        user = authenticate(token)
+    else:
+        user = await blocking_calls.run(authenticate, token)
+    if isinstance(user, web.Response):
+        return user
+    if not isinstance(user, CachedUser):
+        return error_response(*user)
+
+    return None
+
+
+def index_endpoint(handler):
+    """Serve an endpoint which needs the loaded index and an authorized user"""
+
+    async def wrapper(request: web.Request) -> web.Response:
+        if not faiss_index.loader.ready.is_set() and request.match_info.route.name not in INDEX_FREE_ENDPOINTS:
+            return web.json_response({"message": messages.WARMING_UP, **faiss_index.loader.status()},
+                                     status=503, headers={"Retry-After": "1"})
+        unauthorized = await authorize(request)
+        if unauthorized is not None:
+            return unauthorized
+        # Slow clients only keep their connection, not a thread
+        body = await request.read()
+
+        return await handler(request, body)
+
+    return wrapper
+
+
+@index_endpoint
+async def search(request: web.Request, body: bytes) -> web.Response:
+    return await blocking_calls.run(search_call, body, request.content_type, request.query,
+                                    request.headers.get('Accept', ''))
+
+
+@index_endpoint
+async def insert(request: web.Request, body: bytes) -> web.Response:
+    return await blocking_calls.run(write_call, 'insert', body, request.content_type, request.query)
+
+
+@index_endpoint
+async def update(request: web.Request, body: bytes) -> web.Response:
+    return await blocking_calls.run(write_call, 'update', body, request.content_type, request.query)
+
+
+async def register(request: web.Request) -> web.Response:
+    return await blocking_calls.run(account_call, register_user, await request.read())
+
+
+async def login(request: web.Request) -> web.Response:
+    return await blocking_calls.run(account_call, login_user, await request.read())
+
+
+@index_endpoint
+async def replication_status(request: web.Request, body: bytes) -> web.Response:
+    if replication() is None:
+        return error_response(400, messages.REPLICATION_DISABLED)
+    return web.json_response(replication().status())
+
+
+async def export_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=metrics.render().encode(), headers={"Content-Type": METRICS_MIMETYPE})
+
+
+async def liveness(request: web.Request) -> web.Response:
+    status = faiss_index.loader.status()
+    return web.json_response(status, status=500 if status["stage"] == 'failed' else 200)
+
+
+async def readiness(request: web.Request) -> web.Response:
+    status = faiss_index.loader.status()
+    return web.json_response(status, status=200 if status["ready"] else 503)
+
+
+@web.middleware
+async def record_request_timing(request: web.Request, handler) -> web.Response:
+    """Record latency of every request in the metrics shared with the flask endpoints"""
+    tok = time.perf_counter()
+    try:
+        return await handler(request)
+    finally:
+        endpoint = request.match_info.route.name
+        request_seconds.observe(time.perf_counter() - tok, endpoint or 'unknown')
+
+
+def make_application() -> web.Application:
+    """Create the asyncio application with the routes of main.py"""
+    application = web.Application(middlewares=[record_request_timing],
+                                  client_max_size=int(application_config.ASYNC_MAX_BODY_MB * 2 ** 20))
+    # Route names are the flask endpoint names used in metrics
+    application.router.add_post("/register", register, name='register')
+    application.router.add_post("/login", login, name='login')
+    application.router.add_post("/search", search, name='search')
+    application.router.add_put("/insert", insert, name='insert')
+    application.router.add_post("/update", update, name='update')
+    application.router.add_get("/replication", replication_status, name='replication')
+    application.router.add_get("/metrics", export_metrics, name='metrics')
+    application.router.add_get("/health/live", liveness, name='liveness')
+    application.router.add_get("/health/ready", readiness, name='readiness')
+
+    return application
+
+
+# Served by gunicorn with --worker-class aiohttp.GunicornWebWorker
+application = make_application()
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--backlog", type=int, default=4096, help="connections waiting to be accepted")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    web.run_app(application, host=arguments.host, port=arguments.port, backlog=arguments.backlog)
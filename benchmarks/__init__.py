@@ -0,0 +1,2 @@
+"""Offline benchmarks of the faiss index and the server on synthetic vectors"""
+__author__ = "Vitali Muladze"
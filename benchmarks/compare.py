@@ -0,0 +1,77 @@
+"""Compare benchmark results with a baseline run and report regressions"""
+__author__ = "Vitali Muladze"
+
+import argparse
+import json
+import sys
+
+from benchmarks.results import load_results
+
+# Metrics compared between runs and whether higher values are better
+COMPARED_METRICS = {"vectors_per_second": True, "requests_per_second": True,
+                    "p50_ms": False, "p99_ms": False, "memory_bytes_per_vector": False}
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("baseline", help="json results of the baseline run")
+    parser.add_argument("current", help="json results of the run to check")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative change counted as a regression, 0.1 is 10%%")
+
+    return parser.parse_args()
+
+
+def parameters_key(parameters: dict) -> str:
+    """Key matching the same measurement in two runs"""
+    return json.dumps(parameters, sort_keys=True)
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> tuple:
+    """
+    Compare metrics of measurements present in both runs
+    :param baseline: results of the baseline run
+    :param current: results of the run to check
+    :param threshold: relative change counted as a regression
+    :return: lines of the report and number of regressions
+    """
+    baseline_metrics = {parameters_key(result["parameters"]): result["metrics"]
+                        for result in baseline["results"]}
+    lines, n_regressions = [], 0
+    for result in current["results"]:
+        old_metrics = baseline_metrics.get(parameters_key(result["parameters"]))
+        if old_metrics is None:
+            continue
+        # Lost recall of the same index and search knobs is a regression too
+        compared_metrics = {**COMPARED_METRICS, **{metric: True for metric in result["metrics"]
+                                                   if metric.startswith("recall_at_")}}
+        for metric, higher_is_better in compared_metrics.items():
+            old, new = old_metrics.get(metric), result["metrics"].get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            regression = change < -threshold if higher_is_better else change > threshold
+            n_regressions += regression
+            lines.append(f"{'REGRESSION ' if regression else ''}{result['parameters']} "
+                         f"{metric}: {old:.3f} -> {new:.3f} ({change:+.1%})")
+
+    return lines, n_regressions
+
+
+def main():
+    arguments = parse_arguments()
+    baseline, current = load_results(arguments.baseline), load_results(arguments.current)
+    if baseline["benchmark"] != current["benchmark"]:
+        sys.exit(f"Can't compare {baseline['benchmark']} results with {current['benchmark']} results")
+    for name in ("commit", "cpu_count", "faiss", "omp_threads"):
+        if baseline["environment"].get(name) != current["environment"].get(name):
+            print(f"Note: {name} differs: {baseline['environment'].get(name)} -> "
+                  f"{current['environment'].get(name)}")
+    lines, n_regressions = compare(baseline, current, arguments.threshold)
+    print("\n".join(lines))
+    print(f"{n_regressions} regressions over {arguments.threshold:.0%}")
+    sys.exit(1 if n_regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
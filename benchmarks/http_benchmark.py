@@ -0,0 +1,267 @@
+"""End-to-end throughput and latency of the server through gunicorn workers"""
+__author__ = "Vitali Muladze"
+
+import argparse
+import configparser
+import http.client
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy
+
+from benchmarks.results import default_output, latency_summary, save_results, synthetic_vectors
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Different request bodies sent in turn, prepared before measuring
+N_BODIES = 64
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--config", default="config.ini", help="config the benchmark servers are based on")
+    parser.add_argument("--dimensions", type=int, nargs="+", default=[128])
+    parser.add_argument("--index-sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--index-factory", default="IDMap,Flat")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4], help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=4, help="threads of every worker")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32],
+                        help="concurrent client connections")
+    parser.add_argument("--endpoints", nargs="+", default=["search", "insert"], choices=["search", "insert"])
+    parser.add_argument("--wire-format", default="json", choices=["json", "binary"])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 16], help="vectors per request")
+    parser.add_argument("--n-results", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--requests", type=int, default=2000, help="measured requests per level")
+    parser.add_argument("--warmup", type=int, default=100, help="requests before measuring")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", default=None, help="json results, benchmarks/results by default")
+
+    return parser.parse_args()
+
+
+def write_config(arguments: argparse.Namespace, folder: str, dimension: int) -> None:
+    """
+    Write config of a benchmark server with its own files
+    :param arguments: arguments of the run
+    :param folder: folder of the server
+    :param dimension: dimension of vector
+    """
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(arguments.config)
+    for section in ("DATABASE", "APPLICATION", "FILES", "LOGGER", "MAIL", "FAISS_DATABASE"):
+        if not config.has_section(section):
+            config.add_section(section)
+    config["DATABASE"]["URI"] = "media/users.db"
+    config["APPLICATION"].setdefault("SECRET_KEY", "benchmark")
+    config["APPLICATION"].setdefault("SQLALCHEMY_TRACK_MODIFICATIONS", "false")
+    config["APPLICATION"].setdefault("SQLALCHEMY_ECHO", "false")
+    config["FILES"].update({"MEDIA_PATH": "media", "FAISS_INDEX_PATH": "media/index/faiss.index",
+                            "BACKUP_INDEX_PATH": "media/index/faiss_backup.index"})
+    config["LOGGER"].update({"LOG_FILE_INFO": "media/logs/info.log", "LOG_FILE_ERROR": "media/logs/error.log"})
+    config["LOGGER"].setdefault("SEND_MAIL_TO", "benchmark@localhost")
+    for key, value in (("HOST", "localhost"), ("PORT", "25"), ("FROM", "benchmark@localhost")):
+        config["MAIL"].setdefault(key, value)
+    # Each server starts from the prepared index, repeated bodies must not be answered from the cache
+    config["FAISS_DATABASE"].update({"INDEX_DIMENSION": str(dimension),
+                                     "INDEX_FACTORY": arguments.index_factory,
+                                     "RESULT_CACHE_MB": "0", "WAL": "false", "SHARED_INDEX": "false"})
+    os.makedirs(os.path.join(folder, "media", "logs"), exist_ok=True)
+    with open(os.path.join(folder, "config.ini"), "w") as config_file:
+        config.write(config_file)
+
+
+def prepare_server(arguments: argparse.Namespace, folder: str, index_size: int) -> str:
+    """
+    Build the index and the benchmark user of a server folder
+    :param arguments: arguments of the run
+    :param folder: folder of the server
+    :param index_size: number of vectors
+    :return: token of the benchmark user
+    """
+    output = subprocess.run([sys.executable, "-m", "benchmarks.prepare_server",
+                             "--index-size", str(index_size), "--seed", str(arguments.seed)],
+                            cwd=folder, env={**os.environ, "PYTHONPATH": REPOSITORY_PATH},
+                            capture_output=True, text=True, check=True).stdout
+
+    return output.strip().splitlines()[-1]
+
+
+def start_server(folder: str, workers: int, threads: int, port: int) -> subprocess.Popen:
+    """
+    Start gunicorn in the server folder and wait until it answers
+    :param folder: folder of the server
+    :param workers: number of worker processes
+    :param threads: threads of every worker
+    :param port: port to listen on
+    :return: gunicorn process
+    """
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "--chdir", folder,
+                               "--pythonpath", REPOSITORY_PATH, "--workers", str(workers),
+                               "--threads", str(threads), "--bind", f"127.0.0.1:{port}",
+                               "--log-level", "warning", "wsgi:application"])
+    deadline = time.monotonic() + 300
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}")
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            connection.request("GET", "/metrics")
+            if connection.getresponse().status == 200:
+                connection.close()
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("Server did not start in time")
+
+
+def request_bodies(endpoint: str, wire_format: str, dimension: int, batch_size: int,
+                   n_results: int, seed: int) -> tuple:
+    """
+    Encode request bodies before measuring so the client does not add to the latency
+    :param endpoint: search or insert
+    :param wire_format: json or binary
+    :param dimension: dimension of vector
+    :param batch_size: vectors per request
+    :param n_results: number of results of searches
+    :param seed: seed of the vectors
+    :return: method, path, content type and list of bodies
+    """
+    vector_array = synthetic_vectors(N_BODIES * batch_size, dimension, seed)
+    method, path = ("POST", "/search") if endpoint == "search" else ("PUT", "/insert")
+    bodies = []
+    for position in range(N_BODIES):
+        batch = vector_array[position * batch_size:(position + 1) * batch_size]
+        if wire_format == "binary":
+            bodies.append(numpy.ascontiguousarray(batch, dtype='<f4').tobytes())
+        else:
+            bodies.append(json.dumps({"features_vectors": batch.tolist(), "n_results": n_results}).encode())
+    if wire_format == "binary":
+        return method, f"{path}?n_results={n_results}", "application/octet-stream", bodies
+
+    return method, path, "application/json", bodies
+
+
+def run_load(port: int, token: str, method: str, path: str, content_type: str, bodies: list,
+             concurrency: int, n_requests: int) -> dict:
+    """
+    Send requests from concurrent keep-alive connections
+    :param port: port of the server
+    :param token: authorization token
+    :param method: http method
+    :param path: path of the endpoint
+    :param content_type: content type of the bodies
+    :param bodies: request bodies sent in turn
+    :param concurrency: number of connections
+    :param n_requests: number of requests
+    :return: throughput, latency and error metrics
+    """
+    counter = itertools.count()
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def send():
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        own_latencies, own_errors = [], []
+        headers = {"Authorization": token, "Content-Type": content_type}
+        while True:
+            position = next(counter)
+            if position >= n_requests:
+                break
+            tok = time.perf_counter()
+            try:
+                connection.request(method, path, body=bodies[position % len(bodies)], headers=headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    own_errors.append(response.status)
+            except (OSError, http.client.HTTPException) as error:
+                own_errors.append(type(error).__name__)
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            own_latencies.append(time.perf_counter() - tok)
+        connection.close()
+        with lock:
+            latencies.extend(own_latencies)
+            errors.extend(own_errors)
+
+    threads = [threading.Thread(target=send) for _ in range(concurrency)]
+    tok = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - tok
+
+    return {"requests": len(latencies), "errors": len(errors),
+            "error_kinds": sorted(set(map(str, errors))), "seconds": seconds,
+            "requests_per_second": len(latencies) / max(seconds, 1e-9), **latency_summary(latencies)}
+
+
+def benchmark_server(arguments: argparse.Namespace, dimension: int, index_size: int, workers: int) -> list:
+    """
+    Measure every endpoint, batch size, number of results and concurrency on one server
+    :param arguments: arguments of the run
+    :param dimension: dimension of vector
+    :param index_size: number of vectors in the index
+    :param workers: number of worker processes
+    :return: list of results
+    """
+    folder = tempfile.mkdtemp(prefix="faiss-benchmark-")
+    server = None
+    results = []
+    try:
+        write_config(arguments, folder, dimension)
+        token = prepare_server(arguments, folder, index_size)
+        server = start_server(folder, workers, arguments.threads, arguments.port)
+        for endpoint in arguments.endpoints:
+            # Number of results does not matter for insertions
+            n_results_values = arguments.n_results if endpoint == "search" else arguments.n_results[:1]
+            for batch_size, n_results in itertools.product(arguments.batch_sizes, n_results_values):
+                method, path, content_type, bodies = request_bodies(
+                    endpoint, arguments.wire_format, dimension, batch_size, n_results, arguments.seed - 1)
+                for concurrency in arguments.concurrency:
+                    run_load(arguments.port, token, method, path, content_type, bodies,
+                             concurrency, arguments.warmup)
+                    metrics = run_load(arguments.port, token, method, path, content_type, bodies,
+                                       concurrency, arguments.requests)
+                    metrics["vectors_per_second"] = metrics["requests_per_second"] * batch_size
+                    parameters = {"endpoint": endpoint, "wire_format": arguments.wire_format,
+                                  "index_factory": arguments.index_factory, "dimension": dimension,
+                                  "index_size": index_size, "workers": workers, "threads": arguments.threads,
+                                  "concurrency": concurrency, "batch_size": batch_size}
+                    if endpoint == "search":
+                        parameters["n_results"] = n_results
+                    results.append({"parameters": parameters, "metrics": metrics})
+                    print(parameters, {key: round(value, 3) if isinstance(value, float) else value
+                                       for key, value in metrics.items()})
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return results
+
+
+def main():
+    arguments = parse_arguments()
+    output = arguments.output or default_output("http")
+    results = []
+    for dimension, index_size, workers in itertools.product(arguments.dimensions, arguments.index_sizes,
+                                                            arguments.workers):
+        results.extend(benchmark_server(arguments, dimension, index_size, workers))
+    save_results(output, "http", vars(arguments), results)
+    print(f"Results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""Throughput and latency of FaissIndex insert, update and search without the server"""
+__author__ = "Vitali Muladze"
+
+import argparse
+import os
+import tempfile
+import time
+
+import faiss
+import numpy
+
+from benchmarks.results import default_output, latency_summary, save_results, synthetic_vectors
+from models.faiss_database import FaissIndex
+
+# Vectors added at once while the index is built
+BUILD_CHUNK_SIZE = 65536
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dimensions", type=int, nargs="+", default=[128, 512])
+    parser.add_argument("--index-sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 16, 256],
+                        help="vectors per insert, update and search call")
+    parser.add_argument("--n-results", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--index-factory", default="IDMap,Flat")
+    parser.add_argument("--train-size", type=int, default=100000)
+    parser.add_argument("--nprobe", type=int, help="nprobe of searches in IVF indexes")
+    parser.add_argument("--rerank", action="store_true",
+                        help="re-rank candidates with full precision vectors kept in a file")
+    parser.add_argument("--rerank-factor", type=int, default=4)
+    parser.add_argument("--recall-queries", type=int, default=256,
+                        help="queries whose results are compared with an exact flat search")
+    parser.add_argument("--n-vectors", type=int, default=2048,
+                        help="vectors inserted, updated and searched per measurement")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", default=None, help="json results, benchmarks/results by default")
+
+    return parser.parse_args()
+
+
+def timed_calls(function, batches: list) -> tuple:
+    """
+    Call a function on every batch and measure it
+    :param function: function of one batch returning a result or error status
+    :param batches: arguments of the calls
+    :return: total seconds and seconds of every call
+    """
+    latencies = []
+    tok = time.perf_counter()
+    for batch in batches:
+        call_started = time.perf_counter()
+        result_or_status_message = function(*batch)
+        latencies.append(time.perf_counter() - call_started)
+        if isinstance(result_or_status_message, str):
+            raise RuntimeError(result_or_status_message)
+
+    return time.perf_counter() - tok, latencies
+
+
+def build_index(dimension: int, index_size: int, index_factory: str, train_size: int,
+                seed: int, vectors_path: str = None, rerank_factor: int = 4) -> tuple:
+    """
+    Create an index filled with synthetic vectors
+    :param dimension: dimension of vector
+    :param index_size: number of vectors
+    :param index_factory: faiss factory string
+    :param train_size: number of vectors trained on
+    :param seed: seed of the vectors
+    :param vectors_path: file of full precision vectors for re-ranking
+    :param rerank_factor: candidates searched per requested result before re-ranking
+    :return: index and build metrics
+    """
+    faiss_index = FaissIndex(None, dimension, index_factory, vectors_path=vectors_path, rerank_factor=rerank_factor)
+    tok = time.perf_counter()
+    if not faiss_index.is_trained:
+        faiss_index.train(synthetic_vectors(min(train_size, index_size), dimension, seed))
+    trained = time.perf_counter()
+    for start in range(0, index_size, BUILD_CHUNK_SIZE):
+        stop = min(start + BUILD_CHUNK_SIZE, index_size)
+        faiss_index.insert(synthetic_vectors(stop - start, dimension, seed + start),
+                           numpy.arange(start, stop, dtype=numpy.int64))
+    built = time.perf_counter()
+
+    return faiss_index, {"train_seconds": trained - tok, "build_seconds": built - trained,
+                         "build_vectors_per_second": index_size / max(built - trained, 1e-9)}
+
+
+def exact_results(dimension: int, index_size: int, seed: int, queries: numpy.ndarray, n_results: int) -> numpy.ndarray:
+    """
+    Find true nearest neighbours of queries with a flat index of the same synthetic vectors
+    :param dimension: dimension of vector
+    :param index_size: number of vectors
+    :param seed: seed of the vectors
+    :param queries: float32 query matrix
+    :param n_results: number of results
+    :return: int64 ids of the results
+    """
+    flat_index = faiss.IndexFlatL2(dimension)
+    for start in range(0, index_size, BUILD_CHUNK_SIZE):
+        flat_index.add(synthetic_vectors(min(start + BUILD_CHUNK_SIZE, index_size) - start, dimension, seed + start))
+
+    return flat_index.search(queries, n_results)[1]
+
+
+def measure_quality(faiss_index: FaissIndex, arguments: argparse.Namespace, dimension: int,
+                    index_size: int, queries: numpy.ndarray) -> dict:
+    """
+    Measure recall against the flat baseline and memory taken by a vector
+    :param faiss_index: built index
+    :param arguments: arguments of the run
+    :param dimension: dimension of vector
+    :param index_size: number of vectors in the index
+    :param queries: float32 query matrix
+    :return: recall@k of every number of results and bytes per vector
+    """
+    queries = queries[:arguments.recall_queries]
+    exact_ids = exact_results(dimension, index_size, arguments.seed, queries, max(arguments.n_results))
+    metrics = {}
+    for n_results in arguments.n_results:
+        result_ids = faiss_index.search(queries, n_results=n_results, nprobe=arguments.nprobe)[0]
+        metrics[f"recall_at_{n_results}"] = float(numpy.mean(
+            [numpy.isin(found, exact[:n_results]).sum() / n_results for found, exact in zip(result_ids, exact_ids)]))
+    # Codes, ids and structures of the index held in memory, rows of the vector store are on disk
+    memory_bytes = faiss.serialize_index(faiss_index.index).nbytes
+    disk_bytes = 0
+    if faiss_index.vector_store is not None:
+        memory_bytes += index_size * numpy.dtype(numpy.int64).itemsize
+        disk_bytes = os.path.getsize(faiss_index.vector_store.vectors_path)
+    metrics.update({"memory_bytes_per_vector": memory_bytes / index_size,
+                    "disk_bytes_per_vector": disk_bytes / index_size,
+                    "flat_bytes_per_vector": dimension * numpy.dtype(numpy.float32).itemsize})
+
+    return metrics
+
+
+def measure(function, batches: list) -> dict:
+    """
+    Measure an operation over its batches
+    :param function: function of one batch
+    :param batches: arguments of the calls, features vectors first
+    :return: throughput and latency metrics
+    """
+    seconds, latencies = timed_calls(function, batches)
+    n_vectors = sum(batch[0].shape[0] for batch in batches)
+
+    return {"calls": len(batches), "vectors": n_vectors, "seconds": seconds,
+            "calls_per_second": len(batches) / max(seconds, 1e-9),
+            "vectors_per_second": n_vectors / max(seconds, 1e-9), **latency_summary(latencies)}
+
+
+def benchmark_index(arguments: argparse.Namespace, dimension: int, index_size: int, vectors_folder: str) -> list:
+    """
+    Measure insert, update and search of one index for every batch size and number of results
+    :param arguments: arguments of the run
+    :param dimension: dimension of vector
+    :param index_size: number of vectors in the index
+    :param vectors_folder: folder of vector stores of re-ranking indexes
+    :return: list of results
+    """
+    vectors_path = os.path.join(vectors_folder, f"{dimension}_{index_size}.vectors") \
+        if arguments.rerank else None
+    faiss_index, build_metrics = build_index(dimension, index_size, arguments.index_factory,
+                                             arguments.train_size, arguments.seed, vectors_path,
+                                             arguments.rerank_factor)
+    base_parameters = {"index_factory": arguments.index_factory, "dimension": dimension,
+                       "index_size": index_size}
+    if arguments.rerank:
+        base_parameters["rerank_factor"] = arguments.rerank_factor
+    results = [{"parameters": {**base_parameters, "operation": "build"}, "metrics": build_metrics}]
+    queries = synthetic_vectors(arguments.n_vectors, dimension, arguments.seed - 1)
+    results.append({"parameters": {**base_parameters, "operation": "quality"},
+                    "metrics": measure_quality(faiss_index, arguments, dimension, index_size, queries)})
+    for batch_position, batch_size in enumerate(arguments.batch_sizes):
+        batches = [queries[start:start + batch_size] for start in range(0, arguments.n_vectors, batch_size)]
+        parameters = {**base_parameters, "batch_size": batch_size}
+        for n_results in arguments.n_results:
+            metrics = measure(lambda vectors: faiss_index.search(
+                vectors, n_results=n_results, nprobe=arguments.nprobe), [(batch,) for batch in batches])
+            results.append({"parameters": {**parameters, "operation": "search", "n_results": n_results},
+                            "metrics": metrics})
+        # New ids of every batch size, inserted vectors are updated afterwards
+        first_id = index_size + batch_position * arguments.n_vectors
+        id_batches = [numpy.arange(first_id + start, first_id + start + batch.shape[0], dtype=numpy.int64)
+                      for start, batch in zip(range(0, arguments.n_vectors, batch_size), batches)]
+        metrics = measure(faiss_index.insert, list(zip(batches, id_batches)))
+        results.append({"parameters": {**parameters, "operation": "insert"}, "metrics": metrics})
+        metrics = measure(faiss_index.update, list(zip(batches, id_batches)))
+        results.append({"parameters": {**parameters, "operation": "update"}, "metrics": metrics})
+
+    return results
+
+
+def print_result(result: dict) -> None:
+    """Print parameters and rounded metrics of a result"""
+    print(result["parameters"], {key: round(value, 3) if isinstance(value, float) else value
+                                 for key, value in result["metrics"].items()})
+
+
+def main():
+    arguments = parse_arguments()
+    output = arguments.output or default_output("index")
+    results = []
+    # Vector stores of re-ranking indexes are dropped after the run
+    with tempfile.TemporaryDirectory(prefix="faiss-benchmark-") as vectors_folder:
+        for dimension in arguments.dimensions:
+            for index_size in arguments.index_sizes:
+                index_results = benchmark_index(arguments, dimension, index_size, vectors_folder)
+                for result in index_results:
+                    print_result(result)
+                results.extend(index_results)
+    save_results(output, "index", vars(arguments), results)
+    print(f"Results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Prepare a benchmark server folder: synthetic index, users table and an active user token"""
+__author__ = "Vitali Muladze"
+
+import argparse
+import datetime
+
+from jwt import encode
+
+from benchmarks.index_benchmark import build_index
+from source.configuration import application_config, faiss_configuration, files
+
+BENCHMARK_USER = "benchmark"
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--index-size", type=int, required=True)
+    parser.add_argument("--train-size", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=1234)
+
+    return parser.parse_args()
+
+
+def create_user() -> str:
+    """
+    Create the users table with an active benchmark user
+    :return: token of the user
+    """
+    from apps import create_app, db
+    from models.users import User
+
+    application = create_app(application_config)
+    with application.app_context():
+        db.create_all()
+        user = User.query.get(BENCHMARK_USER)
+        if user is None:
+            user = User(username=BENCHMARK_USER)
+            user.hash_password(BENCHMARK_USER * 2)
+            db.session.add(user)
+        user.active = True
+        db.session.commit()
+    token = encode({'username': BENCHMARK_USER,
+                    'exp': datetime.datetime.utcnow() + datetime.timedelta(days=1)},
+                   application_config.SECRET_KEY, algorithm='HS256')
+
+    return token if isinstance(token, str) else token.decode('utf-8')
+
+
+def main():
+    arguments = parse_arguments()
+    faiss_index, _ = build_index(faiss_configuration.dimension, arguments.index_size,
+                                 faiss_configuration.index_factory, arguments.train_size, arguments.seed)
+    faiss_index.to_disk(files.index_path)
+    # The token is the last line of the output
+    print(create_user())
+
+
+if __name__ == '__main__':
+    main()
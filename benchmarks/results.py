@@ -0,0 +1,80 @@
+"""Synthetic data, latency summaries and json results of benchmarks"""
+__author__ = "Vitali Muladze"
+
+import datetime
+import json
+import os
+import platform
+import subprocess
+
+import numpy
+
+
+def synthetic_vectors(n_vectors: int, dimension: int, seed: int) -> numpy.ndarray:
+    """
+    Generate reproducible features vectors
+    :param n_vectors: number of vectors
+    :param dimension: dimension of vector
+    :param seed: seed of the generator, same seed gives same vectors
+    :return: float32 matrix
+    """
+    return numpy.random.RandomState(seed).standard_normal((n_vectors, dimension)).astype(numpy.float32)
+
+
+def latency_summary(latencies: list) -> dict:
+    """
+    Summarize latencies of calls
+    :param latencies: seconds of every call
+    :return: percentiles, mean and maximum in milliseconds
+    """
+    if not latencies:
+        return {}
+    milliseconds = numpy.asarray(latencies) * 1000
+    p50, p90, p99 = numpy.percentile(milliseconds, [50, 90, 99])
+
+    return {"p50_ms": float(p50), "p90_ms": float(p90), "p99_ms": float(p99),
+            "mean_ms": float(milliseconds.mean()), "max_ms": float(milliseconds.max())}
+
+
+def environment() -> dict:
+    """Get versions and hardware the benchmark ran with, needed to compare runs"""
+    import faiss
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            "numpy": numpy.__version__, "faiss": getattr(faiss, "__version__", None),
+            "omp_threads": faiss.omp_get_max_threads(), "commit": commit}
+
+
+def save_results(path: str, benchmark: str, arguments: dict, results: list) -> None:
+    """
+    Write results of a benchmark run as json
+    :param path: output file
+    :param benchmark: name of the benchmark e.g. index or http
+    :param arguments: arguments of the run
+    :param results: list of {"parameters": {...}, "metrics": {...}}
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as results_file:
+        json.dump({"benchmark": benchmark,
+                   "started": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                   "environment": environment(), "arguments": arguments, "results": results},
+                  results_file, indent=2)
+
+
+def load_results(path: str) -> dict:
+    """Read results of a benchmark run"""
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+def default_output(benchmark: str) -> str:
+    """Get a timestamped results file in benchmarks/results"""
+    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"{benchmark}-{timestamp}.json")
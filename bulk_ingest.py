@@ -0,0 +1,44 @@
+"""Stream NDJSON or chunked .npy vectors into the configured index"""
+__author__ = "Vitali Muladze"
+
+import argparse
+
+from commons import faiss_index
+from models.bulk_ingest import BulkIngest, NDJSON, NPY
+from source.configuration import files, faiss_configuration
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("source", help=".ndjson file of {\"features_vector\": [...], \"image_id\": 17} "
+                                       "lines or concatenated .npy float32 chunks with optional int64 ids")
+    parser.add_argument("--format", choices=(NDJSON, NPY),
+                        help="stream format, guessed from the file extension by default")
+    parser.add_argument("--ingest-id", help="id to resume the ingestion with, the file name by default")
+    parser.add_argument("--chunk-size", type=int, default=faiss_configuration.bulk_chunk_size)
+    parser.add_argument("--output", default=files.index_path,
+                        help="where to write an index without write-ahead log or writer process")
+
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    # Vectors ingested into the placeholder of an index which is still loading would replace its file
+    faiss_index.loader.done.wait()
+    if not faiss_index.loader.ready.is_set():
+        raise SystemExit(f"Index could not be loaded: {faiss_index.loader.error}")
+    stream_format = arguments.format or (NDJSON if arguments.source.endswith((".ndjson", ".jsonl")) else NPY)
+    # Index without write-ahead log is written to the output before its rows are committed
+    bulk_ingest = BulkIngest(faiss_index, files.bulk_progress_path, arguments.chunk_size, progress=print,
+                             index_path=arguments.output)
+    with open(arguments.source, "rb") as stream:
+        result_or_status_message = bulk_ingest.ingest(stream, stream_format,
+                                                      arguments.ingest_id or arguments.source)
+    if isinstance(result_or_status_message, str):
+        raise SystemExit(result_or_status_message)
+    print(result_or_status_message)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,58 +2,453 @@
 __author__ = "Vitali Muladze"
 
 import atexit
+import contextlib
 import functools
+import logging
+import os
+import time
 
-from flask import request
+import numpy
+from flask import g, request
 from flask_restful import abort
 from jwt import decode, DecodeError, ExpiredSignatureError
+from sqlalchemy import event
 
-from models.faiss_database import FaissIndex
+from models.checkpointer import open_durable_index
+from models.collection_registry import CollectionRegistry, CollectionSpec
+from models.compactor import Compactor
+from models.cpu_scheduler import CpuScheduler, claim_cores
+from models.faiss_database import FaissIndex, valid_n_results
+from models.index_rebuilder import IndexRebuilder
+from models.key_store import KeyStore
+from models.log import DroppingQueueHandler, Logger
+from models.metrics import MetricsRegistry, resident_memory_bytes
+from models.replication import ReplicaFaissIndex, ReplicationPrimary
+from models.result_cache import ResultCache
+from models.search_batcher import SearchBatcher
+from models.sharded_index import ShardedFaissIndex
+from models.shared_index import SharedFaissIndex
+from models.token_cache import CachedUser, TokenCache
 from models.users import User
-from source.configuration import (application_config, files, faiss_configuration)
+from source.configuration import (application_config, collections_configuration, files, faiss_configuration,
+                                  messages)
 
-faiss_index = FaissIndex(files.index_path, faiss_configuration.dimension)
+# Endpoints served while the index is loading, a replica reports its lag while it catches up
+INDEX_FREE_ENDPOINTS = ('register', 'login', 'metrics', 'liveness', 'readiness', 'replication')
+
+# Time spent on loading the checkpoint and replaying the log, reported at boot
+# or once the index is loaded in background
+recovery_report = None
+checkpointer = None
+# Worker processes split the cores, this one is pinned to its share before any thread starts
+pinned_cores = claim_cores(faiss_configuration.cpu_cores, faiss_configuration.workers,
+                           os.path.join(os.path.dirname(files.index_path), 'cpu_slots')) \
+    if faiss_configuration.pin_cpus else None
+cpu_scheduler = CpuScheduler(len(pinned_cores) if pinned_cores else
+                             faiss_configuration.cpu_cores // max(faiss_configuration.workers, 1),
+                             faiss_configuration.adaptive_threads, pinned_cores)
+# Exact vectors for re-ranking live next to the index, workers of a shared index don't re-rank
+vectors_path = files.vectors_path if faiss_configuration.rerank else None
+if faiss_configuration.primary_address:
+    # Read-only copy of the index of the primary, bootstrapped from its snapshot and following its writes
+    faiss_index = ReplicaFaissIndex(faiss_configuration.dimension, faiss_configuration.index_factory,
+                                    faiss_configuration.primary_address, application_config.SECRET_KEY.encode(),
+                                    faiss_configuration.tombstones)
+elif faiss_configuration.shared_index:
+    # Map the index published by the writer process instead of loading a copy
+    faiss_index = SharedFaissIndex(files.index_path, faiss_configuration.dimension,
+                                   faiss_configuration.writer_address,
+                                   application_config.SECRET_KEY.encode())
+elif faiss_configuration.n_shards > 1:
+    # Split the index across shards searched in parallel
+    faiss_index = ShardedFaissIndex(files.index_path, faiss_configuration.dimension,
+                                    faiss_configuration.index_factory, faiss_configuration.n_shards,
+                                    faiss_configuration.shard_processes, faiss_configuration.tombstones,
+                                    faiss_configuration.background_loading, vectors_path,
+                                    faiss_configuration.rerank_factor, cpu_scheduler)
+elif faiss_configuration.wal:
+    # Recover the index from its checkpoint and write-ahead log
+    faiss_index, checkpointer, recovery_report = open_durable_index(
+        files.index_path, faiss_configuration.dimension, faiss_configuration.index_factory,
+        files.wal_path, files.checkpoint_path,
+        faiss_configuration.wal_fsync, faiss_configuration.wal_fsync_interval_ms,
+        faiss_configuration.checkpoint_interval, faiss_configuration.tombstones,
+        faiss_configuration.background_loading, vectors_path, faiss_configuration.rerank_factor)
+else:
+    faiss_index = FaissIndex(files.index_path, faiss_configuration.dimension,
+                             faiss_configuration.index_factory, faiss_configuration.tombstones,
+                             faiss_configuration.background_loading, vectors_path,
+                             faiss_configuration.rerank_factor)
+faiss_index.cpu_scheduler = cpu_scheduler
+# Keys of image ids are allocated by the process which owns the index
+if faiss_configuration.key_store and not faiss_configuration.shared_index and faiss_configuration.n_shards == 1 \
+        and not faiss_configuration.primary_address:
+    faiss_index.key_store = KeyStore(files.key_store_path, faiss_configuration.key_size,
+                                     faiss_configuration.payload_size)
+# Dead vectors of tombstoned updates and deletions are removed in background, replicas take tombstones
+# over from the primary and indexes like HNSW which can't remove vectors keep tombstones anyway
+compactor = None
+if not faiss_configuration.shared_index:
+    compactor = Compactor(faiss_index, faiss_configuration.compaction_dead_ratio,
+                          faiss_configuration.compaction_interval)
+    compactor.start()
+# Writes of the index streamed to replicas, the process which owns the index is the primary
+replication_primary = None
+if faiss_configuration.replication_address and not faiss_configuration.shared_index \
+        and faiss_configuration.n_shards == 1 and not faiss_configuration.primary_address:
+    replication_primary = ReplicationPrimary(faiss_index, faiss_configuration.replication_address,
+                                             application_config.SECRET_KEY.encode(),
+                                             int(faiss_configuration.replication_backlog_mb * 2 ** 20))
+    replication_primary.start()
+
+
+def replication() -> ReplicationPrimary or ReplicaFaissIndex or None:
+    """Get the primary or replica of this process, None without replication"""
+    if isinstance(faiss_index, ReplicaFaissIndex):
+        return faiss_index
+
+    return replication_primary
+
+
+# New index built from the vectors of the default one in background and swapped in,
+# replicas get a snapshot of the primary instead
+index_rebuilder = None
+if not faiss_configuration.shared_index and faiss_configuration.n_shards == 1 \
+        and not faiss_configuration.primary_address:
+    index_rebuilder = IndexRebuilder(faiss_index, faiss_configuration.train_size, checkpointer=checkpointer)
+# Latency histograms and gauges of this process exported at /metrics
+metrics = MetricsRegistry()
+# Searches of concurrent requests are batched before going to faiss
+search_batcher = SearchBatcher(faiss_index, faiss_configuration.batch_max_wait_ms,
+                               faiss_configuration.batch_max_size, metrics)
+# Repeated query vectors are answered from the cache until the index changes
+result_cache = ResultCache(search_batcher, faiss_index, int(faiss_configuration.result_cache_mb * 2 ** 20))
 
 
 def exit_handler(index: FaissIndex) -> None:
     """
-    Write faiss in the disk on process termination
+    Write faiss in the disk on process termination,
+    with write-ahead log only the log is synced and replayed on next start
     :param index: faiss index
     """
+    # Index which is still loading has no changes, its files must not be overwritten
+    if not index.loader.ready.is_set():
+        return
+    if index.wal is not None:
+        index.wal.close()
+        return
     index.to_disk(files.backup_index_path)
 
 
 # Register the function at exit
 atexit.register(exit_handler, faiss_index)
 
+# Named collections with their own index, loaded on first use and evicted under the memory budget
+collection_registry = CollectionRegistry(
+    {name: CollectionSpec(**settings) for name, settings in collections_configuration.collections.items()},
+    int(collections_configuration.memory_budget_mb * 2 ** 20), cpu_scheduler)
+atexit.register(collection_registry.close)
 
-def login_required(method):
+# Verified tokens of this process, changes of other processes are seen after the ttl
+token_cache = TokenCache(application_config.TOKEN_CACHE_SIZE, application_config.TOKEN_CACHE_TTL)
+
+
+def log_queue_handler() -> DroppingQueueHandler or None:
+    """Get the handler which puts application log records to the writer queue"""
+    for handler in logging.getLogger(Logger.logger_name).handlers:
+        if isinstance(handler, DroppingQueueHandler):
+            return handler
+    return None
+
+
+def queue_depths() -> dict:
+    """Get number of items waiting in each queue"""
+    handler = log_queue_handler()
+    return {("search_batch",): search_batcher.queue.qsize(),
+            ("search_in_flight",): search_batcher.in_flight,
+            ("log",): handler.queue.qsize() if handler is not None else None}
+
+
+request_seconds = metrics.histogram('faiss_server_request_seconds', 'Latency of requests', ('endpoint',))
+stage_seconds = metrics.histogram('faiss_server_stage_seconds', 'Latency of request stages',
+                                  ('endpoint', 'stage'))
+metrics.gauge('faiss_server_index_vectors', 'Number of vectors in the index', lambda: len(faiss_index))
+metrics.gauge('faiss_server_index_dead_vectors', 'Removed or overwritten vectors waiting for compaction',
+              lambda: faiss_index.dead_count)
+metrics.gauge('faiss_server_index_compactions_total', 'Compactions of dead vectors',
+              lambda: compactor.compactions if compactor is not None else None, metric_type='counter')
+metrics.gauge('faiss_server_index_ready', 'Whether the index is loaded and serves requests',
+              lambda: int(faiss_index.loader.ready.is_set()))
+metrics.gauge('faiss_server_index_load_progress', 'Share of the index file which is loaded',
+              lambda: faiss_index.loader.progress)
+metrics.gauge('faiss_server_index_generation', 'Number of changes of the index', lambda: faiss_index.generation)
+metrics.gauge('faiss_server_collections_loaded', 'Named collections in memory', lambda: len(collection_registry))
+metrics.gauge('faiss_server_collections_memory_bytes', 'Estimated memory of loaded named collections',
+              lambda: collection_registry.memory_bytes)
+metrics.gauge('faiss_server_collection_loads_total', 'Loads and evictions of named collections',
+              lambda: {("load",): collection_registry.loads, ("eviction",): collection_registry.evictions},
+              ('event',), metric_type='counter')
+metrics.gauge('faiss_server_cpu_threads', 'Threads of faiss calls of this worker',
+              lambda: cpu_scheduler.max_threads)
+metrics.gauge('faiss_server_cpu_pinned_cores', 'Cores this worker is pinned to',
+              lambda: len(cpu_scheduler.pinned_cores) if cpu_scheduler.pinned_cores else None)
+metrics.gauge('faiss_server_faiss_active_calls', 'Faiss calls sharing the threads of this worker',
+              lambda: cpu_scheduler.active)
+metrics.gauge('faiss_server_faiss_threads', 'Threads chosen for the last faiss call',
+              lambda: {(operation,): n_threads
+                       for operation, n_threads in dict(cpu_scheduler.last_threads).items()},
+              ('operation',))
+metrics.gauge('faiss_server_faiss_calls_total', 'Faiss calls by the number of threads chosen',
+              lambda: {(operation, str(n_threads)): calls
+                       for (operation, n_threads), calls in dict(cpu_scheduler.calls).items()},
+              ('operation', 'threads'), metric_type='counter')
+metrics.gauge('faiss_server_rebuild_progress', 'Share of the vectors added to the index being rebuilt',
+              lambda: index_rebuilder.progress if index_rebuilder is not None else None)
+metrics.gauge('faiss_server_rebuilds_total', 'Rebuilt indexes swapped in',
+              lambda: index_rebuilder.rebuilds if index_rebuilder is not None else None, metric_type='counter')
+metrics.gauge('faiss_server_replication_sequence', 'Last write of the primary or applied by the replica',
+              lambda: replication().sequence if replication() is not None else None)
+metrics.gauge('faiss_server_replication_snapshots_total', 'Snapshots sent by the primary or taken by the replica',
+              lambda: replication().snapshots if replication() is not None else None, metric_type='counter')
+metrics.gauge('faiss_server_replication_replicas', 'Replicas streaming writes of the primary',
+              lambda: replication_primary.replicas if replication_primary is not None else None)
+metrics.gauge('faiss_server_replica_lag_writes', 'Writes of the primary not applied by the replica',
+              lambda: faiss_index.lag_writes if isinstance(faiss_index, ReplicaFaissIndex) else None)
+metrics.gauge('faiss_server_replica_lag_seconds', 'Age of the oldest write not applied by the replica',
+              lambda: faiss_index.lag_seconds if isinstance(faiss_index, ReplicaFaissIndex) else None)
+metrics.gauge('faiss_server_replica_connected', 'Whether the replica is connected to the primary',
+              lambda: int(faiss_index.connected) if isinstance(faiss_index, ReplicaFaissIndex) else None)
+metrics.gauge('process_resident_memory_bytes', 'Resident memory of the process', resident_memory_bytes)
+metrics.gauge('faiss_server_queue_depth', 'Items waiting in queues', queue_depths, ('queue',))
+metrics.gauge('faiss_server_log_dropped_total', 'Log records dropped because the log queue was full',
+              lambda: getattr(log_queue_handler(), 'dropped', None), metric_type='counter')
+metrics.gauge('faiss_server_result_cache_lookups_total', 'Lookups of query vectors in the result cache',
+              lambda: {("hit",): result_cache.hits, ("miss",): result_cache.misses}, ('result',),
+              metric_type='counter')
+metrics.gauge('faiss_server_result_cache_evictions_total', 'Results evicted from the result cache over its memory cap',
+              lambda: result_cache.evictions, metric_type='counter')
+metrics.gauge('faiss_server_result_cache_bytes', 'Memory taken by cached search results',
+              lambda: result_cache.size_bytes)
+metrics.gauge('faiss_server_token_cache_entries', 'Verified tokens in the cache', lambda: len(token_cache))
+
+
+def start_request_timer() -> None:
+    """Remember when the request started, registered as before request function"""
+    g.request_started = time.perf_counter()
+    g.stage_timings = []
+
+
+def record_request_timing(response):
     """
-    Check if the user is logged in
+    Record latency of the request and report its stages in the Server-Timing header,
+    registered as after request function
+    :param response: response of the request
+    :return: response
     """
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    request_seconds.observe(elapsed, request.endpoint or 'unknown')
+    if application_config.SERVER_TIMING:
+        timings = [f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in g.stage_timings]
+        timings.append(f"total;dur={elapsed * 1000:.3f}")
+        response.headers['Server-Timing'] = ", ".join(timings)
 
-    @functools.wraps(method)
-    def wrapper(_):
-        # Get the token from header
-        token = request.headers.get('Authorization')
-        if not token:
-            abort(http_status_code=401, message='Authorization required.')
+    return response
+
+
+def require_ready_index():
+    """
+    Answer requests which need the index with 503 until it is loaded,
+    registered as before request function
+    :return: warming up response or None to handle the request
+    """
+    if faiss_index.loader.ready.is_set() or request.endpoint in INDEX_FREE_ENDPOINTS:
+        return None
+
+    return {"message": messages.WARMING_UP, **faiss_index.loader.status()}, 503, {"Retry-After": "1"}
+
+
+def request_collection(name: str or None) -> FaissIndex or str:
+    """
+    Get the index of a collection, it is not evicted before the request ends
+    :param name: collection name, None for the default index
+    :return: index or error status
+    """
+    if name is None:
+        return faiss_index
+    if 'collections' not in g:
+        g.collections = contextlib.ExitStack()
+
+    return g.collections.enter_context(collection_registry.use(name))
+
+
+def key_arguments(index: FaissIndex, body: dict or None) -> dict or str:
+    """
+    Get string keys and payloads of a JSON request
+    :param index: index of the request
+    :param body: decoded JSON body
+    :return: keyword arguments of the index call or error status if the index has no key store
+    """
+    arguments = {name: body[name] for name in ('keys', 'payloads') if body and body.get(name) is not None}
+    if arguments and getattr(index, 'key_store', None) is None:
+        return messages.KEY_STORE_DISABLED
+
+    return arguments
+
+
+def check_n_results(n_results) -> str or None:
+    """
+    Check a requested number of results before it reaches the index or a shared batch
+    :param n_results: number of results of the request
+    :return: error status or None if it is a positive integer up to MAX_RESULTS
+    """
+    if not valid_n_results(n_results, faiss_configuration.max_results):
+        return messages.INVALID_N_RESULTS
+
+    return None
+
+
+def check_search_knobs(search_knobs: dict) -> str or None:
+    """
+    Check per-request search knobs before they reach the index
+    :param search_knobs: nprobe and ef_search of the request, None if not given
+    :return: error status or None if every given knob is a positive integer
+    """
+    for value in search_knobs.values():
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < 1):
+            return messages.INVALID_SEARCH_KNOBS
+
+    return None
+
+
+def lookup_keys(index: FaissIndex, keys: list) -> numpy.ndarray or str:
+    """
+    Find image ids of stored keys
+    :param index: index of the request
+    :param keys: list of strings
+    :return: int64 image ids or error status if the index has no key store or a key is not stored
+    """
+    key_store = getattr(index, 'key_store', None)
+    if key_store is None:
+        return messages.KEY_STORE_DISABLED
+    id_array = key_store.lookup(keys)
+    if isinstance(id_array, str):
+        return id_array
+
+    return messages.UNKNOWN_KEYS if (id_array < 0).any() else id_array
+
+
+def join_keys(index: FaissIndex, result_indices: numpy.ndarray, lims: numpy.ndarray or None = None) -> dict:
+    """
+    Get keys and payloads of search results if the index has a key store
+    :param index: searched index
+    :param result_indices: image ids of the results
+    :param lims: offsets of the results of every query of a range search
+    :return: keys and payloads in the layout of the indices of the response
+    """
+    key_store = getattr(index, 'key_store', None)
+    if key_store is None:
+        return {}
+    joined = key_store.join(result_indices)
+    if lims is None:
+        return joined
+
+    return {name: [values[start:stop] for start, stop in zip(lims[:-1].tolist(), lims[1:].tolist())]
+            for name, values in joined.items()}
+
+
+def release_collections(_exception=None) -> None:
+    """Let collections used by the request be evicted, registered as teardown request function"""
+    used_collections = g.pop('collections', None)
+    if used_collections is not None:
+        used_collections.close()
+
+
+@contextlib.contextmanager
+def timed_stage(stage: str):
+    """
+    Measure a stage of the request for metrics and the Server-Timing header
+    :param stage: name of the stage e.g. parse, validate, convert, faiss, serialize
+    """
+    tok = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - tok
+        stage_seconds.observe(elapsed, request.endpoint or 'unknown', stage)
+        if 'stage_timings' in g:
+            g.stage_timings.append((stage, elapsed))
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_user_tokens(_mapper, _connection, user: User) -> None:
+    """
+    Forget cached tokens of a changed or deleted user
+    :param user: user
+    """
+    token_cache.invalidate_user(user.username)
+
+
+def authenticate(token: str or None) -> CachedUser or tuple:
+    """
+    Verify an authorization token, verified tokens are served from the cache
+    without decoding and database query, which needs an application context
+    :param token: token from the Authorization header
+    :return: active user or http status code and message
+    """
+    if not token:
+        return 401, 'Authorization required.'
+    user = token_cache.get(token)
+    if user is None:
         try:
             # Try to decode the token
-            decoded = decode(token, application_config.SECRET_KEY, algorithms='HS256')
+            decoded = decode(token, application_config.SECRET_KEY, algorithms=['HS256'])
         except DecodeError:
-            abort(http_status_code=403, message='Token invalid.')
-            return
+            return 403, 'Token invalid.'
         except ExpiredSignatureError:
-            abort(http_status_code=403, message='Token expired.')
-            return
+            return 403, 'Token expired.'
         # Get the username from decoded token
         username = decoded['username']
         # Check if the username exist in our database
-        user = User.query.get(username)
-        if not user:
-            abort(http_status_code=404, message='User not found.')
+        user_record = User.query.get(username)
+        if not user_record:
+            return 404, 'User not found.'
+        user = CachedUser(user_record.username, bool(user_record.active))
+        token_cache.put(token, user, decoded.get('exp'))
+    if not user.active:
+        return 403, 'User inactive.'
+
+    return user
+
+
+def login_required(method):
+    """Check if the user is logged in"""
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        # Get the token from header
+        user = authenticate(request.headers.get('Authorization'))
+        if not isinstance(user, CachedUser):
+            abort(http_status_code=user[0], message=user[1])
+        g.user = user
+
+        return method(*args, **kwargs)
+
+    return wrapper
+
+
+def admin_required(method):
+    """Check if the user is logged in and is an administrator"""
+
+    @functools.wraps(method)
+    @login_required
+    def wrapper(*args, **kwargs):
+        if g.user.username not in application_config.ADMIN_USERS:
+            abort(http_status_code=403, message=messages.NOT_ADMIN)
 
-        return method(user)
+        return method(*args, **kwargs)
 
     return wrapper
@@ -0,0 +1,181 @@
+"""Binary wire format for features vectors and search results"""
+__author__ = "Vitali Muladze"
+
+import io
+
+import numpy
+from flask import Response
+from numpy.lib import format as npy_format
+from werkzeug.datastructures import MIMEAccept
+
+from source.configuration import messages
+
+# Raw little-endian float32 matrix, optionally followed by int64 ids
+OCTET_STREAM = 'application/octet-stream'
+# One or two concatenated .npy arrays: float32 matrix and optional int64 ids
+NPY = 'application/x-npy'
+BINARY_MIMETYPES = (OCTET_STREAM, NPY)
+
+VECTOR_DTYPE = numpy.dtype('<f4')
+ID_DTYPE = numpy.dtype('<i8')
+
+
+def is_binary(request) -> bool:
+    """
+    Check if the request body is in a binary format
+    :param request: flask request
+    :return: is the body binary or not
+    """
+    return request.mimetype in BINARY_MIMETYPES
+
+
+def response_mimetype(request) -> str or None:
+    """
+    Get the binary mimetype the client prefers for the response
+    :param request: flask request
+    :return: binary mimetype or None for json
+    """
+    return accepted_mimetype(request.accept_mimetypes)
+
+
+def accepted_mimetype(accept_mimetypes: MIMEAccept) -> str or None:
+    """
+    Get the preferred binary mimetype of parsed Accept header values
+    :param accept_mimetypes: werkzeug accept object e.g. of parse_accept_header(value, MIMEAccept)
+    :return: binary mimetype or None for json
+    """
+    best = accept_mimetypes.best_match(('application/json',) + BINARY_MIMETYPES, default='application/json')
+    return best if best in BINARY_MIMETYPES else None
+
+
+def read_npy(body: bytes, offset: int = 0) -> tuple:
+    """
+    Read an .npy array from the body without copying its data
+    :param body: request body
+    :param offset: offset of the array in the body
+    :return: array and offset of the next byte after it
+    """
+    stream = io.BytesIO(memoryview(body)[offset:offset + 4096])
+    version = npy_format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = npy_format.read_array_header_1_0(stream)
+    else:
+        shape, fortran_order, dtype = npy_format.read_array_header_2_0(stream)
+    data_offset = offset + stream.tell()
+    count = int(numpy.prod(shape))
+    array = numpy.frombuffer(body, dtype=dtype, count=count, offset=data_offset)
+    array = array.reshape(shape, order='F' if fortran_order else 'C')
+
+    return array, data_offset + count * dtype.itemsize
+
+
+def parse_vectors(body: bytes, mimetype: str, dimension: int,
+                  with_ids: bool = False) -> tuple or str:
+    """
+    Parse features vectors and image ids from a binary body
+    :param body: request body
+    :param mimetype: mimetype of the body
+    :param dimension: dimension of the index
+    :param with_ids: if the raw body carries image ids after the vectors
+    :return: features vectors and image ids (or None) or error status
+    """
+    try:
+        if mimetype == NPY:
+            features_vectors, offset = read_npy(body)
+            image_ids = read_npy(body, offset)[0] if offset < len(body) else None
+        else:
+            row_size = dimension * VECTOR_DTYPE.itemsize + (ID_DTYPE.itemsize if with_ids else 0)
+            # Body must be a whole number of rows
+            if not body or len(body) % row_size:
+                return messages.BAD_BINARY_BODY
+            n_vectors = len(body) // row_size
+            features_vectors = numpy.frombuffer(body, dtype=VECTOR_DTYPE,
+                                                count=n_vectors * dimension).reshape(n_vectors, dimension)
+            image_ids = numpy.frombuffer(body, dtype=ID_DTYPE, count=n_vectors,
+                                         offset=features_vectors.nbytes) if with_ids else None
+    except ValueError:
+        return messages.BAD_BINARY_BODY
+
+    return features_vectors, image_ids
+
+
+def parse_int(value: str or None, default: int or None = None) -> int or str or None:
+    """
+    Parse an integer query argument
+    :param value: query argument e.g. '10'
+    :param default: value of a missing argument
+    :return: integer, the default if the argument is missing or the argument itself if it is no integer,
+             so validation of the request refuses it
+    """
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def parse_id_list(value: str or None) -> list or str or None:
+    """
+    Parse comma separated image ids of a query argument
+    :param value: query argument e.g. '1,5,17'
+    :return: list of ids, None if the argument is missing or error status
+    """
+    if value is None:
+        return None
+    try:
+        return [int(image_id) for image_id in value.split(',') if image_id.strip()]
+    except ValueError:
+        return messages.INVALID_IDS
+
+
+def encode_results(indices: numpy.ndarray, distances: numpy.ndarray, mimetype: str,
+                   lims: numpy.ndarray or None = None) -> bytes:
+    """
+    Encode search results in a binary format
+    :param indices: int64 result indices
+    :param distances: float32 result distances
+    :param mimetype: binary mimetype of the response
+    :param lims: int64 offsets of the results of each query for range searches
+    :return: response body
+    """
+    arrays = [] if lims is None else [numpy.ascontiguousarray(lims, dtype=ID_DTYPE)]
+    arrays += [numpy.ascontiguousarray(indices, dtype=ID_DTYPE),
+               numpy.ascontiguousarray(distances, dtype=VECTOR_DTYPE)]
+    if mimetype == NPY:
+        stream = io.BytesIO()
+        for array in arrays:
+            npy_format.write_array(stream, array)
+        return stream.getvalue()
+
+    return b''.join(array.tobytes() for array in arrays)
+
+
+def results_response(indices: numpy.ndarray, distances: numpy.ndarray, mimetype: str) -> Response:
+    """
+    Make a binary response for search results
+    :param indices: result indices
+    :param distances: result distances
+    :param mimetype: binary mimetype of the response
+    :return: flask response with the shape of results in the headers
+    """
+    response = Response(encode_results(indices, distances, mimetype), mimetype=mimetype)
+    response.headers['X-Result-Shape'] = ','.join(str(size) for size in numpy.shape(indices))
+
+    return response
+
+
+def range_results_response(lims: numpy.ndarray, indices: numpy.ndarray, distances: numpy.ndarray,
+                           mimetype: str) -> Response:
+    """
+    Make a binary response for range search results, results are not padded to the same length
+    :param lims: results of query i are at lims[i]:lims[i + 1]
+    :param indices: result indices of all queries
+    :param distances: result distances of all queries
+    :param mimetype: binary mimetype of the response
+    :return: flask response with number of queries and results in the headers
+    """
+    response = Response(encode_results(indices, distances, mimetype, lims), mimetype=mimetype)
+    response.headers['X-Result-Shape'] = f"{lims.shape[0] - 1},{indices.shape[0]}"
+
+    return response
@@ -0,0 +1,35 @@
+from models.checkpointer import open_durable_index
+from models.faiss_database import FaissIndex
+from models.replication import ReplicationPrimary
+from models.shared_index import SharedIndexWriter, latest_index_path
+from source.configuration import application_config, files, faiss_configuration
+
+if faiss_configuration.wal:
+    # Recover the index from its checkpoint and write-ahead log
+    faiss_index, checkpointer, recovery_report = open_durable_index(
+        files.index_path, faiss_configuration.dimension, faiss_configuration.index_factory,
+        files.wal_path, files.checkpoint_path,
+        faiss_configuration.wal_fsync, faiss_configuration.wal_fsync_interval_ms,
+        faiss_configuration.checkpoint_interval, faiss_configuration.tombstones)
+    print(f"Index recovered: {recovery_report}")
+else:
+    # Continue from the last published generation
+    faiss_index = FaissIndex(latest_index_path(files.index_path), faiss_configuration.dimension,
+                             faiss_configuration.index_factory, faiss_configuration.tombstones)
+# Create the process which owns mutations of the shared index
+writer = SharedIndexWriter(faiss_index, files.index_path,
+                           faiss_configuration.writer_address,
+                           application_config.SECRET_KEY.encode(),
+                           faiss_configuration.publish_interval)
+
+# Writes of the shared index streamed to replicas on other hosts
+replication_primary = None
+if faiss_configuration.replication_address:
+    replication_primary = ReplicationPrimary(faiss_index, faiss_configuration.replication_address,
+                                             application_config.SECRET_KEY.encode(),
+                                             int(faiss_configuration.replication_backlog_mb * 2 ** 20))
+
+if __name__ == '__main__':
+    if replication_primary is not None:
+        replication_primary.start()
+    writer.serve_forever()
@@ -1,23 +1,74 @@
+import threading
+
 from flask_restful import Api
 
 from apps import create_app
-from resources import (Register, Login, Search, Insert, Update)
+from commons import (faiss_index, recovery_report, release_collections, require_ready_index, start_request_timer,
+                     record_request_timing)
+from resources import (Register, Login, Activate, Search, Insert, Update, Delete, Train, BulkInsert, Metrics,
+                       Liveness, Readiness, Collections, Rebuild, Replication)
 from source.configuration import application_config
 
 # Create flask application
 application = create_app(application_config)
+
+
+def log_index_loading() -> None:
+    """Report how long loading of the index took once it finished in background"""
+    faiss_index.loader.done.wait()
+    status = faiss_index.loader.status()
+    if status["error"]:
+        application.logger.error("Index loading failed: %s", status["error"])
+    else:
+        application.logger.info("Index loaded in background: %s", status)
+
+
+# Report how long recovery of the index took
+if recovery_report:
+    application.logger.info("Index recovered: %s", recovery_report)
+    if recovery_report["skipped_lsns"]:
+        application.logger.error("Log records which can not be applied were skipped: %s",
+                                 recovery_report["skipped_lsns"])
+elif faiss_index.loader.started is not None:
+    threading.Thread(target=log_index_loading, name='IndexLoadingReport', daemon=True).start()
+# Measure latency of every request
+application.before_request(start_request_timer)
+# Answer with 503 until the index is loaded
+application.before_request(require_ready_index)
+application.after_request(record_request_timing)
+# Collections used by a request may be evicted once it ended
+application.teardown_request(release_collections)
 # Make an restful API
 api = Api(application)
 # Add register endpoint
 api.add_resource(Register, "/register")
 # Add login endpoint
 api.add_resource(Login, "/login")
+# Add activation endpoint
+api.add_resource(Activate, "/activate")
 # Add searching endpoint
 api.add_resource(Search, "/search")
 # Add insertion endpoint
 api.add_resource(Insert, "/insert")
 # Add update endpoint
 api.add_resource(Update, "/update")
+# Add deletion endpoint
+api.add_resource(Delete, "/delete")
+# Add training endpoint
+api.add_resource(Train, "/train")
+# Add bulk insertion endpoint
+api.add_resource(BulkInsert, "/bulk_insert")
+# Add collections endpoint
+api.add_resource(Collections, "/collections")
+# Add rebuild endpoint
+api.add_resource(Rebuild, "/rebuild")
+# Add replication endpoint
+api.add_resource(Replication, "/replication")
+# Add metrics endpoint
+api.add_resource(Metrics, "/metrics")
+# Add health endpoints
+api.add_resource(Liveness, "/health/live")
+api.add_resource(Readiness, "/health/ready")
 
 if __name__ == '__main__':
     application.run("0.0.0.0", port=8080)
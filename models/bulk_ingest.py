@@ -0,0 +1,323 @@
+"""Streaming bulk ingestion of features vectors into the faiss index"""
+__author__ = "Vitali Muladze"
+
+import fcntl
+import io
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import numpy
+from numpy.lib import format as npy_format
+
+from models.faiss_database import FaissIndex
+from source.configuration import messages
+
+NDJSON = 'ndjson'
+NPY = 'npy'
+NPY_MAGIC = b'\x93NUMPY'
+
+
+def read_exactly(stream, size: int) -> bytes:
+    """
+    Read exactly size bytes, streams may return less on one read
+    :param stream: binary stream
+    :param size: number of bytes
+    :return: bytes, shorter only at the end of the stream
+    """
+    buffer = bytearray()
+    while len(buffer) < size:
+        data = stream.read(size - len(buffer))
+        if not data:
+            break
+        buffer += data
+
+    return bytes(buffer)
+
+
+def read_npy_header(stream) -> tuple or None:
+    """
+    Read the header of the next .npy array of a stream
+    :param stream: binary stream
+    :return: shape and dtype of the array or None at the end of the stream
+    """
+    head = read_exactly(stream, len(NPY_MAGIC) + 2)
+    if not head:
+        return None
+    if len(head) < len(NPY_MAGIC) + 2 or not head.startswith(NPY_MAGIC):
+        raise ValueError("Stream is not a sequence of .npy arrays")
+    # Version 1.0 keeps the header length in 2 bytes, later versions in 4
+    length_size = 2 if head[-2] == 1 else 4
+    length_bytes = read_exactly(stream, length_size)
+    header_length = struct.unpack('<H' if length_size == 2 else '<I', length_bytes)[0]
+    header = io.BytesIO(head + length_bytes + read_exactly(stream, header_length))
+    version = npy_format.read_magic(header)
+    if version == (1, 0):
+        shape, fortran_order, dtype = npy_format.read_array_header_1_0(header)
+    else:
+        shape, fortran_order, dtype = npy_format.read_array_header_2_0(header)
+    if not shape:
+        raise ValueError("Stream arrays must have rows")
+    # Rows of Fortran ordered matrices are not stored one after another
+    if fortran_order and len(shape) > 1:
+        raise ValueError("Stream arrays must be in C order")
+
+    return shape, dtype
+
+
+def read_npy_rows(stream, shape: tuple, dtype: numpy.dtype, chunk_rows: int):
+    """
+    Read the data of an .npy array slice by slice, only one slice is held in memory
+    :param stream: binary stream positioned after the array header
+    :param shape: shape of the array
+    :param dtype: dtype of the array
+    :param chunk_rows: number of rows in a slice
+    :return: generator of arrays of at most chunk_rows rows
+    """
+    row_items = int(numpy.prod(shape[1:]))
+    for start in range(0, shape[0], chunk_rows):
+        n_rows = min(chunk_rows, shape[0] - start)
+        data = read_exactly(stream, n_rows * row_items * dtype.itemsize)
+        if len(data) < n_rows * row_items * dtype.itemsize:
+            raise ValueError("Stream ended inside of an .npy array")
+        yield numpy.frombuffer(data, dtype=dtype).reshape((n_rows,) + tuple(shape[1:]))
+
+
+class BulkIngest:
+    def __init__(self, faiss_index: FaissIndex, progress_path: str, chunk_size: int = 10000,
+                 progress=None, index_path: str or None = None, persist_interval: float = 60):
+        """
+        Stream vectors into the index chunk by chunk with resumable progress
+        :param faiss_index: index to insert into
+        :param progress_path: json file with committed rows of every ingestion
+        :param chunk_size: number of vectors inserted at once
+        :param progress: function called with progress messages
+        :param index_path: file an index without write-ahead log is written to before its rows are committed,
+                           None if such an index records no progress
+        :param persist_interval: seconds between writes of an index without write-ahead log
+        """
+        self.faiss_index = faiss_index
+        self.progress_path = progress_path
+        self.chunk_size = chunk_size
+        self.progress = progress or (lambda message: None)
+        self.index_path = index_path
+        self.persist_interval = persist_interval
+
+    def committed_rows(self, ingest_id: str or None) -> int:
+        """
+        Get number of rows already committed by an ingestion
+        :param ingest_id: id of the ingestion, None never resumes
+        :return: number of committed rows
+        """
+        if ingest_id is None or not os.path.isfile(self.progress_path):
+            return 0
+        with open(self.progress_path) as progress_file:
+            return json.load(progress_file).get(ingest_id, {}).get("rows", 0)
+
+    def _make_durable(self) -> bool:
+        """
+        Make the inserted rows durable before their progress is recorded
+        :return: False if the index can't be made durable, its progress is not recorded then
+        """
+        if self.faiss_index.wal is not None:
+            self.faiss_index.wal.sync()
+            return True
+        if self.index_path is None:
+            return False
+
+        return self.faiss_index.to_disk(self.index_path) == messages.OK
+
+    def _commit(self, ingest_id: str or None, rows: int, chunks: int) -> None:
+        """
+        Remember committed rows of an ingestion atomically
+        :param ingest_id: id of the ingestion
+        :param rows: committed rows
+        :param chunks: committed chunks
+        """
+        if ingest_id is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.progress_path)), exist_ok=True)
+        # Ingestions of other threads and worker processes update the same file
+        with open(self.progress_path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            state = {}
+            if os.path.isfile(self.progress_path):
+                with open(self.progress_path) as progress_file:
+                    state = json.load(progress_file)
+            state[ingest_id] = {"rows": rows, "chunks": chunks}
+            temporary_path = f"{self.progress_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary_path, 'w') as progress_file:
+                json.dump(state, progress_file)
+            os.replace(temporary_path, self.progress_path)
+
+    def read_chunks(self, stream, stream_format: str, skip_rows: int = 0):
+        """
+        Read the stream as chunks of vectors and ids
+        :param stream: binary stream
+        :param stream_format: NDJSON lines {"features_vector": [...], "image_id": 17}
+        or NPY float32 matrices, each optionally followed by an int64 array of its ids
+        :param skip_rows: rows committed earlier, they are skipped without parsing if possible
+        :return: generator of (features vectors, image ids or None)
+        """
+        if stream_format == NDJSON:
+            vectors, ids = [], []
+            for line in stream:
+                if not line.strip():
+                    continue
+                # Committed lines are not parsed again
+                if skip_rows:
+                    skip_rows -= 1
+                    continue
+                row = json.loads(line)
+                vectors.append(row.get("features_vector"))
+                ids.append(row.get("image_id"))
+                if len(vectors) == self.chunk_size:
+                    yield vectors, ids
+                    vectors, ids = [], []
+            if vectors:
+                yield vectors, ids
+            return
+        pending = None
+        while True:
+            header = read_npy_header(stream)
+            if header is None:
+                break
+            shape, dtype = header
+            if len(shape) == 1 and pending is not None:
+                # Ids take 8 bytes a row, they are held while the vectors are read back
+                id_array = numpy.concatenate(list(read_npy_rows(stream, shape, dtype, self.chunk_size)))
+                yield from self._read_back(pending, id_array, skip_rows)
+                skip_rows = max(0, skip_rows - pending[1][0])
+                pending = None
+                continue
+            if pending is not None:
+                yield from self._read_back(pending, None, skip_rows)
+                skip_rows = max(0, skip_rows - pending[1][0])
+            pending = self._spill(stream, shape, dtype)
+        if pending is not None:
+            yield from self._read_back(pending, None, skip_rows)
+
+    def _spill(self, stream, shape: tuple, dtype: numpy.dtype) -> tuple:
+        """
+        Copy an .npy matrix of the stream aside until it is known whether its ids follow,
+        matrices larger than a chunk go to a temporary file instead of memory
+        :param stream: binary stream positioned after the array header
+        :param shape: shape of the matrix
+        :param dtype: dtype of the matrix
+        :return: file with the matrix data, its shape and dtype
+        """
+        row_bytes = int(numpy.prod(shape[1:])) * dtype.itemsize
+        spill_file = tempfile.SpooledTemporaryFile(max_size=self.chunk_size * row_bytes)
+        for rows in read_npy_rows(stream, shape, dtype, self.chunk_size):
+            spill_file.write(rows.tobytes())
+        spill_file.seek(0)
+
+        return spill_file, shape, dtype
+
+    def _read_back(self, pending: tuple, id_array: numpy.ndarray or None, skip_rows: int):
+        """
+        Read a matrix copied aside in chunks of the configured size
+        :param pending: file with the matrix data, its shape and dtype
+        :param id_array: image ids or None
+        :param skip_rows: rows to skip from the beginning
+        :return: generator of (features vectors, image ids or None)
+        """
+        spill_file, shape, dtype = pending
+        start = min(skip_rows, shape[0])
+        spill_file.seek(start * int(numpy.prod(shape[1:])) * dtype.itemsize)
+        with spill_file:
+            for vector_array in read_npy_rows(spill_file, (shape[0] - start,) + tuple(shape[1:]), dtype,
+                                              self.chunk_size):
+                stop = start + vector_array.shape[0]
+                yield vector_array, id_array[start:stop] if id_array is not None else None
+                start = stop
+
+    def _persist(self, ingest_id: str or None, rows: int, chunks: int, skipped_rows: int, tok: float) -> float:
+        """
+        Make inserted rows durable, record and report them as committed
+        :return: time of the commit
+        """
+        if self._make_durable():
+            self._commit(ingest_id, rows, chunks)
+        elapsed = time.time() - tok
+        self.progress(f"bulk ingest {ingest_id}: {rows} rows committed, "
+                      f"{(rows - skipped_rows) / max(elapsed, 1e-9):.0f} rows/s")
+
+        return time.time()
+
+    def validate(self, features_vectors: list or numpy.ndarray,
+                 image_ids: list or numpy.ndarray or None) -> tuple or str:
+        """
+        Validate a whole chunk with numpy instead of checking vectors one by one
+        :param features_vectors: features vectors of the chunk
+        :param image_ids: image ids of the chunk, None values mean automatic ids
+        :return: float32 matrix and int64 ids (or None) or error status
+        """
+        vector_array = self.faiss_index.to_vector_array(features_vectors)
+        if isinstance(vector_array, str):
+            return vector_array
+        if not numpy.isfinite(vector_array).all():
+            return messages.NOT_FINITE_VECTOR
+        if image_ids is None:
+            return vector_array, None
+        if isinstance(image_ids, list):
+            missing = sum(image_id is None for image_id in image_ids)
+            if missing == len(image_ids):
+                return vector_array, None
+            if missing:
+                return messages.DIMENSION_MISMATCH
+        try:
+            id_array = numpy.ascontiguousarray(image_ids, dtype=numpy.int64)
+        except (ValueError, TypeError):
+            return messages.DIMENSION_MISMATCH
+        if id_array.shape != (vector_array.shape[0],):
+            return messages.DIMENSION_MISMATCH
+        if numpy.unique(id_array).shape[0] != id_array.shape[0]:
+            return messages.DUPLICATE_IDS
+
+        return vector_array, id_array
+
+    def ingest(self, stream, stream_format: str, ingest_id: str or None = None) -> dict or str:
+        """
+        Insert vectors from the stream, resuming after the last committed chunk of the ingestion
+        :param stream: binary stream
+        :param stream_format: NDJSON or NPY
+        :param ingest_id: id of the ingestion to resume, None for a new one
+        :return: ingestion report or error status
+        """
+        if stream_format not in (NDJSON, NPY):
+            return messages.UNKNOWN_STREAM_FORMAT
+        skipped_rows = rows = self.committed_rows(ingest_id)
+        chunks = 0
+        tok = persisted = time.time()
+        status_message = None
+        try:
+            for features_vectors, image_ids in self.read_chunks(stream, stream_format, skipped_rows):
+                validated_or_status_message = self.validate(features_vectors, image_ids)
+                if isinstance(validated_or_status_message, str):
+                    status_message = f"{validated_or_status_message} in rows from {rows}"
+                    break
+                result_or_status_message = self.faiss_index.insert(*validated_or_status_message)
+                if isinstance(result_or_status_message, str):
+                    status_message = f"{result_or_status_message} in rows from {rows}"
+                    break
+                rows += validated_or_status_message[0].shape[0]
+                chunks += 1
+                # Rows are committed only once they are durable, an index without log is written to disk
+                # at most every persist_interval seconds
+                if self.faiss_index.wal is not None or time.time() - persisted >= self.persist_interval:
+                    persisted = self._persist(ingest_id, rows, chunks, skipped_rows, tok)
+        except ValueError as error:
+            status_message = f"{messages.BAD_STREAM}: {error} in rows from {rows}"
+        # Rows inserted before a bad chunk are committed too, a resumed ingestion must not repeat them
+        if chunks:
+            self._persist(ingest_id, rows, chunks, skipped_rows, tok)
+        if status_message is not None:
+            return status_message
+        elapsed = time.time() - tok
+
+        return {"ingest_id": ingest_id, "rows": rows, "skipped_rows": skipped_rows, "chunks": chunks,
+                "seconds": elapsed, "rows_per_second": (rows - skipped_rows) / max(elapsed, 1e-9)}
@@ -0,0 +1,216 @@
+"""Background checkpoints of the faiss index and recovery from the write-ahead log"""
+__author__ = "Vitali Muladze"
+
+import os
+import struct
+import threading
+import time
+
+import faiss
+import numpy
+
+from models.faiss_database import FaissIndex
+from models.write_ahead_log import INSERT, WriteAheadLog
+
+# Magic and lsn written in front of the faiss index in a checkpoint file
+CHECKPOINT_HEADER = struct.Struct('<8sQ')
+CHECKPOINT_MAGIC = b'FAISSCKP'
+# Byte length of the dead vectors bitmap written after the index, older checkpoints have none
+TOMBSTONES_HEADER = struct.Struct('<Q')
+# Rows of the vector store written after the bitmap, older checkpoints have none
+STORE_HEADER = struct.Struct('<Q')
+# Maximum number of vectors added to the index at once during replay
+REPLAY_BATCH_SIZE = 65536
+
+
+class Checkpointer:
+    def __init__(self, faiss_index: FaissIndex, wal: WriteAheadLog,
+                 checkpoint_path: str, interval: float = 300):
+        """
+        Write checkpoints of the index in background and recover it on startup
+        :param faiss_index: index to checkpoint
+        :param wal: write-ahead log of the index
+        :param checkpoint_path: path to the checkpoint file
+        :param interval: seconds between checkpoints
+        """
+        self.faiss_index = faiss_index
+        self.wal = wal
+        self.checkpoint_path = checkpoint_path
+        self.interval = interval
+        self.checkpoint_lsn = 0
+        self._checkpoint_lock = threading.Lock()
+
+    def recover(self) -> dict:
+        """
+        Load the last checkpoint and replay the log tail on top of it
+        :return: recovery report
+        """
+        tok = time.time()
+        # Rows of the vector store the replayed writes were appended after
+        store_rows = 0
+        if os.path.isfile(self.checkpoint_path):
+            with open(self.checkpoint_path, 'rb') as checkpoint:
+                magic, self.checkpoint_lsn = CHECKPOINT_HEADER.unpack(checkpoint.read(CHECKPOINT_HEADER.size))
+                if magic != CHECKPOINT_MAGIC:
+                    raise ValueError(f"{self.checkpoint_path} is not an index checkpoint")
+                # Bytes of the checkpoint count towards the loading progress
+                self.faiss_index.replace_index(self.faiss_index.loader.read_index(
+                    checkpoint, os.path.getsize(self.checkpoint_path) - CHECKPOINT_HEADER.size))
+                tombstones_header = checkpoint.read(TOMBSTONES_HEADER.size)
+                if len(tombstones_header) == TOMBSTONES_HEADER.size:
+                    n_bytes, = TOMBSTONES_HEADER.unpack(tombstones_header)
+                    self.faiss_index.restore_dead_bitmap(
+                        numpy.frombuffer(checkpoint.read(n_bytes), dtype=numpy.uint8).copy())
+                store_header = checkpoint.read(STORE_HEADER.size)
+                if len(store_header) == STORE_HEADER.size:
+                    store_rows, = STORE_HEADER.unpack(store_header)
+        loaded = time.time()
+        self.faiss_index.loader.stage = 'replaying log'
+        self.faiss_index.replay_vector_store(store_rows)
+        n_records, n_vectors = 0, 0
+        # Log records which can't be applied are skipped instead of failing every recovery
+        skipped_lsns = []
+        # Consecutive insertions are added to the index together
+        pending_inserts = []
+        for lsn, operation, id_array, vector_array in self.wal.replay(self.checkpoint_lsn):
+            n_records += 1
+            n_vectors += id_array.shape[0]
+            if operation == INSERT:
+                pending_inserts.append((lsn, id_array, vector_array))
+                if sum(ids.shape[0] for _, ids, _ in pending_inserts) < REPLAY_BATCH_SIZE:
+                    continue
+            skipped_lsns += self._apply_inserts(pending_inserts)
+            pending_inserts = []
+            if operation != INSERT and not self._apply(operation, id_array, vector_array):
+                skipped_lsns.append(lsn)
+        skipped_lsns += self._apply_inserts(pending_inserts)
+        self.faiss_index.replay_vector_store(None)
+        tik = time.time()
+
+        return {"checkpoint_lsn": self.checkpoint_lsn, "last_lsn": self.wal.last_lsn,
+                "replayed_records": n_records, "replayed_vectors": n_vectors, "skipped_lsns": skipped_lsns,
+                "checkpoint_seconds": loaded - tok, "replay_seconds": tik - loaded,
+                "total_seconds": tik - tok}
+
+    def _apply(self, operation: int, id_array: numpy.ndarray, vector_array: numpy.ndarray or None) -> bool:
+        """
+        Apply a replayed log record
+        :return: False if faiss refused it, e.g. a removal from an index which can't remove vectors
+        """
+        try:
+            self.faiss_index.apply_log_record(operation, id_array, vector_array)
+        except RuntimeError:
+            return False
+
+        return True
+
+    def _apply_inserts(self, pending_inserts: list) -> list:
+        """
+        Add replayed insertions to the index in one call
+        :param pending_inserts: list of (log sequence number, image ids, features vectors)
+        :return: log sequence numbers of insertions which can't be applied
+        """
+        if not pending_inserts:
+            return []
+        id_array = numpy.concatenate([ids for _, ids, _ in pending_inserts])
+        vector_array = numpy.concatenate([vectors for _, _, vectors in pending_inserts])
+        if self._apply(INSERT, id_array, vector_array):
+            return []
+        # Insertions are added again one by one to skip only the failing ones
+        return [lsn for lsn, ids, vectors in pending_inserts
+                if len(pending_inserts) == 1 or not self._apply(INSERT, ids, vectors)]
+
+    def start(self) -> None:
+        """Start writing checkpoints in background"""
+        threading.Thread(target=self._checkpoint_periodically, name='Checkpointer', daemon=True).start()
+
+    def _checkpoint_periodically(self) -> None:
+        """Write a checkpoint whenever the log grew"""
+        while True:
+            time.sleep(self.interval)
+            if self.wal.last_lsn > self.checkpoint_lsn:
+                self.checkpoint()
+
+    def checkpoint(self) -> int:
+        """
+        Write the index to a temporary file, rename it over the checkpoint
+        and drop the log segments it covers
+        :return: lsn covered by the checkpoint
+        """
+        with self._checkpoint_lock:
+            temporary_path = self.checkpoint_path + '.tmp'
+            checkpoint = open(temporary_path, 'wb')
+            try:
+                # Writes wait only while the index is streamed to the page cache, searches go on
+                with self.faiss_index.lock.long_read():
+                    lsn = self.wal.rotate()
+                    checkpoint.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, lsn))
+                    faiss.write_index(self.faiss_index.index, faiss.PyCallbackIOWriter(checkpoint.write))
+                    # Dead vectors are still in the index until compaction
+                    checkpoint.write(TOMBSTONES_HEADER.pack(self.faiss_index.dead_bitmap.shape[0]))
+                    checkpoint.write(self.faiss_index.dead_bitmap.tobytes())
+                    vector_store = self.faiss_index.vector_store
+                    checkpoint.write(STORE_HEADER.pack(len(vector_store) if vector_store is not None else 0))
+                    checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+            finally:
+                checkpoint.close()
+            os.replace(temporary_path, self.checkpoint_path)
+            # Make the rename durable before the log is dropped
+            directory = os.open(os.path.dirname(os.path.abspath(self.checkpoint_path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+            self.wal.truncate(lsn)
+            self.checkpoint_lsn = lsn
+
+        return lsn
+
+    def close(self) -> None:
+        """Make every logged operation durable, the log tail is replayed on next start"""
+        self.wal.close()
+
+
+def open_durable_index(index_path: str, dimension: int, index_factory: str,
+                       wal_path: str, checkpoint_path: str,
+                       fsync_policy: str = 'interval', fsync_interval_ms: float = 100,
+                       checkpoint_interval: float = 300, tombstones: bool = False,
+                       load_in_background: bool = False, vectors_path: str = None,
+                       rerank_factor: int = 4) -> tuple:
+    """
+    Recover the index from its checkpoint and log and start checkpointing it
+    :param index_path: index file used when there is no checkpoint yet
+    :param dimension: dimension of vector
+    :param index_factory: faiss factory string of a new index
+    :param wal_path: folder of the write-ahead log
+    :param checkpoint_path: path to the checkpoint file
+    :param fsync_policy: fsync policy of the log
+    :param fsync_interval_ms: milliseconds between background fsyncs
+    :param checkpoint_interval: seconds between checkpoints
+    :param tombstones: mask removed and overwritten vectors until compaction
+    :param load_in_background: recover in a thread, the report is in loader.report once it is ready
+    :param vectors_path: file of full precision vectors re-ranking results of compressed indexes
+    :param rerank_factor: candidates searched per requested result before re-ranking
+    :return: faiss index, checkpointer and recovery report (None when recovering in background)
+    """
+    faiss_index = FaissIndex(None, dimension, index_factory, tombstones,
+                             vectors_path=vectors_path, rerank_factor=rerank_factor)
+    wal = WriteAheadLog(wal_path, fsync_policy, fsync_interval_ms)
+    checkpointer = Checkpointer(faiss_index, wal, checkpoint_path, checkpoint_interval)
+
+    def recover() -> dict:
+        """Load the index, replay the log and attach it, writes are logged from now on"""
+        # The checkpoint replaces the index file once it exists
+        if not os.path.isfile(checkpoint_path) and index_path is not None and os.path.isfile(index_path):
+            faiss_index.load(index_path)
+        report = checkpointer.recover()
+        faiss_index.wal = wal
+        checkpointer.start()
+        return report
+
+    if load_in_background:
+        faiss_index.loader.start(recover)
+        return faiss_index, checkpointer, None
+
+    return faiss_index, checkpointer, recover()
@@ -0,0 +1,144 @@
+"""Named collections of vectors with their own index, loaded on first use and evicted when cold"""
+__author__ = "Vitali Muladze"
+
+import contextlib
+import threading
+from collections import OrderedDict, namedtuple
+
+from models.cpu_scheduler import CpuScheduler
+from models.faiss_database import FaissIndex
+from source.configuration import messages
+
+# Settings of a collection read from its config section
+CollectionSpec = namedtuple('CollectionSpec', ['name', 'dimension', 'index_factory', 'index_path',
+                                               'tombstones', 'vectors_path', 'rerank_factor'])
+
+
+class CollectionRegistry:
+    def __init__(self, specs: dict, memory_budget_bytes: int, cpu_scheduler: CpuScheduler or None = None):
+        """
+        Indexes of named collections kept in memory while their estimated size fits the budget,
+        the least recently used unused ones are written to disk and dropped when it is exceeded
+        :param specs: collection specs by name
+        :param memory_budget_bytes: memory of loaded collections, 0 keeps every used collection loaded
+        :param cpu_scheduler: threads of faiss calls shared with the default index
+        """
+        self.specs = specs
+        self.memory_budget_bytes = memory_budget_bytes
+        self.cpu_scheduler = cpu_scheduler
+        self.loads = 0
+        self.evictions = 0
+        # Loaded indexes from the least to the most recently used
+        self._indexes = OrderedDict()
+        # Requests using every loaded collection, used collections are not evicted
+        self._users = {}
+        self._lock = threading.Lock()
+        # A collection is read once even if concurrent requests need it
+        self._loading_locks = {name: threading.Lock() for name in specs}
+
+    def __len__(self):
+        """Get number of loaded collections"""
+        return len(self._indexes)
+
+    @property
+    def memory_bytes(self) -> int:
+        """Get estimated memory of loaded collections"""
+        with self._lock:
+            indexes = list(self._indexes.values())
+
+        return sum(index.memory_bytes for index in indexes)
+
+    @contextlib.contextmanager
+    def use(self, name: str):
+        """
+        Get the index of a collection, loading it if needed, it stays loaded until the block ends
+        :param name: collection name
+        :return: context manager of the index or error status if the collection is unknown
+        """
+        if name not in self.specs:
+            yield messages.UNKNOWN_COLLECTION
+            return
+        index = self._acquire(name)
+        try:
+            yield index
+        finally:
+            with self._lock:
+                self._users[name] -= 1
+            self.evict_cold()
+
+    def _acquire(self, name: str) -> FaissIndex:
+        """Mark a collection as used and most recent, load it if it is not in memory"""
+        with self._lock:
+            index = self._indexes.get(name)
+            if index is not None:
+                self._users[name] += 1
+                self._indexes.move_to_end(name)
+                return index
+        with self._loading_locks[name]:
+            with self._lock:
+                index = self._indexes.get(name)
+                if index is not None:
+                    self._users[name] += 1
+                    self._indexes.move_to_end(name)
+                    return index
+            spec = self.specs[name]
+            # Other collections are served while this one is read
+            index = FaissIndex(spec.index_path, spec.dimension, spec.index_factory, spec.tombstones,
+                               vectors_path=spec.vectors_path, rerank_factor=spec.rerank_factor)
+            index.cpu_scheduler = self.cpu_scheduler
+            with self._lock:
+                self._indexes[name] = index
+                self._users[name] = 1
+                self.loads += 1
+
+        return index
+
+    def evict_cold(self) -> list:
+        """
+        Write and drop the least recently used collections nobody uses until the rest fits the budget
+        :return: names of evicted collections
+        """
+        if self.memory_budget_bytes <= 0:
+            return []
+        evicted = []
+        while self.memory_bytes > self.memory_budget_bytes:
+            with self._lock:
+                name = next((name for name in self._indexes if not self._users[name]), None)
+                if name is None:
+                    # Every loaded collection serves a request, the budget is exceeded until they end
+                    break
+                index = self._indexes.pop(name)
+                del self._users[name]
+            # Requests which need it again wait until its file is complete
+            with self._loading_locks[name]:
+                self._flush(name, index)
+            self.evictions += 1
+            evicted.append(name)
+
+        return evicted
+
+    def _flush(self, name: str, index: FaissIndex) -> None:
+        """Write the index of a collection and close its vector store"""
+        index.to_disk(self.specs[name].index_path)
+        if index.vector_store is not None:
+            index.vector_store.close()
+
+    def status(self) -> list:
+        """Get settings and loading state of every collection"""
+        with self._lock:
+            loaded = dict(self._indexes)
+
+        return [{"name": name, "dimension": spec.dimension, "index_factory": spec.index_factory,
+                 "loaded": name in loaded,
+                 "vectors": len(loaded[name]) if name in loaded else None,
+                 "memory_bytes": loaded[name].memory_bytes if name in loaded else None}
+                for name, spec in self.specs.items()]
+
+    def close(self) -> None:
+        """Write every loaded collection to disk on process termination"""
+        with self._lock:
+            indexes = list(self._indexes.items())
+            self._indexes.clear()
+            self._users.clear()
+        for name, index in indexes:
+            self._flush(name, index)
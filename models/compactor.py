@@ -0,0 +1,32 @@
+"""Background compaction of dead vectors left by tombstoned updates and deletions"""
+__author__ = "Vitali Muladze"
+
+import threading
+import time
+
+from models.faiss_database import FaissIndex
+
+
+class Compactor:
+    def __init__(self, faiss_index: FaissIndex, dead_ratio: float = 0.2, interval: float = 10):
+        """
+        Remove dead vectors in background once enough of the index is dead
+        :param faiss_index: index with tombstones
+        :param dead_ratio: share of dead stored vectors which triggers compaction
+        :param interval: seconds between checks of the dead share
+        """
+        self.faiss_index = faiss_index
+        self.dead_ratio = dead_ratio
+        self.interval = interval
+        self.compactions = 0
+
+    def start(self) -> None:
+        """Start checking the index in background"""
+        threading.Thread(target=self._compact_periodically, name='Compactor', daemon=True).start()
+
+    def _compact_periodically(self) -> None:
+        """Compact the index whenever the dead share crossed the threshold"""
+        while True:
+            time.sleep(self.interval)
+            if self.faiss_index.compact(self.dead_ratio):
+                self.compactions += 1
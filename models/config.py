@@ -27,6 +27,21 @@ class Application:
     SQLALCHEMY_ECHO = True if config["APPLICATION"]["SQLALCHEMY_ECHO"] is "true" else False
     SQLALCHEMY_DATABASE_URI = OracleDatabase().get_connection_string()
     WTF_CSRF_SECRET_KEY = "SecretBogGe"
+    # Verified tokens are trusted for TOKEN_CACHE_TTL seconds without a database query
+    TOKEN_CACHE_SIZE = config["APPLICATION"].getint("TOKEN_CACHE_SIZE", fallback=10000)
+    TOKEN_CACHE_TTL = config["APPLICATION"].getfloat("TOKEN_CACHE_TTL", fallback=60)
+    # Report latency of request stages in the Server-Timing response header
+    SERVER_TIMING = config["APPLICATION"].getboolean("SERVER_TIMING", fallback=True)
+    # Usernames allowed to run administrative operations like rebuilding the index, comma separated
+    ADMIN_USERS = [username.strip() for username in config["APPLICATION"].get("ADMIN_USERS", fallback="").split(",")
+                   if username.strip()]
+    # Registered users may use the service at once, otherwise an administrator activates them with /activate
+    ACTIVATE_USERS = config["APPLICATION"].getboolean("ACTIVATE_USERS", fallback=True)
+    # Threads of the asyncio server running index and database calls, requests beyond
+    # ASYNC_MAX_PENDING waiting or running calls are refused with 503
+    ASYNC_THREADS = config["APPLICATION"].getint("ASYNC_THREADS", fallback=os.cpu_count() or 1)
+    ASYNC_MAX_PENDING = config["APPLICATION"].getint("ASYNC_MAX_PENDING", fallback=1024)
+    ASYNC_MAX_BODY_MB = config["APPLICATION"].getfloat("ASYNC_MAX_BODY_MB", fallback=100)
 
     @staticmethod
     def init_app(app):
@@ -45,6 +60,11 @@ class Files:
     log_file_error = config["LOGGER"]["LOG_FILE_ERROR"]
     index_path = config["FILES"]["FAISS_INDEX_PATH"]
     backup_index_path = config["FILES"]["BACKUP_INDEX_PATH"]
+    wal_path = config["FILES"].get("WAL_PATH", fallback="media/index/wal")
+    checkpoint_path = config["FILES"].get("CHECKPOINT_PATH", fallback="media/index/faiss.checkpoint")
+    bulk_progress_path = config["FILES"].get("BULK_PROGRESS_PATH", fallback="media/index/bulk_ingest.json")
+    vectors_path = config["FILES"].get("VECTORS_PATH", fallback="media/index/faiss.vectors")
+    key_store_path = config["FILES"].get("KEY_STORE_PATH", fallback="media/index/faiss.keys")
 
 
 class MailConfiguration:
@@ -55,5 +75,88 @@ class MailConfiguration:
     send_mail_to = config["LOGGER"]["SEND_MAIL_TO"]
 
 
+class LoggerConfiguration:
+    """Configuration class for the background log writer"""
+    # Records logged while the queue is full are dropped and counted
+    queue_size = config["LOGGER"].getint("QUEUE_SIZE", fallback=10000)
+    batch_size = config["LOGGER"].getint("BATCH_SIZE", fallback=256)
+    # Share of info records which are written, warnings and errors are always written
+    info_sample_rate = config["LOGGER"].getfloat("INFO_SAMPLE_RATE", fallback=1.0)
+    # Errors are mailed together at most once per interval
+    mail_interval = config["LOGGER"].getfloat("MAIL_INTERVAL_S", fallback=300)
+
+
 class FaissConfiguration:
+    """Configuration class for faiss index"""
     dimension = int(config["FAISS_DATABASE"]["INDEX_DIMENSION"])
+    # Faiss factory string of a new index e.g. IVF4096,PQ64 or OPQ64,IVF4096,PQ64 or HNSW32
+    index_factory = config["FAISS_DATABASE"].get("INDEX_FACTORY", fallback="IDMap,Flat")
+    # Number of vectors sampled for training
+    train_size = config["FAISS_DATABASE"].getint("TRAIN_SIZE", fallback=100000)
+    # Number of vectors added at once by bulk ingestion
+    bulk_chunk_size = config["FAISS_DATABASE"].getint("BULK_CHUNK_SIZE", fallback=10000)
+    # Largest number of results of one search query
+    max_results = config["FAISS_DATABASE"].getint("MAX_RESULTS", fallback=1000)
+    # Window of cross-request search batching, 0 disables batching
+    batch_max_wait_ms = config["FAISS_DATABASE"].getfloat("BATCH_MAX_WAIT_MS", fallback=0)
+    batch_max_size = config["FAISS_DATABASE"].getint("BATCH_MAX_SIZE", fallback=256)
+    # Memory cap of cached search results, 0 disables the cache
+    result_cache_mb = config["FAISS_DATABASE"].getfloat("RESULT_CACHE_MB", fallback=0)
+    # One memory mapped index for all workers, mutated by the index writer process
+    shared_index = config["FAISS_DATABASE"].getboolean("SHARED_INDEX", fallback=False)
+    writer_address = config["FAISS_DATABASE"].get("WRITER_ADDRESS", fallback="media/index/writer.sock")
+    publish_interval = config["FAISS_DATABASE"].getfloat("PUBLISH_INTERVAL_S", fallback=1.0)
+    # Vectors split by image id across shards searched in parallel, 1 keeps a single index
+    n_shards = config["FAISS_DATABASE"].getint("N_SHARDS", fallback=1)
+    shard_processes = config["FAISS_DATABASE"].getboolean("SHARD_PROCESSES", fallback=False)
+    # Write-ahead log of mutations with background checkpoints instead of writing at exit
+    wal = config["FAISS_DATABASE"].getboolean("WAL", fallback=False)
+    wal_fsync = config["FAISS_DATABASE"].get("WAL_FSYNC", fallback="interval")
+    wal_fsync_interval_ms = config["FAISS_DATABASE"].getfloat("WAL_FSYNC_INTERVAL_MS", fallback=100)
+    checkpoint_interval = config["FAISS_DATABASE"].getfloat("CHECKPOINT_INTERVAL_S", fallback=300)
+    # Mask removed and overwritten vectors in searches and remove them in background compaction
+    tombstones = config["FAISS_DATABASE"].getboolean("TOMBSTONES", fallback=False)
+    compaction_dead_ratio = config["FAISS_DATABASE"].getfloat("COMPACTION_DEAD_RATIO", fallback=0.2)
+    compaction_interval = config["FAISS_DATABASE"].getfloat("COMPACTION_INTERVAL_S", fallback=10)
+    # Serve health and login requests while the index file is read in background
+    background_loading = config["FAISS_DATABASE"].getboolean("BACKGROUND_LOADING", fallback=False)
+    # Full precision vectors on disk re-rank candidates of compressed codes e.g. SQfp16, SQ8 or PQ64
+    rerank = config["FAISS_DATABASE"].getboolean("RERANK", fallback=False)
+    rerank_factor = config["FAISS_DATABASE"].getint("RERANK_FACTOR", fallback=4)
+    # String keys and fixed-size payloads of image ids joined into search results
+    key_store = config["FAISS_DATABASE"].getboolean("KEY_STORE", fallback=False)
+    key_size = config["FAISS_DATABASE"].getint("KEY_SIZE", fallback=64)
+    payload_size = config["FAISS_DATABASE"].getint("PAYLOAD_SIZE", fallback=0)
+    # Cores of the host split between the worker processes which choose faiss threads within their share
+    cpu_cores = config["FAISS_DATABASE"].getint("CPU_CORES", fallback=len(os.sched_getaffinity(0)))
+    workers = config["FAISS_DATABASE"].getint("WORKERS", fallback=1)
+    pin_cpus = config["FAISS_DATABASE"].getboolean("PIN_CPUS", fallback=False)
+    adaptive_threads = config["FAISS_DATABASE"].getboolean("ADAPTIVE_THREADS", fallback=True)
+    # Writes streamed from the primary listening on REPLICATION_ADDRESS to replicas with PRIMARY_ADDRESS
+    replication_address = config["FAISS_DATABASE"].get("REPLICATION_ADDRESS", fallback="")
+    primary_address = config["FAISS_DATABASE"].get("PRIMARY_ADDRESS", fallback="")
+    replication_backlog_mb = config["FAISS_DATABASE"].getfloat("REPLICATION_BACKLOG_MB", fallback=256)
+
+
+class CollectionsConfiguration:
+    """Configuration class for named collections, one [COLLECTION <name>] section each"""
+    # Estimated memory of loaded collections, least recently used ones are evicted beyond it, 0 keeps all
+    memory_budget_mb = config["FAISS_DATABASE"].getfloat("COLLECTIONS_MEMORY_MB", fallback=0)
+
+    def __init__(self):
+        self.collections = {}
+        for section in config.sections():
+            if not section.startswith("COLLECTION "):
+                continue
+            name = section[len("COLLECTION "):].strip()
+            index_path = config[section].get("FAISS_INDEX_PATH",
+                                             fallback=os.path.join(Files.media_path, "index", f"{name}.index"))
+            self.collections[name] = {
+                "name": name,
+                "dimension": config[section].getint("INDEX_DIMENSION"),
+                "index_factory": config[section].get("INDEX_FACTORY", fallback="IDMap,Flat"),
+                "index_path": index_path,
+                "tombstones": config[section].getboolean("TOMBSTONES", fallback=False),
+                "vectors_path": config[section].get("VECTORS_PATH", fallback=f"{index_path}.vectors")
+                if config[section].getboolean("RERANK", fallback=False) else None,
+                "rerank_factor": config[section].getint("RERANK_FACTOR", fallback=4)}
@@ -0,0 +1,89 @@
+"""Threads of faiss calls chosen from the cores of the worker process"""
+__author__ = "Vitali Muladze"
+
+import contextlib
+import fcntl
+import os
+import threading
+
+import faiss
+
+# Distance computations of a flat scan worth one more thread, smaller calls don't gain from threads
+MIN_WORK_PER_THREAD = 2 ** 24
+
+
+def claim_cores(n_cores: int, n_workers: int, slots_folder: str) -> list or None:
+    """
+    Pin this process to its share of the cores, workers take the first free slot
+    :param n_cores: cores of the host given to all workers
+    :param n_workers: worker processes sharing the cores
+    :param slots_folder: folder of the slot lock files, a slot is freed when its process exits
+    :return: pinned cores or None if every slot is taken
+    """
+    available_cores = sorted(os.sched_getaffinity(0))[:n_cores]
+    cores_per_worker = max(1, len(available_cores) // n_workers)
+    os.makedirs(slots_folder, exist_ok=True)
+    for slot in range(n_workers):
+        slot_file = open(os.path.join(slots_folder, f"cpu_slot.{slot}"), 'w')
+        try:
+            fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            slot_file.close()
+            continue
+        # The lock is held until the process exits
+        claim_cores.slot_file = slot_file
+        cores = available_cores[slot * cores_per_worker:(slot + 1) * cores_per_worker] or available_cores
+        # Threads started later, e.g. of OpenMP, inherit the affinity
+        os.sched_setaffinity(0, cores)
+        return cores
+
+    return None
+
+
+class CpuScheduler:
+    def __init__(self, max_threads: int, adaptive: bool = True, pinned_cores: list or None = None):
+        """
+        Choose the OpenMP threads of every faiss call of this process within its share of the cores,
+        concurrent calls split the share and small calls run on fewer threads
+        :param max_threads: threads of this worker process
+        :param adaptive: choose threads by the size of the call instead of always using the share
+        :param pinned_cores: cores this process is pinned to, None if it is not pinned
+        """
+        self.max_threads = max(1, max_threads)
+        self.adaptive = adaptive
+        self.pinned_cores = pinned_cores
+        # Calls running in faiss
+        self.active = 0
+        # Threads of the last call and number of calls by operation and threads
+        self.last_threads = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def threads(self, operation: str, n_queries: int, n_vectors: int, dimension: int):
+        """
+        Set the OpenMP threads of faiss calls of the current thread for the block
+        :param operation: name of the call e.g. search or insert
+        :param n_queries: number of query or added vectors
+        :param n_vectors: number of vectors in the index
+        :param dimension: dimension of vector
+        :return: context manager of the chosen number of threads
+        """
+        with self._lock:
+            self.active += 1
+            share = max(1, self.max_threads // self.active)
+        n_threads = share
+        if self.adaptive:
+            # Faiss splits work over queries, more threads than queries stay idle
+            work = max(n_queries, 1) * max(n_vectors, 1) * dimension
+            n_threads = int(min(share, max(n_queries, 1), max(1, work // MIN_WORK_PER_THREAD)))
+        # Threads of OpenMP are set per calling thread
+        faiss.omp_set_num_threads(n_threads)
+        with self._lock:
+            self.last_threads[operation] = n_threads
+            self.calls[(operation, n_threads)] = self.calls.get((operation, n_threads), 0) + 1
+        try:
+            yield n_threads
+        finally:
+            with self._lock:
+                self.active -= 1
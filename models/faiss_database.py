@@ -1,131 +1,1133 @@
 """Faiss index class for creating/loading and using the database"""
 __author__ = "Vitali Muladze"
 
+import contextlib
 import os
 
 import faiss
 import numpy
 from faiss import IDSelectorBatch
 
+from models.index_loader import IndexLoader
+from models.position_map import PositionMap
+from models.read_write_lock import ReadWriteLock
+from models.vector_store import VectorStore
+from models.write_ahead_log import INSERT, REMOVE, TRAIN, UPDATE
 from source.configuration import messages
 
+# Indexes which can't skip dead vectors while scanning fetch at most this many candidates per requested result
+MAX_OVERFETCH = 16
+
+
+def with_ids(index_factory: str) -> str:
+    """
+    Make a factory string whose index accepts image ids,
+    IVF indexes store ids themselves and the others are wrapped with IDMap
+    :param index_factory: faiss factory string e.g. 'IVF4096,PQ64' or 'HNSW32'
+    :return: factory string
+    """
+    if index_factory.startswith('IDMap') or 'IVF' in index_factory:
+        return index_factory
+
+    return f"IDMap,{index_factory}"
+
+
+def valid_n_results(n_results, max_results: int or None = None) -> bool:
+    """
+    Check a requested number of results
+    :param n_results: number of results
+    :param max_results: largest allowed number of results, None for no limit
+    :return: True if it is a positive integer within the limit
+    """
+    return isinstance(n_results, (int, numpy.integer)) and not isinstance(n_results, bool) and n_results > 0 and \
+        (max_results is None or n_results <= max_results)
+
+
+def sort_ranges(lims: numpy.ndarray, indices: numpy.ndarray, distances: numpy.ndarray,
+                metric_type: int) -> tuple:
+    """
+    Sort range search results of every query from the closest
+    :param lims: results of query i are at lims[i]:lims[i + 1]
+    :param indices: image ids of all results
+    :param distances: distances of all results
+    :param metric_type: faiss metric, larger inner products are closer
+    :return: lims, indices and distances
+    """
+    # Faiss gives size_t offsets
+    lims = lims.astype(numpy.int64)
+    query_numbers = numpy.repeat(numpy.arange(lims.shape[0] - 1), numpy.diff(lims))
+    sort_keys = -distances if metric_type == faiss.METRIC_INNER_PRODUCT else distances
+    order = numpy.lexsort((sort_keys, query_numbers))
+
+    return lims, indices[order], distances[order]
+
 
 class FaissIndex:
-    def __init__(self, index_path: str = None, dimension: int = 2048):
+    def __init__(self, index_path: str = None, dimension: int = 2048,
+                 index_factory: str = 'IDMap,Flat', tombstones: bool = False,
+                 load_in_background: bool = False, vectors_path: str = None, rerank_factor: int = 4):
         """
         Initialize the the faiss database
         :param index_path: Path to the index file,
         :param dimension: Dimension of vector
+        :param index_factory: faiss factory string of a new index
+        :param tombstones: mask removed and overwritten vectors instead of removing them at once
+        :param load_in_background: return at once and read the index file in a thread,
+                                   the index is empty until loader.ready is set
+        :param vectors_path: file of full precision vectors which re-rank results of compressed indexes
+        :param rerank_factor: candidates searched in the index per requested result before re-ranking
         :return: None
         """
+        load_index = index_path is not None and os.path.isfile(index_path)
         # Check if the file is faiss index
-        if index_path is not None and os.path.isfile(index_path):
+        if load_index and not load_in_background:
             self.index = faiss.read_index(index_path)
         # Create new index
         else:
             self.index: IDSelectorBatch = faiss.index_factory(dimension,
-                                                              'IDMap,Flat')
+                                                              with_ids(index_factory))
         self.dimension = dimension
+        # Searches share the lock, mutations take it exclusively and are logged
+        # if a write-ahead log is attached
+        self.lock = ReadWriteLock()
+        self.wal = None
+        # Bumped after every change of the index, e.g. to invalidate cached results
+        self.generation = 0
+        # One bit per stored position, set for dead vectors
+        self.dead_bitmap = numpy.zeros(0, dtype=numpy.uint8)
+        self.dead_count = 0
+        self._tombstones_requested = tombstones
+        # Dead vectors stay in place and are masked in searches until compaction
+        self.tombstones = tombstones
+        self.removable = True
+        self._check_removal()
+        # Indexes like PQ can't skip dead vectors while scanning, they over-fetch instead
+        self._selector_search = True
+        # Next automatic image id, found from the stored ids on first use
+        self._next_id = None
+        # Compressed codes are scanned in memory, candidates are re-ranked with exact vectors from disk,
+        # only IDMap indexes tell stored positions apart from image ids
+        self.vector_store = VectorStore(vectors_path, dimension) if vectors_path is not None else None
+        self.rerank_factor = max(int(rerank_factor), 1)
+        # Row of the vector store of every stored position, None without re-ranking
+        self._store_rows = None
+        # First row of the vector store compared with replayed writes, None once replay appends
+        self._replay_row = None
+        self._align_vector_store()
+        # String keys and payloads of image ids which also allocates automatic ids, None without keys
+        self.key_store = None
+        # Chooses OpenMP threads of faiss calls within the cores of the worker, None keeps the faiss default
+        self.cpu_scheduler = None
+        # Functions called with every applied write and the lock held, e.g. to replay it into a rebuilt index
+        self.mutation_listeners = []
+        # Stored positions of image ids, built on first use and dropped once positions move
+        self._id_positions = None
+        # Progress of loading the index, ready at once unless it is loaded in background
+        self.loader = IndexLoader()
+        if load_index and load_in_background:
+            self.loader.start(self.load, index_path)
 
     def __len__(self):
-        """Get number of vectors in the database"""
-        return self.index.ntotal
+        """Get number of live vectors in the database"""
+        return self.index.ntotal - self.dead_count
 
-    def insert(self, features_vectors: list, image_ids: list or None = None,
-               is_updating: bool = False) -> str:
+    def load(self, index_path: str) -> None:
         """
-        Insert features vectors with batches
-        :param is_updating: If the insertion is due to update an index
-        :param features_vectors: features vectors
-        :param image_ids: image ids
-        :return: status of insertion
+        Read an index file counting loaded bytes and replace the index with it
+        :param index_path: Path to the index file
         """
-        # If image_id is not specified
-        if image_ids is None:
-            image_ids = list(range(self.index.ntotal,
-                                   self.index.ntotal + len(features_vectors)))
+        with open(index_path, 'rb') as index_file:
+            index = self.loader.read_index(index_file, os.path.getsize(index_path))
+        self.replace_index(index)
 
-        # Check that for each vector there is an image id
-        if len(image_ids) != len(features_vectors):
-            return messages.DIMENSION_MISMATCH
+    def replace_index(self, index: faiss.Index) -> None:
+        """
+        Swap in a loaded index, searches see either the old or the new one
+        :param index: faiss index
+        """
+        with self.lock:
+            self.index = index
+            self.dead_bitmap = numpy.zeros(0, dtype=numpy.uint8)
+            self.dead_count = 0
+            self._id_positions = None
+            self._check_removal()
+            self._selector_search = True
+            self._next_id = None
+            self._align_vector_store()
+            self.generation += 1
 
-        # Check if image_id is bigger then index length
-        for image_id in image_ids:
-            if not is_updating and image_id < self.index.ntotal:
-                return messages.SMALLER_LENGTH_ERROR
+    def _check_removal(self) -> None:
+        """
+        Find out if vectors can be removed from the index, e.g. HNSW can't remove them and keeps tombstones
+        instead, updates and deletions are refused if neither works so the log never holds a failing write
+        """
+        with self.lock:
+            try:
+                self.index.remove_ids(self._removal_selector(numpy.empty(0, dtype=numpy.int64)))
+                self.removable = True
+            except RuntimeError:
+                self.removable = False
+            # Only IDMap indexes tell stored positions apart from image ids, dead vectors stay masked
+            self.tombstones = isinstance(faiss.downcast_index(self.index), faiss.IndexIDMap) and \
+                (self._tombstones_requested or not self.removable or self.dead_count > 0)
+
+    def _removal_selector(self, id_array: numpy.ndarray) -> faiss.IDSelector:
+        """
+        Select image ids to remove, inverted lists with a hashtable direct map only remove listed ids
+        :param id_array: int64 image ids, kept alive by the caller while the selector is used
+        :return: faiss id selector
+        """
+        ivf_index = self.ivf_index()
+        if ivf_index is not None and ivf_index.direct_map.type == faiss.DirectMap.Hashtable:
+            return faiss.IDSelectorArray(id_array.shape[0], faiss.swig_ptr(id_array))
+
+        return IDSelectorBatch(id_array.shape[0], faiss.swig_ptr(id_array))
+
+    def _align_vector_store(self, chunk_size: int = 65536) -> None:
+        """
+        Find the latest row of the vector store of every stored position, the caller holds the lock,
+        vectors missing from the store e.g. of an index built without it are decoded from the index
+        :param chunk_size: number of missing vectors decoded at once
+        """
+        index = faiss.downcast_index(self.index)
+        if self.vector_store is None or not isinstance(index, faiss.IndexIDMap):
+            self._store_rows = None
+            return
+        position_ids = self._position_ids(index)
+        store_rows = numpy.full(position_ids.shape[0], -1, dtype=numpy.int64)
+        row_ids = self.vector_store.row_ids()
+        if row_ids.shape[0] and position_ids.shape[0]:
+            # First of the reversed rows is the latest row of an id
+            unique_ids, reversed_rows = numpy.unique(row_ids[::-1], return_index=True)
+            places = numpy.minimum(numpy.searchsorted(unique_ids, position_ids), unique_ids.shape[0] - 1)
+            found = unique_ids[places] == position_ids
+            store_rows[found] = row_ids.shape[0] - 1 - reversed_rows[places[found]]
+        inner_index = faiss.downcast_index(index.index)
+        missing_positions = numpy.flatnonzero(store_rows < 0)
+        for start in range(0, missing_positions.shape[0], chunk_size):
+            chunk_positions = missing_positions[start:start + chunk_size]
+            store_rows[chunk_positions] = self.vector_store.append(
+                position_ids[chunk_positions], inner_index.reconstruct_batch(chunk_positions))
+        self._store_rows = store_rows
+
+    def replay_vector_store(self, first_row: int or None) -> None:
+        """
+        Use rows of the vector store written before a restart for replayed writes again instead of appending them
+        :param first_row: rows of the store at the checkpoint the log is replayed on, None once replay is done
+        """
+        with self.lock:
+            self._replay_row = first_row
+
+    def _store_vectors(self, id_array: numpy.ndarray, vector_array: numpy.ndarray) -> numpy.ndarray:
+        """
+        Write vectors to the vector store, the caller holds the lock
+        :param id_array: int64 image ids
+        :param vector_array: float32 features vectors
+        :return: int64 rows of the vectors
+        """
+        # Replayed writes were appended in the same order before the restart
+        if self._replay_row is not None and self.vector_store.holds(self._replay_row, id_array, vector_array):
+            rows = numpy.arange(self._replay_row, self._replay_row + id_array.shape[0], dtype=numpy.int64)
+            self._replay_row += id_array.shape[0]
+            return rows
+        # Rows after a mismatch belong to other writes, e.g. the store was rewritten after the checkpoint
+        self._replay_row = None
+
+        return self.vector_store.append(id_array, vector_array)
+
+    def refresh(self) -> None:
+        """Pick up changes made by other processes, own index has none"""
+
+    @property
+    def is_trained(self) -> bool:
+        """Check if the index can take vectors, IVF and PQ indexes must be trained first"""
+        return self.index.is_trained
 
+    @property
+    def metric_type(self) -> int:
+        """Get the faiss metric, smaller L2 distances and larger inner products are closer"""
+        return self.index.metric_type
+
+    def train(self, features_vectors: list or numpy.ndarray) -> int or str:
+        """
+        Train the index on sample vectors
+        :param features_vectors: training sample as lists or float32 matrix
+        :return: number of training vectors or error status
+        """
+        # Writes go to the loaded index, not to its empty placeholder
+        if not self.loader.ready.is_set():
+            return messages.WARMING_UP
         # Check that vector dimension is same as index dimension
-        for features_vector in features_vectors:
-            if len(features_vector) != self.dimension:
-                return messages.DIMENSION_ERROR
-        # Write the image_id = 17 as [17] of type numpy array
-        id_array = numpy.array(image_ids, dtype=numpy.int64)
-        # Write the vector array [0.2, 0.12] as [[0.2, 0.12]] of type numpy array
-        vector_array = numpy.array(features_vectors).astype('float32')
-        # Insert values into the index
-        self.index.add_with_ids(vector_array, id_array)
+        vector_array = self.to_vector_array(features_vectors)
+        if isinstance(vector_array, str):
+            return vector_array
+        # Ids are not used for training, log stores one per vector
+        id_array = numpy.full(vector_array.shape[0], -1, dtype=numpy.int64)
+        with self.lock:
+            # Trained index with vectors can not change its quantizers
+            if self.index.ntotal:
+                return messages.INDEX_NOT_EMPTY
+            lsn = self.wal.append(TRAIN, id_array, vector_array) if self.wal else None
+            with self._parallelism('train', vector_array.shape[0]):
+                self.apply_log_record(TRAIN, id_array, vector_array)
+        if lsn:
+            self.wal.commit(lsn)
 
-        return image_ids
+        return vector_array.shape[0]
 
-    def update(self, features_vectors: list, image_ids: list) -> str:
+    def insert(self, features_vectors: list or numpy.ndarray,
+               image_ids: list or numpy.ndarray or None = None,
+               is_updating: bool = False, keys: list or None = None,
+               payloads: list or None = None) -> list or str:
+        """
+        Insert features vectors with batches
+        :param is_updating: If the insertion is due to update an index
+        :param features_vectors: features vectors as lists or float32 matrix
+        :param image_ids: image ids as list or int64 array
+        :param keys: new string keys of the vectors instead of image ids, needs the key store
+        :param payloads: payloads of the vectors stored with automatic ids, needs the key store
+        :return: inserted image ids or status of insertion
+        """
+        # Writes go to the loaded index, not to its empty placeholder
+        if not self.loader.ready.is_set():
+            return messages.WARMING_UP
+        # Check that vector dimension is same as index dimension
+        vector_array = self.to_vector_array(features_vectors)
+        if isinstance(vector_array, str):
+            return vector_array
+        if (keys is not None or payloads is not None) and self.key_store is None:
+            return messages.KEY_STORE_DISABLED
+        if (keys is not None or payloads is not None) and image_ids is not None:
+            return messages.KEYS_WITH_IDS
+        with self.lock:
+            if not self.index.is_trained:
+                return messages.INDEX_NOT_TRAINED
+            # Ids of the key store are never reused, also after removals and restarts
+            if image_ids is None and self.key_store is not None:
+                image_ids = self.key_store.allocate(vector_array.shape[0], keys, payloads, self.next_free_id())
+                if isinstance(image_ids, str):
+                    return image_ids
+            # If image_id is not specified
+            if image_ids is None:
+                next_id = self.next_free_id()
+                image_ids = numpy.arange(next_id, next_id + vector_array.shape[0])
+            # Write the image_id = 17 as [17] of type numpy array
+            id_array = numpy.ascontiguousarray(image_ids, dtype=numpy.int64)
+            # Check that for each vector there is an image id
+            if id_array.ndim != 1 or id_array.shape[0] != vector_array.shape[0]:
+                return messages.DIMENSION_MISMATCH
+            # Check if image_id is bigger then index length
+            if not is_updating and (id_array < self.index.ntotal).any():
+                return messages.SMALLER_LENGTH_ERROR
+            if not is_updating and not self._allocated(id_array):
+                return messages.IDS_NOT_ALLOCATED
+            lsn = self.wal.append(INSERT, id_array, vector_array) if self.wal else None
+            # Insert values into the index
+            with self._parallelism('insert', vector_array.shape[0]):
+                self.apply_log_record(INSERT, id_array, vector_array)
+        # Wait for the log outside of the lock so concurrent writes share one fsync
+        if lsn:
+            self.wal.commit(lsn)
+
+        return id_array.tolist()
+
+    def update(self, features_vectors: list or numpy.ndarray,
+               image_ids: list or numpy.ndarray or None = None, keys: list or None = None,
+               payloads: list or None = None) -> list or str:
         """
         Update index ids with new values
         :param image_ids: image id to change the value for
         :param features_vectors: features vector
-        :return: status of update
+        :param keys: stored string keys instead of image ids, needs the key store
+        :param payloads: new payloads of the vectors, needs the key store
+        :return: updated image ids or status of update
         """
+        # Writes go to the loaded index, not to its empty placeholder
+        if not self.loader.ready.is_set():
+            return messages.WARMING_UP
+        if (keys is not None or payloads is not None) and self.key_store is None:
+            return messages.KEY_STORE_DISABLED
+        if keys is not None and image_ids is not None:
+            return messages.KEYS_WITH_IDS
+        if keys is not None:
+            image_ids = self.key_store.lookup(keys)
+            if isinstance(image_ids, str):
+                return image_ids
+            if (image_ids < 0).any():
+                return messages.UNKNOWN_KEYS
         # Check if image IDs specified
         if image_ids is None:
             return messages.NO_IDS_SPECIFIED
 
+        # Check that vector dimension is same as index dimension
+        vector_array = self.to_vector_array(features_vectors)
+        if isinstance(vector_array, str):
+            return vector_array
+        # Write the image_id = 17 as [17] of type numpy array
+        id_array = numpy.ascontiguousarray(image_ids, dtype=numpy.int64)
         # Check that for each vector there is an image id
-        if len(image_ids) != len(features_vectors):
+        if id_array.ndim != 1 or id_array.shape[0] != vector_array.shape[0]:
             return messages.DIMENSION_MISMATCH
+        with self.lock:
+            if not self.index.is_trained:
+                return messages.INDEX_NOT_TRAINED
+            # Checked before logging, a logged write which fails would fail again in every recovery
+            if not self.tombstones and not self.removable:
+                return messages.REMOVE_NOT_SUPPORTED
+            if not self._allocated(id_array):
+                return messages.IDS_NOT_ALLOCATED
+            if payloads is not None:
+                status = self.key_store.set_payloads(id_array, payloads)
+                if status != messages.OK:
+                    return status
+            lsn = self.wal.append(UPDATE, id_array, vector_array) if self.wal else None
+            with self._parallelism('update', vector_array.shape[0]):
+                self.apply_log_record(UPDATE, id_array, vector_array)
+        if lsn:
+            self.wal.commit(lsn)
 
-        # Check that vector dimension is same as index dimension
-        for features_vector in features_vectors:
-            if len(features_vector) != self.dimension:
-                return messages.DIMENSION_ERROR
-        # Write the image_id = 17 as [17] of type numpy array
-        id_array = numpy.array(image_ids, dtype=numpy.int64)
-        # Select the ids from index and remove them
-        id_selector = IDSelectorBatch(id_array.shape[0],
-                                      faiss.swig_ptr(id_array))
-        self.index.remove_ids(id_selector)
-        # Insert new values
-        _status = self.insert(features_vectors, image_ids, is_updating=True)
+        return id_array.tolist()
+
+    def delete(self, image_ids: list or numpy.ndarray or None = None, keys: list or None = None) -> list or str:
+        """
+        Delete vectors of image ids, unknown ids are ignored
+        :param image_ids: image ids as list or int64 array
+        :param keys: stored string keys instead of image ids, unknown keys are ignored
+        :return: deleted image ids or status of deletion
+        """
+        # Writes go to the loaded index, not to its empty placeholder
+        if not self.loader.ready.is_set():
+            return messages.WARMING_UP
+        if keys is not None and self.key_store is None:
+            return messages.KEY_STORE_DISABLED
+        if keys is not None and image_ids is not None:
+            return messages.KEYS_WITH_IDS
+        if keys is not None:
+            image_ids = self.key_store.lookup(keys)
+            if isinstance(image_ids, str):
+                return image_ids
+            image_ids = image_ids[image_ids >= 0]
+        # Check if image IDs specified
+        if image_ids is None:
+            return messages.NO_IDS_SPECIFIED
+        try:
+            id_array = numpy.ascontiguousarray(image_ids, dtype=numpy.int64)
+        except (ValueError, TypeError, OverflowError):
+            return messages.INVALID_IDS
+        if id_array.ndim != 1:
+            return messages.INVALID_IDS
+        with self.lock:
+            if not self.tombstones and not self.removable:
+                return messages.REMOVE_NOT_SUPPORTED
+            lsn = self.wal.append(REMOVE, id_array) if self.wal else None
+            self.apply_log_record(REMOVE, id_array, None)
+            if self.key_store is not None:
+                self.key_store.release(id_array)
+        if lsn:
+            self.wal.commit(lsn)
 
-        return _status
+        return id_array.tolist()
 
-    def search(self, features_vectors: list,
-               n_results: int = 10) -> tuple or str:
+    def _allocated(self, id_array: numpy.ndarray) -> bool:
+        """
+        Check that ids given by a client don't run ahead of the key store, whose record of an id is its row,
+        so an arbitrary large id would grow its file up to that id
+        :param id_array: int64 image ids
+        :return: True without key store or if every id is below the next automatic id
+        """
+        if self.key_store is None or not id_array.shape[0]:
+            return True
+
+        return int(id_array.max()) < max(self.next_free_id(), len(self.key_store))
+
+    def next_free_id(self) -> int:
+        """Get the automatic image id following every stored and removed id"""
+        with self.lock:
+            if self._next_id is None:
+                try:
+                    stored_ids = self.stored_ids()
+                except TypeError:
+                    stored_ids = numpy.empty(0, dtype=numpy.int64)
+                self._next_id = int(stored_ids.max()) + 1 if stored_ids.shape[0] else 0
+
+            return max(self._next_id, self.index.ntotal)
+
+    def apply_log_record(self, operation: int, id_array: numpy.ndarray,
+                         vector_array: numpy.ndarray) -> None:
+        """
+        Apply a validated operation to the index without logging it
+        :param operation: INSERT, UPDATE, REMOVE or TRAIN
+        :param id_array: int64 image ids
+        :param vector_array: float32 features vectors, None for removals
+        """
+        with self.lock:
+            if operation == TRAIN:
+                self.index.train(vector_array)
+            if operation in (UPDATE, REMOVE) and self.tombstones:
+                # Old vectors are only marked, their memory is reclaimed by compaction
+                self._mark_dead(id_array)
+            elif operation in (UPDATE, REMOVE):
+                # Following positions move down, so do their rows of the vector store
+                kept_positions = None
+                if self._store_rows is not None:
+                    kept_positions = ~numpy.isin(self._position_ids(faiss.downcast_index(self.index)), id_array)
+                # Select the ids from index and remove them
+                self.index.remove_ids(self._removal_selector(id_array))
+                self._id_positions = None
+                if kept_positions is not None:
+                    self._store_rows = self._store_rows[kept_positions]
+            if operation in (INSERT, UPDATE):
+                first_position = self.index.ntotal
+                # Insert new values
+                self.index.add_with_ids(vector_array, id_array)
+                if self._id_positions is not None:
+                    self._id_positions.add(id_array, first_position)
+                if self._store_rows is not None:
+                    self._store_rows = numpy.concatenate(
+                        [self._store_rows, self._store_vectors(id_array, vector_array)])
+                # Automatic ids must not reuse ids which are removed later
+                if self._next_id is not None and id_array.shape[0]:
+                    self._next_id = max(self._next_id, int(id_array.max()) + 1)
+            # Readers which saw the old generation must not see it again after the change
+            self.generation += 1
+            for listener in self.mutation_listeners:
+                listener(operation, id_array, vector_array)
+
+    def search(self, features_vectors: list or numpy.ndarray, n_results: int = 10,
+               nprobe: int or None = None, ef_search: int or None = None,
+               allow_ids: list or numpy.ndarray or None = None,
+               deny_ids: list or numpy.ndarray or None = None) -> tuple or str:
         """
         Search similarities for features vectors
-        :param features_vectors: features vectors
+        :param features_vectors: features vectors as lists or float32 matrix
         :param n_results: number of results
+        :param nprobe: number of IVF lists to scan, more is slower with better recall
+        :param ef_search: HNSW candidates queue size, more is slower with better recall
+        :param allow_ids: image ids the results are restricted to
+        :param deny_ids: image ids excluded from the results
         :return: indices of the results and distances sorted increasingly or error status
         """
+        if not valid_n_results(n_results):
+            return messages.INVALID_N_RESULTS
         # Check that vector dimension is same as index dimension
-        for features_vector in features_vectors:
-            if len(features_vector) != self.dimension:
-                return messages.DIMENSION_ERROR
-        # Write the vector array [[0.2, 0.12], [0.98, 0.34]] as [[0.2, 0.12], [0.98, 0.34]] of type numpy array
-        vector_array = numpy.array(features_vectors).astype('float32')
-        # Search for similarities
-        distances, result_indices = self.index.search(vector_array, n_results)
+        vector_array = self.to_vector_array(features_vectors)
+        if isinstance(vector_array, str):
+            return vector_array
+        id_selector = self.id_selector(allow_ids, deny_ids)
+        if isinstance(id_selector, str):
+            return id_selector
+        # Search for similarities, a concurrent update is seen either whole or not at all
+        with self.lock.read(), self._parallelism('search', vector_array.shape[0]):
+            if self._store_rows is not None:
+                return self._search_reranked(vector_array, n_results, nprobe, ef_search, id_selector)
+            if self.dead_count:
+                return self._search_live(vector_array, n_results, nprobe, ef_search, id_selector)
+            try:
+                distances, result_indices = self.index.search(
+                    vector_array, n_results, params=self.search_parameters(nprobe, ef_search, id_selector))
+            except RuntimeError:
+                # Indexes like PQ can't skip ids while scanning
+                if id_selector is None:
+                    raise
+                return messages.FILTER_NOT_SUPPORTED
 
         return result_indices, distances
 
+    def range_search(self, features_vectors: list or numpy.ndarray, radius: float,
+                     nprobe: int or None = None, ef_search: int or None = None,
+                     allow_ids: list or numpy.ndarray or None = None,
+                     deny_ids: list or numpy.ndarray or None = None) -> tuple or str:
+        """
+        Search all vectors within a radius of features vectors
+        :param features_vectors: features vectors as lists or float32 matrix
+        :param radius: L2 distances below or inner products above it are results
+        :param nprobe: number of IVF lists to scan
+        :param ef_search: HNSW candidates queue size
+        :param allow_ids: image ids the results are restricted to
+        :param deny_ids: image ids excluded from the results
+        :return: lims, indices and distances of the results or error status,
+                 results of query i are at lims[i]:lims[i + 1] sorted from the closest
+        """
+        vector_array = self.to_vector_array(features_vectors)
+        if isinstance(vector_array, str):
+            return vector_array
+        try:
+            radius = float(radius)
+        except (ValueError, TypeError):
+            return messages.INVALID_RADIUS
+        id_selector = self.id_selector(allow_ids, deny_ids)
+        if isinstance(id_selector, str):
+            return id_selector
+        with self.lock.read(), self._parallelism('range_search', vector_array.shape[0]):
+            try:
+                if self.dead_count:
+                    index = faiss.downcast_index(self.index)
+                    lims, distances, positions = index.index.range_search(
+                        vector_array, radius,
+                        params=self.search_parameters(nprobe, ef_search, self._live_selector(index, id_selector)))
+                    result_indices = self._to_image_ids(index, positions)
+                else:
+                    lims, distances, result_indices = self.index.range_search(
+                        vector_array, radius, params=self.search_parameters(nprobe, ef_search, id_selector))
+            except RuntimeError:
+                return messages.RANGE_SEARCH_NOT_SUPPORTED
+
+        return sort_ranges(lims, result_indices, distances, self.metric_type)
+
+    def search_by_ids(self, image_ids: list or numpy.ndarray, n_results: int = 10, radius: float or None = None,
+                      **search_knobs) -> tuple or str:
+        """
+        Search similarities of stored vectors, every query excludes its own image id from its results
+        :param image_ids: image ids of the stored query vectors
+        :param n_results: number of results
+        :param radius: search all vectors within the radius instead of the top results
+        :param search_knobs: per-request search parameters e.g. nprobe, ef_search, allow_ids, deny_ids
+        :return: results like search or range_search or error status
+        """
+        if radius is None and not valid_n_results(n_results):
+            return messages.INVALID_N_RESULTS
+        vector_array = self.reconstruct(image_ids)
+        if isinstance(vector_array, str):
+            return vector_array
+        id_array = numpy.ascontiguousarray(image_ids, dtype=numpy.int64)
+        if radius is not None:
+            result_or_status_message = self.range_search(vector_array, radius, **search_knobs)
+            if isinstance(result_or_status_message, str):
+                return result_or_status_message
+            lims, result_indices, distances = result_or_status_message
+            query_numbers = numpy.repeat(numpy.arange(id_array.shape[0]), numpy.diff(lims))
+            keep = result_indices != id_array[query_numbers]
+            lims = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(query_numbers[keep],
+                                                                       minlength=id_array.shape[0]))])
+
+            return lims, result_indices[keep], distances[keep]
+        # One more result replaces the query itself
+        result_or_status_message = self.search(vector_array, n_results=n_results + 1, **search_knobs)
+        if isinstance(result_or_status_message, str):
+            return result_or_status_message
+        result_indices, distances = result_or_status_message
+        keep = result_indices != id_array[:, None]
+        # Approximate searches may miss the query, its last result is dropped instead
+        keep[keep.all(axis=1), -1] = False
+
+        return (result_indices[keep].reshape(id_array.shape[0], n_results),
+                distances[keep].reshape(id_array.shape[0], n_results))
+
+    @staticmethod
+    def id_selector(allow_ids: list or numpy.ndarray or None = None,
+                    deny_ids: list or numpy.ndarray or None = None) -> faiss.IDSelector or str or None:
+        """
+        Make a selector of image ids, faiss skips the other ids while scanning
+        :param allow_ids: image ids the results are restricted to
+        :param deny_ids: image ids excluded from the results
+        :return: selector, None without filters or error status
+        """
+        id_selectors = []
+        for image_ids, allowed in ((allow_ids, True), (deny_ids, False)):
+            if image_ids is None:
+                continue
+            try:
+                id_array = numpy.ascontiguousarray(image_ids, dtype=numpy.int64)
+            except (ValueError, TypeError, OverflowError):
+                return messages.INVALID_IDS
+            if id_array.ndim != 1:
+                return messages.INVALID_IDS
+            # Batch selector keeps its own hash set of the ids
+            id_selector = faiss.IDSelectorBatch(id_array)
+            id_selectors.append(id_selector if allowed else faiss.IDSelectorNot(id_selector))
+        if not id_selectors:
+            return None
+
+        return id_selectors[0] if len(id_selectors) == 1 else faiss.IDSelectorAnd(*id_selectors)
+
+    def _live_selector(self, index: faiss.IndexIDMap,
+                       id_selector: faiss.IDSelector or None = None) -> faiss.IDSelector:
+        """
+        Make a selector of live stored positions, the caller holds the lock
+        :param index: IDMap index
+        :param id_selector: selector of image ids the positions must also pass
+        :return: selector of positions
+        """
+        # The bitmap does not cover positions added after the last deletion, they are live
+        dead_selector = faiss.IDSelectorBitmap(self.dead_bitmap.shape[0], faiss.swig_ptr(self.dead_bitmap))
+        live_selector = faiss.IDSelectorNot(dead_selector)
+        if id_selector is None:
+            return live_selector
+
+        return faiss.IDSelectorAnd(live_selector, faiss.IDSelectorTranslated(index.id_map, id_selector))
+
+    def _search_live(self, vector_array: numpy.ndarray, n_results: int, nprobe: int or None,
+                     ef_search: int or None, id_selector: faiss.IDSelector or None = None) -> tuple or str:
+        """
+        Search the index skipping dead vectors, the caller holds the lock
+        :param vector_array: float32 query matrix
+        :param n_results: number of results
+        :param nprobe: number of IVF lists to scan
+        :param ef_search: HNSW candidates queue size
+        :param id_selector: selector of image ids
+        :return: indices of the results and distances sorted increasingly or error status
+        """
+        result_or_status_message = self._search_positions(vector_array, n_results, nprobe, ef_search, id_selector)
+        if isinstance(result_or_status_message, str):
+            return result_or_status_message
+        positions, distances = result_or_status_message
+
+        return self._to_image_ids(faiss.downcast_index(self.index), positions), distances
+
+    def _search_reranked(self, vector_array: numpy.ndarray, n_results: int, nprobe: int or None,
+                         ef_search: int or None, id_selector: faiss.IDSelector or None = None,
+                         max_chunk_floats: int = 2 ** 22) -> tuple or str:
+        """
+        Search candidates in the compressed index and order them by exact distances
+        to full precision vectors of the vector store, the caller holds the lock
+        :param vector_array: float32 query matrix
+        :param n_results: number of results
+        :param nprobe: number of IVF lists to scan
+        :param ef_search: HNSW candidates queue size
+        :param id_selector: selector of image ids
+        :param max_chunk_floats: size of candidate vectors read at once, queries are re-ranked in chunks
+        :return: indices of the results and distances sorted increasingly or error status
+        """
+        result_or_status_message = self._search_positions(vector_array, n_results * self.rerank_factor,
+                                                          nprobe, ef_search, id_selector)
+        if isinstance(result_or_status_message, str):
+            return result_or_status_message
+        positions = result_or_status_message[0]
+        inner_product = self.metric_type == faiss.METRIC_INNER_PRODUCT
+        missing_distance = -numpy.finfo(numpy.float32).max if inner_product else numpy.finfo(numpy.float32).max
+        distances = numpy.full(positions.shape, missing_distance, dtype=numpy.float32)
+        n_queries = max(max_chunk_floats // max(positions.shape[1] * self.dimension, 1), 1)
+        for start in range(0, positions.shape[0], n_queries):
+            chunk_positions = positions[start:start + n_queries]
+            found = chunk_positions >= 0
+            candidates = numpy.zeros(chunk_positions.shape + (self.dimension,), dtype=numpy.float32)
+            candidates[found] = self.vector_store.read(self._store_rows[chunk_positions[found]])
+            queries = vector_array[start:start + n_queries, numpy.newaxis, :]
+            if inner_product:
+                chunk_distances = numpy.einsum('qkd,qkd->qk', candidates, numpy.broadcast_to(queries, candidates.shape))
+            else:
+                differences = candidates - queries
+                chunk_distances = numpy.einsum('qkd,qkd->qk', differences, differences)
+            distances[start:start + n_queries] = numpy.where(found, chunk_distances, missing_distance)
+        # Missing candidates have the farthest distance and stay behind the found ones
+        order = numpy.argsort(-distances if inner_product else distances, axis=1, kind='stable')[:, :n_results]
+        positions = numpy.take_along_axis(positions, order, axis=1)
+        distances = numpy.take_along_axis(distances, order, axis=1)
+        if positions.shape[1] < n_results:
+            padding = ((0, 0), (0, n_results - positions.shape[1]))
+            positions = numpy.pad(positions, padding, constant_values=-1)
+            distances = numpy.pad(distances, padding, constant_values=missing_distance)
+
+        return self._to_image_ids(faiss.downcast_index(self.index), positions), distances
+
+    def _search_positions(self, vector_array: numpy.ndarray, n_results: int, nprobe: int or None,
+                          ef_search: int or None, id_selector: faiss.IDSelector or None = None) -> tuple or str:
+        """
+        Search stored positions past the IDMap skipping dead vectors, the caller holds the lock
+        :param vector_array: float32 query matrix
+        :param n_results: number of results
+        :param nprobe: number of IVF lists to scan
+        :param ef_search: HNSW candidates queue size
+        :param id_selector: selector of image ids
+        :return: positions of the results and distances sorted increasingly or error status
+        """
+        index = faiss.downcast_index(self.index)
+        if not self.dead_count:
+            position_selector = None if id_selector is None else faiss.IDSelectorTranslated(index.id_map,
+                                                                                              id_selector)
+            try:
+                distances, positions = index.index.search(
+                    vector_array, n_results, params=self.search_parameters(nprobe, ef_search, position_selector))
+            except RuntimeError:
+                if id_selector is None:
+                    raise
+                return messages.FILTER_NOT_SUPPORTED
+            return positions, distances
+        if self._selector_search:
+            try:
+                distances, positions = index.index.search(
+                    vector_array, n_results,
+                    params=self.search_parameters(nprobe, ef_search, self._live_selector(index, id_selector)))
+                return positions, distances
+            except RuntimeError:
+                self._selector_search = False
+        if id_selector is not None:
+            return messages.FILTER_NOT_SUPPORTED
+        missing_distance = numpy.finfo(numpy.float32).max
+        if self.metric_type == faiss.METRIC_INNER_PRODUCT:
+            missing_distance = -missing_distance
+        positions = numpy.full((vector_array.shape[0], n_results), -1, dtype=numpy.int64)
+        distances = numpy.full((vector_array.shape[0], n_results), missing_distance, dtype=numpy.float32)
+        # Dead vectors take their share of the candidates, queries which got too few live ones are searched again
+        n_candidates = min(int(numpy.ceil(n_results * index.ntotal / max(len(self), 1))), index.ntotal)
+        rows = numpy.arange(vector_array.shape[0])
+        while True:
+            candidate_distances, candidates = index.index.search(vector_array[rows], n_candidates,
+                                                                 params=self.search_parameters(nprobe, ef_search))
+            live = candidates >= 0
+            live[live] = ~self._is_dead(candidates[live])
+            # Live results keep their order, dead ones move behind them and become missing results
+            order = numpy.argsort(~live, axis=1, kind='stable')[:, :n_results]
+            positions[rows, :order.shape[1]] = numpy.take_along_axis(numpy.where(live, candidates, -1), order, axis=1)
+            distances[rows, :order.shape[1]] = numpy.take_along_axis(
+                numpy.where(live, candidate_distances, missing_distance), order, axis=1)
+            # Queries whose candidates ran out before n_results got all live results there are
+            short = (live.sum(axis=1) < n_results) & (candidates[:, -1] >= 0)
+            if not short.any() or n_candidates >= index.ntotal:
+                break
+            if n_candidates >= n_results * MAX_OVERFETCH:
+                return messages.TOO_MANY_DEAD
+            rows = rows[short]
+            n_candidates = min(n_candidates * 2, n_results * MAX_OVERFETCH, index.ntotal)
+
+        return positions, distances
+
+    @staticmethod
+    def _position_ids(index: faiss.IndexIDMap) -> numpy.ndarray:
+        """Get image ids by stored position without copying them"""
+        if not index.ntotal:
+            return numpy.empty(0, dtype=numpy.int64)
+
+        return faiss.rev_swig_ptr(index.id_map.data(), index.id_map.size())
+
+    def _to_image_ids(self, index: faiss.IndexIDMap, positions: numpy.ndarray) -> numpy.ndarray:
+        """Translate stored positions of results to image ids, missing results stay -1"""
+        return numpy.where(positions >= 0, self._position_ids(index)[positions], -1)
+
+    def _dead_mask(self, n_total: int) -> numpy.ndarray:
+        """Get a boolean mask of dead stored positions"""
+        dead_mask = numpy.zeros(n_total, dtype=bool)
+        # Positions added after the last deletion are not covered by the bitmap
+        n_covered = min(n_total, self.dead_bitmap.shape[0] * 8)
+        if n_covered:
+            dead_mask[:n_covered] = numpy.unpackbits(self.dead_bitmap, count=n_covered, bitorder='little')
+
+        return dead_mask
+
+    def _is_dead(self, positions: numpy.ndarray) -> numpy.ndarray:
+        """Get a boolean mask of dead positions from their bits of the bitmap"""
+        # The bitmap does not cover positions added after the last deletion, they are live
+        covered = positions < self.dead_bitmap.shape[0] * 8
+        dead = numpy.zeros(positions.shape, dtype=bool)
+        dead[covered] = (self.dead_bitmap[positions[covered] >> 3] >> (positions[covered] & 7)) & 1
+
+        return dead
+
+    def _position_map(self, index: faiss.IndexIDMap) -> PositionMap:
+        """Get the stored positions of image ids, the caller holds the lock"""
+        if self._id_positions is None:
+            self._id_positions = PositionMap(self._position_ids(index).copy())
+
+        return self._id_positions
+
+    def _mark_dead(self, id_array: numpy.ndarray) -> None:
+        """
+        Mark stored vectors of the ids dead, the caller holds the lock
+        :param id_array: int64 image ids
+        """
+        index = faiss.downcast_index(self.index)
+        if not index.ntotal:
+            return
+        _, positions = self._position_map(index).lookup(numpy.unique(id_array))
+        positions = positions[~self._is_dead(positions)]
+        if not positions.shape[0]:
+            return
+        n_bytes = (index.ntotal + 7) // 8
+        if self.dead_bitmap.shape[0] < n_bytes:
+            self.dead_bitmap = numpy.concatenate(
+                [self.dead_bitmap, numpy.zeros(n_bytes - self.dead_bitmap.shape[0], dtype=numpy.uint8)])
+        numpy.bitwise_or.at(self.dead_bitmap, positions >> 3, (1 << (positions & 7)).astype(numpy.uint8))
+        self.dead_count += positions.shape[0]
+
+    def restore_dead_bitmap(self, dead_bitmap: numpy.ndarray) -> None:
+        """
+        Take over dead vectors of a checkpoint written with tombstones
+        :param dead_bitmap: one bit per stored position, set for dead vectors
+        """
+        with self.lock:
+            self.dead_bitmap = dead_bitmap
+            self.dead_count = int(self._dead_mask(self.index.ntotal).sum())
+            # Dead positions stay masked, so removals must keep marking them instead of moving positions
+            self._check_removal()
+
+    @property
+    def dead_ratio(self) -> float:
+        """Get the share of stored vectors which are dead"""
+        return self.dead_count / self.index.ntotal if self.index.ntotal else 0.0
+
+    def compact(self, min_dead_ratio: float = 0.0) -> int:
+        """
+        Remove dead vectors physically, searches wait until the index is rewritten
+        :param min_dead_ratio: compact only if at least this share of stored vectors is dead
+        :return: number of removed vectors
+        """
+        if not self.dead_count or self.dead_ratio < min_dead_ratio:
+            return 0
+        with self.lock:
+            if not self.dead_count:
+                return 0
+            index = faiss.downcast_index(self.index)
+            dead_mask = self._dead_mask(index.ntotal)
+            live_ids = self._position_ids(index)[~dead_mask]
+            inner_index = faiss.downcast_index(index.index)
+            unwrapped_index = inner_index
+            while isinstance(unwrapped_index, faiss.IndexPreTransform):
+                unwrapped_index = faiss.downcast_index(unwrapped_index.index)
+            if isinstance(unwrapped_index, faiss.IndexFlatCodes):
+                # Flat codes shift the following vectors down, in the same order as the ids
+                dead_positions = numpy.flatnonzero(dead_mask).astype(numpy.int64)
+                inner_index.remove_ids(IDSelectorBatch(dead_positions.shape[0], faiss.swig_ptr(dead_positions)))
+            else:
+                # Indexes like HNSW can't remove vectors, the live ones are added to the emptied index
+                live_vectors = inner_index.reconstruct_n(0, index.ntotal)[~dead_mask]
+                inner_index.reset()
+                inner_index.add(live_vectors)
+            faiss.copy_array_to_vector(live_ids, index.id_map)
+            index.ntotal = inner_index.ntotal
+            if self._store_rows is not None:
+                self._store_rows = self._store_rows[~dead_mask]
+            n_removed = self.dead_count
+            self.dead_bitmap = numpy.zeros(0, dtype=numpy.uint8)
+            self.dead_count = 0
+            self._id_positions = None
+
+        return n_removed
+
+    def search_parameters(self, nprobe: int or None = None, ef_search: int or None = None,
+                          id_selector: faiss.IDSelector or None = None) -> faiss.SearchParameters or None:
+        """
+        Make per-request search parameters, knobs which don't apply to the index are ignored
+        :param nprobe: number of IVF lists to scan
+        :param ef_search: HNSW candidates queue size
+        :param id_selector: selector of ids searched
+        :return: faiss search parameters or None for index defaults
+        """
+        if not nprobe and not ef_search and id_selector is None:
+            return None
+        ivf_index = self.ivf_index()
+        hnsw_index = self.hnsw_index()
+        # IVF and HNSW indexes refuse parameters of another type, knobs which are not given keep the index settings
+        if ivf_index is not None:
+            search_parameters = faiss.SearchParametersIVF(nprobe=int(nprobe) if nprobe else ivf_index.nprobe,
+                                                          max_codes=ivf_index.max_codes)
+        elif hnsw_index is not None:
+            search_parameters = faiss.SearchParametersHNSW(
+                efSearch=int(ef_search) if ef_search else hnsw_index.hnsw.efSearch,
+                check_relative_distance=hnsw_index.hnsw.check_relative_distance)
+        elif id_selector is not None:
+            search_parameters = faiss.SearchParameters()
+        else:
+            return None
+        if id_selector is not None:
+            search_parameters.sel = id_selector
+
+        return search_parameters
+
+    def _parallelism(self, operation: str, n_queries: int):
+        """
+        Get context of the OpenMP threads of a faiss call chosen by the cpu scheduler
+        :param operation: name of the call
+        :param n_queries: number of query or added vectors
+        :return: context manager
+        """
+        if self.cpu_scheduler is None:
+            return contextlib.nullcontext()
+
+        return self.cpu_scheduler.threads(operation, n_queries, self.index.ntotal, self.dimension)
+
+    def ivf_index(self) -> faiss.IndexIVF or None:
+        """Get the IVF part of the index if there is any"""
+        try:
+            return faiss.extract_index_ivf(self.index)
+        except RuntimeError:
+            return None
+
+    def hnsw_index(self) -> faiss.IndexHNSW or None:
+        """Get the HNSW part of the index if there is any"""
+        index = faiss.downcast_index(self.index)
+        # Unwrap IDMap and pre-transforms like OPQ
+        while isinstance(index, (faiss.IndexIDMap, faiss.IndexPreTransform)):
+            index = faiss.downcast_index(index.index)
+
+        return index if isinstance(index, faiss.IndexHNSW) else None
+
+    @property
+    def memory_bytes(self) -> int:
+        """Estimate memory taken by the stored vectors from their codes, ids and HNSW links"""
+        hnsw_index = self.hnsw_index()
+        try:
+            code_size = faiss.downcast_index(hnsw_index.storage if hnsw_index is not None
+                                             else self.index).sa_code_size()
+        except RuntimeError:
+            code_size = self.dimension * numpy.dtype(numpy.float32).itemsize
+        # Ids of IDMap and inverted lists take 8 bytes, HNSW links of the base level 4 bytes each
+        vector_size = code_size + numpy.dtype(numpy.int64).itemsize
+        if hnsw_index is not None:
+            vector_size += hnsw_index.hnsw.nb_neighbors(0) * numpy.dtype(numpy.int32).itemsize
+
+        return self.index.ntotal * vector_size
+
+    def iterate_vectors(self, chunk_size: int = 65536):
+        """
+        Read stored vectors with their ids chunk by chunk
+        :param chunk_size: number of vectors in a chunk
+        :return: generator of (int64 image ids, float32 features vectors)
+        """
+        self._add_direct_map()
+        # Writes wait until the vectors are read, searches go on
+        with self.lock.long_read():
+            index = faiss.downcast_index(self.index)
+            id_array = self.stored_ids()
+            if isinstance(index, faiss.IndexIDMap):
+                inner_index = faiss.downcast_index(index.index)
+                live_mask = ~self._dead_mask(id_array.shape[0])
+                for start in range(0, id_array.shape[0], chunk_size):
+                    stop = min(start + chunk_size, id_array.shape[0])
+                    # Dead vectors are skipped
+                    chunk_live = live_mask[start:stop]
+                    if self._store_rows is not None:
+                        # Full precision vectors instead of decoded codes
+                        yield id_array[start:stop][chunk_live], self.vector_store.read(
+                            self._store_rows[start:stop][chunk_live])
+                        continue
+                    yield id_array[start:stop][chunk_live], inner_index.reconstruct_n(start, stop - start)[chunk_live]
+                return
+            for start in range(0, id_array.shape[0], chunk_size):
+                chunk_ids = id_array[start:start + chunk_size]
+                yield chunk_ids, self.index.reconstruct_batch(chunk_ids)
+
+    def reconstruct(self, image_ids: list or numpy.ndarray) -> numpy.ndarray or str:
+        """
+        Get stored vectors of image ids, full precision vectors of the vector store if there is one
+        :param image_ids: image ids as list or int64 array
+        :return: float32 matrix or error status if an id is not stored
+        """
+        try:
+            id_array = numpy.ascontiguousarray(image_ids, dtype=numpy.int64)
+        except (ValueError, TypeError, OverflowError):
+            return messages.INVALID_IDS
+        if id_array.ndim != 1 or not id_array.shape[0]:
+            return messages.INVALID_IDS
+        self.refresh()
+        self._add_direct_map()
+        with self.lock.read():
+            index = faiss.downcast_index(self.index)
+            if not isinstance(index, faiss.IndexIDMap):
+                if self.ivf_index() is None:
+                    return messages.RECONSTRUCT_NOT_SUPPORTED
+                try:
+                    return self.index.reconstruct_batch(id_array)
+                except RuntimeError:
+                    return messages.UNKNOWN_IDS
+            positions = self._live_positions(index, id_array)
+            if (positions < 0).any():
+                return messages.UNKNOWN_IDS
+            if self._store_rows is not None:
+                return self.vector_store.read(self._store_rows[positions])
+
+            return faiss.downcast_index(index.index).reconstruct_batch(positions)
+
+    def _add_direct_map(self) -> None:
+        """Let an IVF index find vectors by id, the direct map is kept up to date by later writes"""
+        ivf_index = self.ivf_index()
+        # Reconstruction by id needs a direct map from ids to inverted lists, adding it changes the index
+        if ivf_index is not None and ivf_index.direct_map.type == faiss.DirectMap.NoMap:
+            with self.lock:
+                if ivf_index.direct_map.type == faiss.DirectMap.NoMap:
+                    ivf_index.set_direct_map_type(faiss.DirectMap.Hashtable)
+                    # Inverted lists under an IDMap can't remove translated ids with a hashtable
+                    self._check_removal()
+
+    def _live_positions(self, index: faiss.IndexIDMap, id_array: numpy.ndarray) -> numpy.ndarray:
+        """
+        Find stored positions of live image ids, the caller holds the lock
+        :param index: IDMap index
+        :param id_array: int64 image ids
+        :return: int64 positions, -1 for ids which are not stored
+        """
+        unique_ids, inverse = numpy.unique(id_array, return_inverse=True)
+        rows, positions = self._position_map(index).lookup(unique_ids)
+        live = ~self._is_dead(positions)
+        unique_positions = numpy.full(unique_ids.shape[0], -1, dtype=numpy.int64)
+        # The latest position wins if an id was inserted again without removing it
+        numpy.maximum.at(unique_positions, rows[live], positions[live])
+
+        return unique_positions[inverse]
+
+    def stored_ids(self) -> numpy.ndarray:
+        """Get a copy of image ids in order of stored positions, dead vectors included"""
+        index = faiss.downcast_index(self.index)
+        if isinstance(index, faiss.IndexIDMap):
+            return faiss.vector_to_array(index.id_map)
+        # IVF indexes keep ids in their inverted lists
+        ivf_index = self.ivf_index()
+        if ivf_index is None:
+            raise TypeError(f"Can not read vectors of {type(index).__name__}")
+        inverted_lists = ivf_index.invlists
+
+        return numpy.concatenate(
+            [faiss.rev_swig_ptr(inverted_lists.get_ids(list_number),
+                                inverted_lists.list_size(list_number)).copy()
+             for list_number in range(ivf_index.nlist)] + [numpy.empty(0, dtype=numpy.int64)])
+
+    def sample_vectors(self, n_samples: int, seed: int = 1234) -> numpy.ndarray:
+        """
+        Draw a random sample of stored vectors e.g. for training of a new index
+        :param n_samples: number of vectors in the sample
+        :param seed: random seed
+        :return: float32 matrix of sampled vectors
+        """
+        n_total = len(self)
+        n_samples = min(n_samples, n_total)
+        positions = numpy.sort(numpy.random.RandomState(seed).choice(n_total, n_samples, replace=False))
+        sample, start = [], 0
+        for id_array, vector_array in self.iterate_vectors():
+            stop = start + id_array.shape[0]
+            # Keep sampled rows of this chunk only, memory stays bounded by the sample size
+            chunk_positions = positions[(positions >= start) & (positions < stop)] - start
+            sample.append(vector_array[chunk_positions])
+            start = stop
+
+        return numpy.concatenate(sample) if sample else numpy.empty((0, self.dimension), dtype=numpy.float32)
+
+    def to_vector_array(self, features_vectors: list or numpy.ndarray) -> numpy.ndarray or str:
+        """
+        Convert features vectors to a contiguous float32 matrix,
+        float32 matrices are used as they are without a copy
+        :param features_vectors: features vectors as lists or numpy array
+        :return: float32 matrix or error status
+        """
+        try:
+            # Write the vector array [[0.2, 0.12], [0.98, 0.34]] as float32 numpy matrix
+            vector_array = numpy.ascontiguousarray(features_vectors, dtype=numpy.float32)
+        except (ValueError, TypeError):
+            return messages.DIMENSION_ERROR
+        # Check that vector dimension is same as index dimension
+        if vector_array.ndim != 2 or vector_array.shape[1] != self.dimension:
+            return messages.DIMENSION_ERROR
+
+        return vector_array
+
     def to_disk(self, index_path: str) -> str:
         """
         Write the index to disk
         :param index_path: Path to the index folder
         :return: status if writing
         """
+        # The placeholder of an index which is still loading must not replace its file
+        if not self.loader.ready.is_set():
+            return messages.WARMING_UP
         # Create path to the index if not exists
         if not os.path.isdir(os.path.dirname(index_path)):
             os.makedirs(os.path.dirname(index_path), exist_ok=True)
-        # Write the index to disk
-        faiss.write_index(self.index, index_path)
+        with self.lock:
+            # Index files carry no tombstones, dead vectors are removed before writing
+            self.compact()
+            # Rows of removed and overwritten vectors are dropped once they outnumber the live ones
+            if self._store_rows is not None and len(self.vector_store) > 2 * self._store_rows.shape[0]:
+                self.vector_store.rewrite(self._store_rows)
+                self._store_rows = numpy.arange(self._store_rows.shape[0], dtype=numpy.int64)
+            # Write the index to disk
+            faiss.write_index(self.index, index_path)
 
         return messages.OK
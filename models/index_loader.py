@@ -0,0 +1,87 @@
+"""Loading of the faiss index off the request path with progress for readiness probes"""
+__author__ = "Vitali Muladze"
+
+import threading
+import time
+
+import faiss
+
+
+class IndexLoader:
+    def __init__(self):
+        """
+        State of loading an index, ready unless loading was started in background
+        """
+        self.ready = threading.Event()
+        self.ready.set()
+        # Set once loading finished, also when it failed
+        self.done = threading.Event()
+        self.done.set()
+        self.stage = 'ready'
+        self.loaded_bytes = 0
+        self.total_bytes = 0
+        self.started = None
+        self.seconds = None
+        self.error = None
+        # Value returned by the loading function e.g. recovery report
+        self.report = None
+
+    def start(self, function, *args) -> None:
+        """
+        Run the loading function in background, the index is not ready until it returns
+        :param function: function which loads the index
+        :param args: arguments of the function
+        """
+        self.ready.clear()
+        self.done.clear()
+        self.stage = 'loading'
+        self.started = time.time()
+        threading.Thread(target=self._run, args=(function, *args), name='IndexLoader', daemon=True).start()
+
+    def _run(self, function, *args) -> None:
+        """Run the loading function and record its outcome"""
+        try:
+            self.report = function(*args)
+            self.stage = 'ready'
+            self.ready.set()
+        except Exception as error:
+            # The process stays up to report the error, liveness fails
+            self.error = f"{type(error).__name__}: {error}"
+            self.stage = 'failed'
+        finally:
+            self.seconds = time.time() - self.started
+            self.done.set()
+
+    def read_index(self, index_file, n_bytes: int = 0) -> faiss.Index:
+        """
+        Read a faiss index from an open file counting read bytes for the progress
+        :param index_file: file opened for binary reading at the start of the index
+        :param n_bytes: size of the index in bytes if it is not counted in total_bytes yet
+        :return: faiss index
+        """
+        self.total_bytes += n_bytes
+
+        def read(size: int) -> bytes:
+            data = index_file.read(size)
+            self.loaded_bytes += len(data)
+            return data
+
+        return faiss.read_index(faiss.PyCallbackIOReader(read))
+
+    @property
+    def progress(self) -> float:
+        """Get the share of the index which is loaded"""
+        if self.ready.is_set():
+            return 1.0
+
+        return min(self.loaded_bytes / self.total_bytes, 1.0) if self.total_bytes else 0.0
+
+    def status(self) -> dict:
+        """Get the loading state reported by the readiness endpoint"""
+        seconds = self.seconds
+        if seconds is None and self.started is not None:
+            seconds = time.time() - self.started
+
+        return {"ready": self.ready.is_set(), "stage": self.stage, "progress": round(self.progress, 4),
+                "loaded_bytes": self.loaded_bytes, "total_bytes": self.total_bytes,
+                "seconds": seconds, "error": self.error, "report": self.report}
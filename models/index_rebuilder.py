@@ -0,0 +1,239 @@
+"""Online rebuild of the index into a new index type, swapped in once it caught up with writes"""
+__author__ = "Vitali Muladze"
+
+import threading
+import time
+
+import faiss
+import numpy
+
+from models.checkpointer import Checkpointer
+from models.faiss_database import FaissIndex
+from models.write_ahead_log import INSERT, REMOVE, TRAIN
+from source.configuration import messages
+
+# Writes made during the build left for the final replay, which blocks writes and searches
+MAX_FINAL_REPLAY = 10000
+
+
+class IndexRebuilder:
+    def __init__(self, faiss_index: FaissIndex, train_size: int = 100000, chunk_size: int = 10000,
+                 n_eval_queries: int = 100, checkpointer: Checkpointer or None = None):
+        """
+        Build a new index from the vectors of the served one in background, writes which arrive during
+        the build are recorded and replayed into it before it replaces the served index
+        :param faiss_index: served index, not sharded or shared
+        :param train_size: number of vectors sampled for training
+        :param chunk_size: number of vectors read and added at once
+        :param n_eval_queries: sampled vectors whose searches compare recall and latency of both indexes
+        :param checkpointer: checkpointer of the write-ahead log which writes the new index at once
+        """
+        self.faiss_index = faiss_index
+        self.train_size = train_size
+        self.chunk_size = chunk_size
+        self.n_eval_queries = n_eval_queries
+        self.checkpointer = checkpointer
+        self.stage = 'idle'
+        self.index_factory = None
+        self.n_vectors = 0
+        self.n_added = 0
+        self.n_replayed = 0
+        self.started = None
+        self.seconds = None
+        self.error = None
+        # Recall against an exact scan and latency of both indexes
+        self.evaluation = None
+        self.rebuilds = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        # Writes applied to the served index since the snapshot of its ids
+        self._pending = []
+        self._pending_lock = threading.Lock()
+
+    @property
+    def progress(self) -> float:
+        """Get share of the snapshot vectors added to the new index"""
+        return self.n_added / self.n_vectors if self.n_vectors else float(self.stage == 'done')
+
+    def status(self) -> dict:
+        """Get stage, progress and evaluation of the current or last rebuild"""
+        return {"stage": self.stage, "index_factory": self.index_factory, "progress": self.progress,
+                "n_vectors": self.n_vectors, "n_added": self.n_added, "n_replayed": self.n_replayed,
+                "pending_writes": len(self._pending), "seconds": self.seconds if self.seconds is not None
+                else time.time() - self.started if self.started else None,
+                "error": self.error, "evaluation": self.evaluation}
+
+    def start(self, index_factory: str, n_results: int = 10, nprobe: int or None = None,
+              ef_search: int or None = None) -> dict or str:
+        """
+        Start a rebuild unless one is running
+        :param index_factory: faiss factory string of the new index, the configured one compacts the index
+        :param n_results: number of results of the evaluation searches
+        :param nprobe: number of IVF lists scanned by the evaluation searches
+        :param ef_search: HNSW candidates queue size of the evaluation searches
+        :return: status of the rebuild or error status
+        """
+        if not isinstance(n_results, int) or n_results < 1:
+            return messages.INVALID_REBUILD
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return messages.REBUILD_RUNNING
+            try:
+                target = FaissIndex(None, self.faiss_index.dimension, index_factory)
+            except (RuntimeError, TypeError):
+                return messages.INVALID_INDEX_FACTORY
+            target.cpu_scheduler = self.faiss_index.cpu_scheduler
+            self.stage = 'sampling'
+            self.index_factory = index_factory
+            self.n_vectors = self.n_added = self.n_replayed = 0
+            self.started = time.time()
+            self.seconds = self.error = self.evaluation = None
+            self._thread = threading.Thread(target=self._run,
+                                            args=(target, n_results, {"nprobe": nprobe, "ef_search": ef_search}),
+                                            name='IndexRebuilder', daemon=True)
+            self._thread.start()
+
+        return self.status()
+
+    def _record(self, operation: int, id_array: numpy.ndarray, vector_array: numpy.ndarray or None) -> None:
+        """Keep a write applied to the served index, called with its lock held"""
+        if operation == TRAIN:
+            return
+        with self._pending_lock:
+            # Vectors of binary requests are views of the request body
+            self._pending.append((operation, id_array.copy(),
+                                  vector_array.copy() if vector_array is not None else None))
+
+    def _run(self, target: FaissIndex, n_results: int, search_knobs: dict) -> None:
+        """Rebuild the index and record the outcome"""
+        try:
+            self._rebuild(target, n_results, search_knobs)
+            self.stage = 'done'
+            self.rebuilds += 1
+        except Exception as error:
+            # The served index stays as it was
+            self.error = f"{type(error).__name__}: {error}"
+            self.stage = 'failed'
+        finally:
+            with self.faiss_index.lock:
+                if self._record in self.faiss_index.mutation_listeners:
+                    self.faiss_index.mutation_listeners.remove(self._record)
+            with self._pending_lock:
+                self._pending = []
+            self.seconds = time.time() - self.started
+
+    def _rebuild(self, target: FaissIndex, n_results: int, search_knobs: dict) -> None:
+        """Train and fill the new index, replay writes made meanwhile and swap it in"""
+        # Ids of the snapshot and the writes after it are taken at once
+        with self.faiss_index.lock:
+            id_array = self.faiss_index.stored_ids()
+            id_array = id_array[~self.faiss_index._dead_mask(id_array.shape[0])]
+            self.faiss_index.mutation_listeners.append(self._record)
+        self.n_vectors = id_array.shape[0]
+        random_state = numpy.random.RandomState(1234)
+        sample_ids = numpy.sort(random_state.choice(id_array, min(self.train_size, self.n_vectors), replace=False))
+        _, sample = self._read_vectors(sample_ids)
+        queries = sample[random_state.permutation(sample.shape[0])[:self.n_eval_queries]]
+        if not target.is_trained:
+            self.stage = 'training'
+            status = target.train(sample)
+            if isinstance(status, str):
+                raise ValueError(status)
+        self.stage = 'building'
+        keep_max = self.faiss_index.metric_type == faiss.METRIC_INNER_PRODUCT
+        ground_truth = faiss.ResultHeap(queries.shape[0], n_results, keep_max=keep_max)
+        for start in range(0, self.n_vectors, self.chunk_size):
+            chunk_ids, chunk_vectors = self._read_vectors(id_array[start:start + self.chunk_size])
+            if chunk_ids.shape[0]:
+                status = target.insert(chunk_vectors, chunk_ids, is_updating=True)
+                if isinstance(status, str):
+                    raise ValueError(status)
+                # Exact results of the evaluation queries are found from the same vectors
+                if queries.shape[0]:
+                    distances, positions = faiss.knn(queries, chunk_vectors, min(n_results, chunk_ids.shape[0]),
+                                                     metric=self.faiss_index.metric_type)
+                    ground_truth.add_result(distances, numpy.where(positions >= 0, chunk_ids[positions], -1))
+            self.n_added = min(start + self.chunk_size, self.n_vectors)
+        ground_truth.finalize()
+        self.stage = 'replaying'
+        # Writes keep coming, the final replay under the lock is kept short
+        while len(self._pending) > MAX_FINAL_REPLAY:
+            self._replay(target)
+        self.stage = 'evaluating'
+        before = self._evaluate(self.faiss_index, queries, ground_truth.I, n_results, search_knobs)
+        after = self._evaluate(target, queries, ground_truth.I, n_results, search_knobs)
+        self.evaluation = {"n_queries": queries.shape[0], "n_results": n_results,
+                           "recall_before": before[0], "recall_after": after[0],
+                           "latency_ms_before": before[1], "latency_ms_after": after[1]}
+        self.stage = 'swapping'
+        # Writes and searches wait until the last writes are replayed and the new index is in place
+        with self.faiss_index.lock:
+            self._replay(target)
+            self.faiss_index.mutation_listeners.remove(self._record)
+            self.faiss_index.replace_index(target.index)
+            # Layouts which can't remove vectors, e.g. HNSW, only marked the replayed removals
+            self.faiss_index.restore_dead_bitmap(target.dead_bitmap)
+        # Recovery starts from the new index instead of replaying the log onto the old one
+        if self.checkpointer is not None:
+            self.checkpointer.checkpoint()
+
+    def _read_vectors(self, id_array: numpy.ndarray) -> tuple:
+        """
+        Read vectors of snapshot ids from the served index, ids removed since the snapshot are skipped
+        :param id_array: int64 image ids
+        :return: int64 image ids which are still stored and their float32 features vectors
+        """
+        while id_array.shape[0]:
+            vector_array = self.faiss_index.reconstruct(id_array)
+            if not isinstance(vector_array, str):
+                return id_array, vector_array
+            if vector_array != messages.UNKNOWN_IDS:
+                raise ValueError(vector_array)
+            # Their removal is replayed, so they are not needed
+            with self.faiss_index.lock.read():
+                stored_ids = self.faiss_index.stored_ids()
+                stored_ids = stored_ids[~self.faiss_index._dead_mask(stored_ids.shape[0])]
+            id_array = id_array[numpy.isin(id_array, stored_ids)]
+
+        return id_array, numpy.empty((0, self.faiss_index.dimension), dtype=numpy.float32)
+
+    def _replay(self, target: FaissIndex) -> None:
+        """Apply the recorded writes to the new index, the last write of every id wins"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        id_array = numpy.concatenate([record[1] for record in pending])
+        vector_array = numpy.concatenate([record[2] if record[2] is not None
+                                          else numpy.zeros((record[1].shape[0], target.dimension), numpy.float32)
+                                          for record in pending])
+        removed = numpy.concatenate([numpy.full(record[1].shape[0], record[0] == REMOVE) for record in pending])
+        # Vectors read from the served index may already contain a write, so writes replace instead of adding
+        unique_ids, reversed_rows = numpy.unique(id_array[::-1], return_index=True)
+        last_rows = id_array.shape[0] - 1 - reversed_rows
+        last_rows = last_rows[~removed[last_rows]]
+        with target.lock:
+            target.apply_log_record(REMOVE, unique_ids, None)
+            if last_rows.shape[0]:
+                target.apply_log_record(INSERT, id_array[last_rows], vector_array[last_rows])
+        self.n_replayed += len(pending)
+
+    def _evaluate(self, index: FaissIndex, queries: numpy.ndarray, ground_truth: numpy.ndarray, n_results: int,
+                  search_knobs: dict) -> tuple:
+        """
+        Search the evaluation queries one by one like requests do
+        :return: recall@n_results against the exact results and mean latency in milliseconds, None if unsupported
+        """
+        if not queries.shape[0]:
+            return None, None
+        hits = 0
+        tok = time.time()
+        for query, exact_ids in zip(queries, ground_truth):
+            result = index.search(query[None], n_results, **search_knobs)
+            if isinstance(result, str):
+                return None, None
+            exact_ids = exact_ids[exact_ids >= 0]
+            hits += numpy.isin(exact_ids, result[0][0]).sum() / max(exact_ids.shape[0], 1)
+        latency_ms = (time.time() - tok) * 1000 / queries.shape[0]
+
+        return float(hits / queries.shape[0]), latency_ms
@@ -0,0 +1,212 @@
+"""External string keys and small payloads of image ids kept in a memory mapped file"""
+__author__ = "Vitali Muladze"
+
+import os
+import threading
+
+import numpy
+
+from source.configuration import messages
+
+# Keys allocated since the last merge which are looked up in a dict, merged into the sorted arrays
+# once they outnumber this or an eighth of the sorted keys
+MIN_MERGE_SIZE = 65536
+# Ids stored before the key store was enabled are skipped with empty records, at most this many
+MAX_SKIPPED_IDS = 2 ** 20
+
+
+class KeyStore:
+    def __init__(self, store_path: str, key_size: int = 64, payload_size: int = 0):
+        """
+        Fixed-size records whose row is the image id, so ids of search results index the file directly,
+        ids are allocated monotonically and never reused, also after removals and restarts
+        :param store_path: path to the records file
+        :param key_size: maximum length of a key in utf-8 bytes
+        :param payload_size: maximum length of a payload in utf-8 bytes, 0 stores no payloads
+        """
+        self.store_path = store_path
+        fields = [('live', numpy.uint8), ('key', f'S{key_size}')]
+        if payload_size:
+            fields.append(('payload', f'S{payload_size}'))
+        self.record_dtype = numpy.dtype(fields)
+        self.key_size = key_size
+        self.payload_size = payload_size
+        os.makedirs(os.path.dirname(os.path.abspath(store_path)), exist_ok=True)
+        self._fd = os.open(store_path, os.O_RDWR | os.O_CREAT, 0o644)
+        # Records written by a process which stopped during an append are dropped
+        self.n_rows = os.fstat(self._fd).st_size // self.record_dtype.itemsize
+        os.ftruncate(self._fd, self.n_rows * self.record_dtype.itemsize)
+        self._records = None
+        self._map_lock = threading.Lock()
+        # Allocations and changes of keys are serialized, lookups and joins read the memory map
+        self._lock = threading.Lock()
+        # Keys of live records sorted with their ids, recent keys wait in a dict until they are merged
+        self._sorted_keys = numpy.empty(0, dtype=self.record_dtype['key'])
+        self._sorted_ids = numpy.empty(0, dtype=numpy.int64)
+        self._recent = {}
+        self._merge(self._live_rows())
+
+    def __len__(self):
+        """Get number of allocated ids"""
+        return self.n_rows
+
+    def records(self) -> numpy.ndarray:
+        """Get the records read through a memory map, mapped again once it grew"""
+        with self._map_lock:
+            if self._records is None or self._records.shape[0] < self.n_rows:
+                self._records = numpy.memmap(self.store_path, dtype=self.record_dtype, mode='r',
+                                             shape=(self.n_rows,)) if self.n_rows else None
+            records = self._records
+
+        return records if records is not None else numpy.empty(0, dtype=self.record_dtype)
+
+    def _live_rows(self) -> numpy.ndarray:
+        """Get ids of live records with a key"""
+        records = self.records()
+
+        return numpy.flatnonzero((records['live'] == 1) & (records['key'] != b''))
+
+    def _merge(self, new_ids: numpy.ndarray) -> None:
+        """Add keys of records to the sorted arrays, dropping keys of removed records, the caller holds the lock"""
+        records = self.records()
+        ids = numpy.concatenate([self._sorted_ids[records['live'][self._sorted_ids] == 1],
+                                 new_ids.astype(numpy.int64)])
+        keys = records['key'][ids]
+        order = numpy.argsort(keys, kind='stable')
+        self._sorted_keys = keys[order]
+        self._sorted_ids = ids[order]
+        self._recent = {}
+
+    def _encode(self, values: list, size: int) -> numpy.ndarray or None:
+        """Convert strings to fixed-size utf-8 bytes, None if one is not a string or too long"""
+        if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+            return None
+        encoded = [value.encode() for value in values]
+        if any(len(value) > size for value in encoded):
+            return None
+
+        return numpy.array(encoded, dtype=f'S{max(size, 1)}')
+
+    def _find(self, key_array: numpy.ndarray) -> numpy.ndarray:
+        """Look up encoded keys, -1 for unknown keys"""
+        id_array = numpy.full(key_array.shape[0], -1, dtype=numpy.int64)
+        if self._sorted_keys.shape[0]:
+            places = numpy.minimum(numpy.searchsorted(self._sorted_keys, key_array), self._sorted_keys.shape[0] - 1)
+            found = self._sorted_keys[places] == key_array
+            id_array[found] = self._sorted_ids[places[found]]
+        for number, key in enumerate(key_array.tolist()):
+            id_array[number] = self._recent.get(key, id_array[number])
+        # Removed records stay in the sorted arrays until the next merge
+        known = id_array >= 0
+        id_array[known] = numpy.where(self.records()['live'][id_array[known]] == 1, id_array[known], -1)
+
+        return id_array
+
+    def lookup(self, keys: list) -> numpy.ndarray or str:
+        """
+        Find image ids of keys
+        :param keys: list of strings
+        :return: int64 image ids, -1 for unknown keys, or error status
+        """
+        key_array = self._encode(keys, self.key_size)
+        if key_array is None:
+            return messages.INVALID_KEYS
+        with self._lock:
+            return self._find(key_array)
+
+    def allocate(self, n_ids: int, keys: list or None = None, payloads: list or None = None,
+                 first_id: int = 0) -> numpy.ndarray or str:
+        """
+        Allocate new image ids with their keys and payloads
+        :param n_ids: number of ids
+        :param keys: new unique keys or None for ids without keys
+        :param payloads: payloads or None for empty payloads
+        :param first_id: smallest id which may be allocated e.g. following ids given by clients
+        :return: int64 image ids or error status
+        """
+        records = numpy.zeros(n_ids, dtype=self.record_dtype)
+        records['live'] = 1
+        if keys is not None:
+            key_array = self._encode(keys, self.key_size)
+            if key_array is None or key_array.shape[0] != n_ids or numpy.unique(key_array).shape[0] != n_ids \
+                    or (key_array == b'').any():
+                return messages.INVALID_KEYS
+            records['key'] = key_array
+        if payloads is not None:
+            payload_array = self._encode(payloads, self.payload_size)
+            if not self.payload_size or payload_array is None or payload_array.shape[0] != n_ids:
+                return messages.INVALID_PAYLOADS
+            records['payload'] = payload_array
+        with self._lock:
+            if keys is not None and (self._find(records['key']) >= 0).any():
+                return messages.KEYS_EXIST
+            first_id = max(first_id, self.n_rows)
+            if first_id - self.n_rows > MAX_SKIPPED_IDS:
+                return messages.KEY_STORE_GAP
+            # Ids given by clients are skipped with empty records
+            padding = numpy.zeros(first_id - self.n_rows, dtype=self.record_dtype)
+            os.pwrite(self._fd, padding.tobytes() + records.tobytes(), self.n_rows * self.record_dtype.itemsize)
+            id_array = numpy.arange(first_id, first_id + n_ids, dtype=numpy.int64)
+            self.n_rows = first_id + n_ids
+            if keys is not None:
+                self._recent.update(zip(records['key'].tolist(), id_array.tolist()))
+                if len(self._recent) > max(MIN_MERGE_SIZE, self._sorted_ids.shape[0] // 8):
+                    self._merge(numpy.fromiter(self._recent.values(), dtype=numpy.int64))
+
+        return id_array
+
+    def set_payloads(self, id_array: numpy.ndarray, payloads: list) -> str:
+        """
+        Replace payloads of allocated image ids
+        :param id_array: int64 image ids
+        :param payloads: payloads
+        :return: status
+        """
+        payload_array = self._encode(payloads, self.payload_size)
+        if not self.payload_size or payload_array is None or payload_array.shape[0] != id_array.shape[0]:
+            return messages.INVALID_PAYLOADS
+        if ((id_array < 0) | (id_array >= self.n_rows)).any():
+            return messages.UNKNOWN_KEYS
+        offset = self.record_dtype.fields['payload'][1]
+        with self._lock:
+            for image_id, payload in zip(id_array.tolist(), payload_array):
+                os.pwrite(self._fd, payload.tobytes(), image_id * self.record_dtype.itemsize + offset)
+
+        return messages.OK
+
+    def release(self, id_array: numpy.ndarray) -> None:
+        """
+        Forget keys and payloads of removed image ids, their ids are not allocated again
+        :param id_array: int64 image ids, ids without record are ignored
+        """
+        id_array = id_array[(id_array >= 0) & (id_array < self.n_rows)]
+        with self._lock:
+            records = self.records()
+            for image_id in id_array[records['live'][id_array] == 1].tolist():
+                os.pwrite(self._fd, b'\0', image_id * self.record_dtype.itemsize)
+                self._recent.pop(records['key'][image_id], None)
+
+    def join(self, id_array: numpy.ndarray) -> dict:
+        """
+        Get keys and payloads of search results
+        :param id_array: int64 image ids of any shape, -1 for missing results
+        :return: keys and payloads as nested lists of the same shape, None for ids without key or payload
+        """
+        records = self.records()
+        valid = (id_array >= 0) & (id_array < records.shape[0])
+        if not records.shape[0]:
+            empty = numpy.full(id_array.shape, None, dtype=object).tolist()
+            return {"keys": empty, "payloads": empty} if self.payload_size else {"keys": empty}
+        rows = records[numpy.where(valid, id_array, 0)]
+        live = valid & (rows['live'] == 1)
+        joined = {"keys": numpy.where(live & (rows['key'] != b''),
+                                      numpy.char.decode(rows['key'], 'utf-8', errors='replace'), None).tolist()}
+        if self.payload_size:
+            joined["payloads"] = numpy.where(live, numpy.char.decode(rows['payload'], 'utf-8', errors='replace'),
+                                             None).tolist()
+
+        return joined
+
+    def close(self) -> None:
+        """Close the file, written records are kept"""
+        os.close(self._fd)
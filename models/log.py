@@ -2,13 +2,18 @@
 __author__ = "Vitali Muladze"
 
 
+import atexit
 import inspect
 import logging
-from logging.handlers import SMTPHandler
+import queue
+import random
+import threading
+import time
+from logging.handlers import QueueHandler, SMTPHandler
 
 from flask import has_request_context, request
 
-from source.configuration import files, mail_config
+from source.configuration import files, mail_config, logger_config
 
 
 class RequestFormatter(logging.Formatter):
@@ -17,7 +22,8 @@ class RequestFormatter(logging.Formatter):
         if has_request_context():
             record.url = request.url
             record.remote_addr = request.remote_addr
-        else:
+        # Records formatted in the writer thread carry request info captured when they were logged
+        elif not hasattr(record, 'url'):
             record.url = None
             record.remote_addr = None
 
@@ -27,6 +33,145 @@ class RequestFormatter(logging.Formatter):
 formatter = RequestFormatter('[%(asctime)s] %(remote_addr)s requested %(url)s %(levelname)s in %(module)s: %(message)s')
 
 
+class SamplingFilter(logging.Filter):
+    """Pass only a sample of info records, warnings and errors always pass"""
+
+    def __init__(self, sample_rate: float = 1.0):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record):
+        return record.levelno > logging.INFO or self.sample_rate >= 1 or random.random() < self.sample_rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Put records to a bounded queue without formatting them, records are dropped when it is full"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Only request info is taken here, message is formatted in the writer thread
+        if has_request_context():
+            record.url = request.url
+            record.remote_addr = request.remote_addr
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class AggregatingSMTPHandler(SMTPHandler):
+    """Send collected errors in one mail at most once per interval without blocking the writer"""
+
+    def __init__(self, *args, interval: float = 300, max_records: int = 50, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.interval = interval
+        self.max_records = max_records
+        self.pending = []
+        self.pending_count = 0
+        self.last_sent = 0
+        self._sending = None
+
+    def emit(self, record):
+        self.pending_count += 1
+        # Mail holds first records only, the rest is counted
+        if len(self.pending) < self.max_records:
+            self.pending.append(self.format(record))
+        self.flush()
+
+    def flush(self):
+        if not self.pending_count or time.time() - self.last_sent < self.interval:
+            return
+        if self._sending is not None and self._sending.is_alive():
+            return
+        lines, count = self.pending, self.pending_count
+        self.pending, self.pending_count = [], 0
+        self.last_sent = time.time()
+        self._sending = threading.Thread(target=self._send, args=(lines, count), daemon=True)
+        self._sending.start()
+
+    def _send(self, lines: list, count: int) -> None:
+        """Send one mail with collected errors"""
+        message = "\n".join(lines)
+        if count > len(lines):
+            message += f"\n... and {count - len(lines)} more errors"
+        # Lines are formatted already
+        record = logging.makeLogRecord({"msg": message, "levelno": logging.ERROR, "levelname": "ERROR",
+                                        "aggregated": True})
+        super().emit(record)
+
+    def format(self, record):
+        if getattr(record, 'aggregated', False):
+            return record.getMessage()
+        return super().format(record)
+
+
+class LogWriter:
+    """Background thread which writes queued records in batches"""
+
+    def __init__(self, log_queue: queue.Queue, handlers: list, queue_handler: DroppingQueueHandler,
+                 batch_size: int = 256, flush_interval: float = 1.0):
+        self.queue = log_queue
+        self.handlers = handlers
+        self.queue_handler = queue_handler
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.reported_dropped = 0
+        self._thread = threading.Thread(target=self._run, name='LogWriter', daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = []
+            try:
+                batch.append(self.queue.get(timeout=self.flush_interval))
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            if None in batch:
+                self._write(batch[:batch.index(None)])
+                return
+            self._write(batch)
+
+    def _write(self, batch: list) -> None:
+        """Handle a batch of records and flush handlers once for all of them"""
+        dropped = self.queue_handler.dropped
+        if dropped > self.reported_dropped:
+            batch.append(logging.makeLogRecord({
+                "msg": f"{dropped - self.reported_dropped} log records dropped, log queue is full",
+                "levelno": logging.WARNING, "levelname": "WARNING", "module": "log"}))
+            self.reported_dropped = dropped
+        for record in batch:
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        for handler in self.handlers:
+            handler.flush()
+
+    def stop(self) -> None:
+        """Write records left in the queue and stop the thread"""
+        self.queue.put(None)
+        self._thread.join(timeout=5)
+
+
+class BufferedFileHandler(logging.FileHandler):
+    """File handler which leaves flushing to the writer, once per batch"""
+
+    def emit(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
 class Logger:
     logging_format = formatter
     logger_name = 'FaissServer'
@@ -34,31 +179,37 @@ class Logger:
     logger_file_error = files.log_file_error
 
     def __init__(self):
-        """Create logger instance which handles file insertion and printing"""
+        """Create logger instance which handles file insertion and printing off the request thread"""
         # Create logger formatter and instance
         self.log = logging.getLogger(self.logger_name)
         self.log.setLevel(logging.DEBUG)
         log_formatter = self.logging_format
         # Info type logs formatter
-        file_handler_info = logging.FileHandler(self.logger_file_info, mode='a', encoding="utf-8")
+        file_handler_info = BufferedFileHandler(self.logger_file_info, mode='a', encoding="utf-8")
         file_handler_info.setFormatter(log_formatter)
         file_handler_info.setLevel(logging.INFO)
-        self.log.addHandler(file_handler_info)
         # Error type logs formatter
-        file_handler_error = logging.FileHandler(self.logger_file_error, mode='a', encoding="latin-1")
+        file_handler_error = BufferedFileHandler(self.logger_file_error, mode='a', encoding="latin-1")
         file_handler_error.setFormatter(log_formatter)
         file_handler_error.setLevel(logging.ERROR)
-        self.log.addHandler(file_handler_error)
-        # Send errors to mail
-        mail_handler = SMTPHandler(
+        # Send errors to mail, aggregated and rate limited
+        mail_handler = AggregatingSMTPHandler(
             mailhost=mail_config.host,
             fromaddr=mail_config.sender,
             toaddrs=mail_config.send_mail_to,
-            subject='Internal Control services Application Error'
+            subject='Internal Control services Application Error',
+            interval=logger_config.mail_interval
         )
         mail_handler.setLevel(logging.ERROR)
         mail_handler.setFormatter(log_formatter)
-        self.log.addHandler(mail_handler)
+        # Requests only put records to the queue, the writer thread does the I/O
+        log_queue = queue.Queue(maxsize=logger_config.queue_size)
+        self.queue_handler = DroppingQueueHandler(log_queue)
+        self.queue_handler.addFilter(SamplingFilter(logger_config.info_sample_rate))
+        self.log.addHandler(self.queue_handler)
+        self.writer = LogWriter(log_queue, [file_handler_info, file_handler_error, mail_handler],
+                                self.queue_handler, logger_config.batch_size)
+        atexit.register(self.writer.stop)
 
     def log_event(self, message: str = "", error: bool = False) -> None:
         """Function for logging events"""
@@ -0,0 +1,158 @@
+"""Metrics of the application in prometheus text format"""
+__author__ = "Vitali Muladze"
+
+import bisect
+import os
+import resource
+import threading
+
+# Upper bounds of latency buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Upper bounds of batch size buckets in vectors
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def format_labels(label_names: tuple, label_values: tuple, **extra) -> str:
+    """
+    Format labels of a sample e.g. {endpoint="search",stage="parse"}
+    :param label_names: names of the labels
+    :param label_values: values of the labels
+    :param extra: additional labels e.g. le of histogram buckets
+    :return: formatted labels or empty string
+    """
+    pairs = list(zip(label_names, label_values)) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def format_value(value: float) -> str:
+    """Format a sample value, integers without the fraction"""
+    if value == int(value) and abs(value) < 2 ** 53:
+        return str(int(value))
+    return repr(float(value))
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, label_names: tuple = (),
+                 buckets: tuple = LATENCY_BUCKETS):
+        """
+        Histogram of observed values per label values
+        :param name: metric name
+        :param documentation: help text
+        :param label_names: names of the labels
+        :param buckets: upper bounds of the buckets, +Inf is added
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # Label values -> [bucket counts, sum, count]
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values) -> None:
+        """
+        Count a value in its bucket
+        :param value: observed value
+        :param label_values: values of the labels in order of label names
+        """
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            sample = self._samples.get(label_values)
+            if sample is None:
+                sample = self._samples[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            sample[0][position] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    def render(self) -> list:
+        """Get lines of the histogram in text format"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            samples = [(label_values, list(counts), total, count)
+                       for label_values, (counts, total, count) in self._samples.items()]
+        for label_values, counts, total, count in samples:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float('inf') else format_value(bound)
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, label_values, le=le)} "
+                             f"{cumulative}")
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, documentation: str, function, label_names: tuple = (),
+                 metric_type: str = 'gauge'):
+        """
+        Metric read from the application when it is scraped
+        :param name: metric name
+        :param documentation: help text
+        :param function: function returning a value, or a dict of label values tuples and values
+        :param label_names: names of the labels
+        :param metric_type: gauge or counter
+        """
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.label_names = tuple(label_names)
+        self.metric_type = metric_type
+
+    def render(self) -> list:
+        """Get lines of the metric in text format"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            if value is None:
+                continue
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}")
+
+        return lines
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name: str, documentation: str, label_names: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        """Create and register a histogram"""
+        histogram = Histogram(name, documentation, label_names, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def gauge(self, name: str, documentation: str, function, label_names: tuple = (),
+              metric_type: str = 'gauge') -> Gauge:
+        """Create and register a metric read on scrape"""
+        gauge = Gauge(name, documentation, function, label_names, metric_type)
+        self.metrics.append(gauge)
+        return gauge
+
+    def render(self) -> str:
+        """Get all metrics in prometheus text format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+def resident_memory_bytes() -> int:
+    """Get resident memory of the process, peak resident memory where /proc is missing"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
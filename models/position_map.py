@@ -0,0 +1,62 @@
+"""Stored positions of image ids in an IDMap index, kept up to date by insertions"""
+__author__ = "Vitali Muladze"
+
+import numpy
+
+# Appended positions are matched by a scan until more than this many are merged into the sorted ones
+MERGE_SIZE = 65536
+
+
+class PositionMap:
+    def __init__(self, position_ids: numpy.ndarray):
+        """
+        Image ids sorted with their stored positions, positions appended later are kept apart
+        until there are enough of them to be worth merging in
+        :param position_ids: int64 image ids by stored position
+        """
+        order = numpy.argsort(position_ids, kind='stable')
+        self.sorted_ids = position_ids[order]
+        self.sorted_positions = order.astype(numpy.int64)
+        self._added_ids = numpy.empty(0, dtype=numpy.int64)
+        self._added_positions = numpy.empty(0, dtype=numpy.int64)
+
+    def add(self, id_array: numpy.ndarray, first_position: int) -> None:
+        """
+        Take over ids appended to the index, the caller holds the index lock for writing
+        :param id_array: int64 image ids
+        :param first_position: stored position of the first of them
+        """
+        self._added_ids = numpy.concatenate([self._added_ids, id_array])
+        self._added_positions = numpy.concatenate(
+            [self._added_positions, numpy.arange(first_position, first_position + id_array.shape[0])])
+        if self._added_ids.shape[0] > MERGE_SIZE:
+            order = numpy.lexsort((self._added_positions, self._added_ids))
+            added_ids = self._added_ids[order]
+            # Appended positions follow the stored positions of the same id
+            places = numpy.searchsorted(self.sorted_ids, added_ids, side='right')
+            self.sorted_ids = numpy.insert(self.sorted_ids, places, added_ids)
+            self.sorted_positions = numpy.insert(self.sorted_positions, places, self._added_positions[order])
+            self._added_ids = numpy.empty(0, dtype=numpy.int64)
+            self._added_positions = numpy.empty(0, dtype=numpy.int64)
+
+    def lookup(self, id_array: numpy.ndarray) -> tuple:
+        """
+        Find every stored position of the ids, dead ones included
+        :param id_array: unique int64 image ids
+        :return: int64 numbers of the ids in id_array and their positions
+        """
+        left = numpy.searchsorted(self.sorted_ids, id_array, side='left')
+        counts = numpy.searchsorted(self.sorted_ids, id_array, side='right') - left
+        rows = numpy.repeat(numpy.arange(id_array.shape[0]), counts)
+        # Offsets of every match within the range of its id
+        offsets = numpy.arange(rows.shape[0]) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        positions = self.sorted_positions[numpy.repeat(left, counts) + offsets]
+        if not self._added_ids.shape[0] or not id_array.shape[0]:
+            return rows, positions
+        # Appended positions are few, they are matched against the sorted ids instead of being sorted
+        order = numpy.argsort(id_array)
+        places = numpy.minimum(numpy.searchsorted(id_array[order], self._added_ids), id_array.shape[0] - 1)
+        added = id_array[order[places]] == self._added_ids
+
+        return (numpy.concatenate([rows, order[places[added]]]),
+                numpy.concatenate([positions, self._added_positions[added]]))
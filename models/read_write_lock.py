@@ -0,0 +1,112 @@
+"""Reader-writer lock letting searches run in parallel while writes are exclusive"""
+__author__ = "Vitali Muladze"
+
+import threading
+
+
+class ReadLock:
+    """Context manager taking the lock for reading"""
+
+    def __init__(self, lock, long: bool = False):
+        self.lock = lock
+        self.long = long
+
+    def __enter__(self):
+        self.lock.acquire_read(self.long)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release_read()
+
+
+class ReadWriteLock:
+    def __init__(self):
+        """
+        Lock held by many readers or one writer, waiting writers go before new readers
+        so a stream of searches can't starve writes. Both sides are reentrant
+        and the writer may also read, a reader can't become a writer.
+        Used as a context manager it is taken for writing, read() takes it for reading
+        and long_read() for reads of the whole index which new readers don't wait for.
+        """
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        # Readers like checkpoints which hold the lock for seconds, waiting writers wait for them anyway
+        self._long_readers = 0
+        self._waiting_writers = 0
+        self._writer = None
+        self._writer_depth = 0
+        # Read depth of each thread for reentrant reads
+        self._local = threading.local()
+        self._read_lock = ReadLock(self)
+        self._long_read_lock = ReadLock(self, long=True)
+
+    def read(self) -> ReadLock:
+        """Get the context manager taking the lock for reading"""
+        return self._read_lock
+
+    def long_read(self) -> ReadLock:
+        """Get the context manager taking the lock for a long read, new readers don't queue behind writers meanwhile"""
+        return self._long_read_lock
+
+    def acquire_read(self, long: bool = False) -> None:
+        """
+        Wait until there is no writer, nested reads of a thread don't wait
+        :param long: the read holds the lock long, writers waiting meanwhile don't hold up new readers
+        """
+        depth = getattr(self._local, 'depth', 0)
+        if depth or self._writer == threading.get_ident():
+            self._local.depth = depth + 1
+            return
+        with self._condition:
+            # A waiting writer waits for a long reader anyway, blocking new readers would stall them for as long
+            while self._writer is not None or (self._waiting_writers and not self._long_readers):
+                self._condition.wait()
+            self._readers += 1
+            self._long_readers += long
+        self._local.depth = 1
+        self._local.long = long
+
+    def release_read(self) -> None:
+        depth = self._local.depth - 1
+        self._local.depth = depth
+        # Nested reads and reads of the writer don't count as readers
+        if depth or self._writer == threading.get_ident():
+            return
+        with self._condition:
+            self._readers -= 1
+            self._long_readers -= self._local.long
+            if not self._readers:
+                self._condition.notify_all()
+
+    def acquire_write(self) -> None:
+        """Wait until readers and the other writer are done"""
+        thread = threading.get_ident()
+        if self._writer == thread:
+            self._writer_depth += 1
+            return
+        if getattr(self._local, 'depth', 0):
+            raise RuntimeError("A reader can't take the lock for writing")
+        with self._condition:
+            self._waiting_writers += 1
+            try:
+                while self._readers or self._writer is not None:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = thread
+            self._writer_depth = 1
+
+    def release_write(self) -> None:
+        self._writer_depth -= 1
+        if self._writer_depth:
+            return
+        with self._condition:
+            self._writer = None
+            self._condition.notify_all()
+
+    def __enter__(self):
+        self.acquire_write()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release_write()
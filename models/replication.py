@@ -0,0 +1,271 @@
+"""Replication of the index from a primary to read-only replicas through the ordered stream of its writes"""
+__author__ = "Vitali Muladze"
+
+import collections
+import itertools
+import threading
+import time
+import uuid
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import faiss
+import numpy
+
+from models.faiss_database import FaissIndex
+from source.configuration import messages
+
+# Seconds between heartbeats which carry the primary sequence to idle replicas
+HEARTBEAT_INTERVAL = 1.0
+# Replicas which heard nothing for this many heartbeats connect again
+MISSED_HEARTBEATS = 5
+# Writes sent to a replica in one message
+MAX_RECORDS_PER_MESSAGE = 1024
+
+
+def parse_address(address: str) -> tuple:
+    """
+    Split a host:port address
+    :param address: address e.g. 127.0.0.1:7070, the host defaults to localhost
+    :return: host and port
+    """
+    host, _, port = address.rpartition(':')
+
+    return host or '127.0.0.1', int(port)
+
+
+class ReplicationPrimary:
+    def __init__(self, faiss_index: FaissIndex, address: str, authkey: bytes, backlog_bytes: int = 256 * 2 ** 20):
+        """
+        Number every write applied to the index and stream the writes to replicas,
+        replicas which are new or fell behind the kept writes get a snapshot of the index first
+        :param faiss_index: index which takes the writes
+        :param address: host:port to listen for replicas on
+        :param authkey: key replicas authenticate with
+        :param backlog_bytes: memory of the latest writes kept for replicas which catch up
+        """
+        self.faiss_index = faiss_index
+        self.address = address
+        self.authkey = authkey
+        self.backlog_bytes = backlog_bytes
+        # Replicas of an earlier process of the primary bootstrap again
+        self.stream_id = uuid.uuid4().hex
+        self.sequence = 0
+        self.replicas = 0
+        self.snapshots = 0
+        # Latest writes as (sequence, operation, image ids, vectors) in order of their sequence
+        self._backlog = collections.deque()
+        self._backlog_size = 0
+        self._condition = threading.Condition()
+        self._listener = None
+        faiss_index.mutation_listeners.append(self._record)
+
+    def _record(self, operation: int, id_array: numpy.ndarray, vector_array: numpy.ndarray or None) -> None:
+        """Number a write applied to the index, called with its lock held so numbers follow the order of writes"""
+        # Vectors of binary requests are views of the request body
+        vector_array = vector_array.copy() if vector_array is not None else None
+        with self._condition:
+            self.sequence += 1
+            self._backlog.append((self.sequence, operation, id_array.copy(), vector_array))
+            self._backlog_size += id_array.nbytes + (vector_array.nbytes if vector_array is not None else 0)
+            while self._backlog_size > self.backlog_bytes and len(self._backlog) > 1:
+                _, _, old_ids, old_vectors = self._backlog.popleft()
+                self._backlog_size -= old_ids.nbytes + (old_vectors.nbytes if old_vectors is not None else 0)
+            self._condition.notify_all()
+
+    def start(self) -> None:
+        """Listen for replicas, they are served once the index is loaded"""
+        self._listener = Listener(parse_address(self.address), authkey=self.authkey)
+        threading.Thread(target=self._accept, name='ReplicationPrimary', daemon=True).start()
+
+    def _accept(self) -> None:
+        """Serve every replica in its own thread"""
+        # Snapshots of an index which is still loading would be empty
+        self.faiss_index.loader.ready.wait()
+        while True:
+            try:
+                connection = self._listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                continue
+            threading.Thread(target=self._stream, args=(connection,), name='ReplicationStream', daemon=True).start()
+
+    def _stream(self, connection) -> None:
+        """
+        Send writes following the sequence a replica asks for, a snapshot if they are not kept
+        :param connection: replica connection
+        """
+        with self._condition:
+            self.replicas += 1
+        try:
+            with connection:
+                stream_id, sequence = connection.recv()
+                if stream_id != self.stream_id:
+                    sequence = None
+                while True:
+                    with self._condition:
+                        self._condition.wait_for(lambda: self.sequence != sequence, HEARTBEAT_INTERVAL)
+                        oldest = self._backlog[0][0] if self._backlog else self.sequence + 1
+                        behind = sequence is None or sequence + 1 < oldest
+                        records = [] if behind else list(itertools.islice(
+                            self._backlog, sequence + 1 - oldest, sequence + 1 - oldest + MAX_RECORDS_PER_MESSAGE))
+                        primary_sequence = self.sequence
+                    if behind:
+                        sequence = self._send_snapshot(connection)
+                        continue
+                    connection.send(('records', primary_sequence, records))
+                    if records:
+                        sequence = records[-1][0]
+        except (OSError, EOFError):
+            return
+        finally:
+            with self._condition:
+                self.replicas -= 1
+
+    def _send_snapshot(self, connection) -> int:
+        """
+        Send the index with the sequence of the last write it contains
+        :param connection: replica connection
+        :return: sequence of the snapshot
+        """
+        # Writes wait only while the index is serialized, not while it is sent, searches go on
+        with self.faiss_index.lock.long_read():
+            index_array = faiss.serialize_index(self.faiss_index.index)
+            state = {"stream_id": self.stream_id, "tombstones": self.faiss_index.tombstones,
+                     "dead_bitmap": self.faiss_index.dead_bitmap.copy()}
+            sequence = self.sequence
+        connection.send(('snapshot', sequence, state))
+        connection.send_bytes(index_array)
+        self.snapshots += 1
+
+        return sequence
+
+    def status(self) -> dict:
+        """Get the sequence of the last write and the connected replicas"""
+        return {"role": "primary", "address": self.address, "stream_id": self.stream_id,
+                "sequence": self.sequence, "replicas": self.replicas, "snapshots": self.snapshots,
+                "backlog_writes": len(self._backlog), "backlog_bytes": self._backlog_size}
+
+
+class ReplicaFaissIndex(FaissIndex):
+    def __init__(self, dimension: int, index_factory: str, primary_address: str, authkey: bytes,
+                 tombstones: bool = False):
+        """
+        Read-only copy of the index of a primary, bootstrapped from its snapshot and following its writes,
+        it is not ready until it caught up with the primary
+        :param dimension: dimension of vector
+        :param index_factory: faiss factory string of the index until the snapshot replaces it
+        :param primary_address: host:port of the primary
+        :param authkey: key to authenticate to the primary
+        :param tombstones: mask removed and overwritten vectors, taken over from the primary with the snapshot
+        """
+        super().__init__(None, dimension, index_factory, tombstones)
+        self.primary_address = primary_address
+        self.authkey = authkey
+        self.stream_id = None
+        # Sequence of the last applied write and the latest sequence heard of the primary
+        self.sequence = 0
+        self.primary_sequence = 0
+        self.snapshots = 0
+        self.connected = False
+        self.last_contact = None
+        # Sequences of the primary not applied yet with the time they were heard of
+        self._behind = collections.deque()
+        self.loader.ready.clear()
+        self.loader.stage = 'replicating'
+        self.loader.started = time.time()
+        threading.Thread(target=self._replicate, name='Replica', daemon=True).start()
+
+    @property
+    def lag_writes(self) -> int:
+        """Get number of writes of the primary not applied yet"""
+        return max(self.primary_sequence - self.sequence, 0)
+
+    @property
+    def lag_seconds(self) -> float:
+        """Get seconds since the oldest write which is not applied yet was heard of"""
+        try:
+            return time.time() - self._behind[0][1]
+        except IndexError:
+            return 0.0
+
+    def _replicate(self) -> None:
+        """Follow the primary, connecting again whenever the connection is lost"""
+        primary_address = parse_address(self.primary_address)
+        while True:
+            try:
+                with Client(primary_address, authkey=self.authkey) as connection:
+                    connection.send((self.stream_id, self.sequence))
+                    self.connected = True
+                    while connection.poll(HEARTBEAT_INTERVAL * MISSED_HEARTBEATS):
+                        kind, primary_sequence, payload = connection.recv()
+                        self.last_contact = time.time()
+                        self._heard(primary_sequence)
+                        if kind == 'snapshot':
+                            self._apply_snapshot(primary_sequence, payload, connection.recv_bytes())
+                        else:
+                            self._apply_records(payload)
+                        self._behind_until(self.sequence)
+                        if not self.loader.ready.is_set() and self.sequence >= primary_sequence:
+                            self.loader.seconds = time.time() - self.loader.started
+                            self.loader.stage = 'ready'
+                            self.loader.ready.set()
+            except (OSError, EOFError, AuthenticationError):
+                pass
+            self.connected = False
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    def _heard(self, primary_sequence: int) -> None:
+        """Remember when a sequence of the primary was first heard of"""
+        if primary_sequence > self.primary_sequence:
+            self._behind.append((primary_sequence, time.time()))
+            self.primary_sequence = primary_sequence
+
+    def _behind_until(self, sequence: int) -> None:
+        """Forget sequences of the primary which are applied"""
+        while self._behind and self._behind[0][0] <= sequence:
+            self._behind.popleft()
+
+    def _apply_snapshot(self, sequence: int, state: dict, index_bytes: bytes) -> None:
+        """Replace the index with a snapshot of the primary"""
+        index = faiss.deserialize_index(numpy.frombuffer(index_bytes, dtype=numpy.uint8))
+        # Searches see the snapshot with its dead vectors at once
+        with self.lock:
+            self._tombstones_requested = state["tombstones"]
+            self.replace_index(index)
+            self.restore_dead_bitmap(state["dead_bitmap"])
+            self.stream_id = state["stream_id"]
+            self.sequence = self.primary_sequence = sequence
+            self._behind.clear()
+        self.snapshots += 1
+
+    def _apply_records(self, records: list) -> None:
+        """Apply writes of the primary in their order"""
+        for sequence, operation, id_array, vector_array in records:
+            with self.lock:
+                self.apply_log_record(operation, id_array, vector_array)
+                self.sequence = sequence
+
+    def status(self) -> dict:
+        """Get the applied sequence and the lag behind the primary"""
+        return {"role": "replica", "primary_address": self.primary_address, "connected": self.connected,
+                "stream_id": self.stream_id, "sequence": self.sequence, "primary_sequence": self.primary_sequence,
+                "lag_writes": self.lag_writes, "lag_seconds": self.lag_seconds, "snapshots": self.snapshots,
+                "seconds_since_contact": time.time() - self.last_contact if self.last_contact else None}
+
+    def insert(self, features_vectors: list or numpy.ndarray, image_ids: list or numpy.ndarray or None = None,
+               is_updating: bool = False, **key_arguments) -> list or str:
+        return messages.READ_ONLY_REPLICA
+
+    def update(self, features_vectors: list or numpy.ndarray, image_ids: list or numpy.ndarray or None = None,
+               **key_arguments) -> list or str:
+        return messages.READ_ONLY_REPLICA
+
+    def delete(self, image_ids: list or numpy.ndarray or None = None, **key_arguments) -> list or str:
+        return messages.READ_ONLY_REPLICA
+
+    def train(self, features_vectors: list or numpy.ndarray) -> int or str:
+        return messages.READ_ONLY_REPLICA
+
+    def to_disk(self, index_path: str) -> str:
+        """The primary owns the index file, replicas bootstrap from it again"""
+        return messages.OK
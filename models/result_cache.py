@@ -0,0 +1,134 @@
+"""Cache of search results invalidated by index generation"""
+__author__ = "Vitali Muladze"
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy
+
+from models.faiss_database import FaissIndex
+
+# Approximate memory taken by a cache entry besides its arrays
+ENTRY_OVERHEAD = 200
+
+
+class ResultCache:
+    def __init__(self, searcher, index: FaissIndex, max_bytes: int):
+        """
+        Bounded LRU cache of search results of single query vectors
+        :param searcher: object with search method to run on cache misses e.g. batcher or index
+        :param index: index whose generation invalidates the cache
+        :param max_bytes: memory cap of cached results, 0 disables the cache
+        """
+        self.searcher = searcher
+        self.index = index
+        self.max_bytes = max_bytes
+        self.generation = None
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def search(self, features_vectors: list or numpy.ndarray, n_results: int = 10,
+               **search_knobs) -> tuple or str:
+        """
+        Search similarities for features vectors, repeated query vectors are served from the cache
+        :param features_vectors: features vectors as lists or float32 matrix
+        :param n_results: number of results
+        :param search_knobs: per-request search parameters e.g. nprobe, ef_search
+        :return: indices of the results and distances sorted increasingly or error status
+        """
+        # Check that vector dimension is same as index dimension
+        vector_array = self.index.to_vector_array(features_vectors)
+        if isinstance(vector_array, str):
+            return vector_array
+        if self.max_bytes <= 0 or not vector_array.shape[0]:
+            return self.searcher.search(vector_array, n_results=n_results, **search_knobs)
+        # Generation is read before searching, results of a concurrent write are never cached as new
+        self.index.refresh()
+        generation = self.index.generation
+        # Same vector with other number of results or knobs is another entry
+        key_hash = hashlib.blake2b(repr((n_results, sorted(search_knobs.items()))).encode(), digest_size=16)
+        keys = []
+        for row in vector_array:
+            row_hash = key_hash.copy()
+            row_hash.update(row)
+            keys.append(row_hash.digest())
+        cached = self._get_many(keys, generation)
+        missing_rows = [row for row, result in enumerate(cached) if result is None]
+        if missing_rows:
+            result_or_status_message = self.searcher.search(vector_array[missing_rows],
+                                                            n_results=n_results, **search_knobs)
+            if isinstance(result_or_status_message, str):
+                return result_or_status_message
+            result_indices, distances = result_or_status_message
+            for position, row in enumerate(missing_rows):
+                # Copies don't keep the whole batch result alive
+                cached[row] = (result_indices[position].copy(), distances[position].copy())
+            self._put_many([keys[row] for row in missing_rows],
+                           [cached[row] for row in missing_rows], generation)
+
+        return (numpy.stack([indices for indices, _ in cached]),
+                numpy.stack([distances for _, distances in cached]))
+
+    def _get_many(self, keys: list, generation: int) -> list:
+        """
+        Get cached results of query vectors
+        :param keys: hashes of query vectors
+        :param generation: current index generation
+        :return: list of results or None for misses
+        """
+        with self._lock:
+            self._check_generation(generation)
+            results = []
+            for key in keys:
+                result = self._entries.get(key)
+                if result is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                results.append(result)
+
+            return results
+
+    def _put_many(self, keys: list, results: list, generation: int) -> None:
+        """
+        Cache results of query vectors and evict least recently used ones over the memory cap
+        :param keys: hashes of query vectors
+        :param results: (indices, distances) of each query vector
+        :param generation: index generation the results were searched in
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            for key, result in zip(keys, results):
+                if key in self._entries:
+                    continue
+                self._entries[key] = result
+                self.size_bytes += self._entry_size(result)
+            while self.size_bytes > self.max_bytes and self._entries:
+                _, result = self._entries.popitem(last=False)
+                self.size_bytes -= self._entry_size(result)
+                self.evictions += 1
+
+    def _check_generation(self, generation: int) -> None:
+        """Drop all results when the index changed, the lock must be held"""
+        if generation != self.generation:
+            self._entries.clear()
+            self.size_bytes = 0
+            self.generation = generation
+
+    @staticmethod
+    def _entry_size(result: tuple) -> int:
+        """Approximate memory of a cached result"""
+        return result[0].nbytes + result[1].nbytes + ENTRY_OVERHEAD
+
+    def stats(self) -> dict:
+        """Get counters of the cache"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self._entries), "size_bytes": self.size_bytes,
+                "max_bytes": self.max_bytes, "generation": self.generation}
@@ -0,0 +1,163 @@
+"""Cross-request batching of searches in front of the faiss index"""
+__author__ = "Vitali Muladze"
+
+import queue
+import threading
+import time
+
+import numpy
+
+from models.faiss_database import FaissIndex, valid_n_results
+from models.metrics import MetricsRegistry, SIZE_BUCKETS
+from source.configuration import messages
+
+
+class PendingSearch:
+    """Search request waiting in the batching queue"""
+
+    def __init__(self, vector_array: numpy.ndarray, n_results: int, search_knobs: dict):
+        self.vector_array = vector_array
+        self.n_results = n_results
+        self.search_knobs = search_knobs
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class SearchBatcher:
+    def __init__(self, index: FaissIndex, max_wait_ms: float = 0, max_batch_size: int = 256,
+                 metrics: MetricsRegistry or None = None):
+        """
+        Collect searches of concurrent requests and run them as one batch
+        :param index: faiss index to search in
+        :param max_wait_ms: how long to wait for more queries, 0 disables batching
+        :param max_batch_size: maximum number of query vectors in one batch
+        :param metrics: registry of faiss call latency and batch sizes
+        """
+        self.index = index
+        self.metrics = metrics
+        if metrics is not None:
+            self.faiss_seconds = metrics.histogram(
+                'faiss_server_faiss_seconds', 'Latency of faiss search calls')
+            self.batch_vectors = metrics.histogram(
+                'faiss_server_batch_vectors', 'Query vectors per faiss search call', buckets=SIZE_BUCKETS)
+            self.batch_requests = metrics.histogram(
+                'faiss_server_batch_requests', 'Requests per faiss search call', buckets=SIZE_BUCKETS)
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue()
+        # Number of callers currently waiting for results
+        self.in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        if self.max_wait > 0:
+            threading.Thread(target=self._run, name='SearchBatcher', daemon=True).start()
+
+    def search(self, features_vectors: list or numpy.ndarray, n_results: int = 10,
+               **search_knobs) -> tuple or str:
+        """
+        Search similarities for features vectors within a shared batch
+        :param features_vectors: features vectors as lists or float32 matrix
+        :param n_results: number of results
+        :param search_knobs: per-request search parameters e.g. nprobe, ef_search
+        :return: indices of the results and distances sorted increasingly or error status
+        """
+        # A bad request must not fail the batch it would share
+        if not valid_n_results(n_results):
+            return messages.INVALID_N_RESULTS
+        # Search directly if batching is disabled
+        if self.max_wait <= 0:
+            return self._search(features_vectors, 1, n_results=n_results, **search_knobs)
+        # Check that vector dimension is same as index dimension
+        vector_array = self.index.to_vector_array(features_vectors)
+        if isinstance(vector_array, str):
+            return vector_array
+        pending = PendingSearch(vector_array, n_results, search_knobs)
+        with self._in_flight_lock:
+            self.in_flight += 1
+        try:
+            self.queue.put(pending)
+            pending.done.wait()
+        finally:
+            with self._in_flight_lock:
+                self.in_flight -= 1
+        if pending.error is not None:
+            raise pending.error
+
+        return pending.result
+
+    def _run(self) -> None:
+        """Collect pending searches for the batching window and execute them"""
+        while True:
+            batch = [self.queue.get()]
+            n_vectors = batch[0].vector_array.shape[0]
+            deadline = time.monotonic() + self.max_wait
+            # Waiting makes no sense when nobody else is searching
+            while n_vectors < self.max_batch_size and self.in_flight > len(batch):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(pending)
+                n_vectors += pending.vector_array.shape[0]
+            # Searches with different knobs can not share a faiss call
+            groups = {}
+            for pending in batch:
+                groups.setdefault(tuple(sorted(pending.search_knobs.items())), []).append(pending)
+            for group in groups.values():
+                self._execute(group)
+
+    def _execute(self, batch: list) -> None:
+        """
+        Run one search for the whole batch and hand each caller its slice
+        :param batch: pending searches with the same knobs
+        """
+        try:
+            n_results = max(pending.n_results for pending in batch)
+            if len(batch) == 1:
+                vector_array = batch[0].vector_array
+            else:
+                vector_array = numpy.concatenate([pending.vector_array for pending in batch])
+            result_or_status_message = self._search(vector_array, len(batch), n_results=n_results,
+                                                    **batch[0].search_knobs)
+            start = 0
+            for pending in batch:
+                if isinstance(result_or_status_message, str):
+                    pending.result = result_or_status_message
+                    continue
+                end = start + pending.vector_array.shape[0]
+                # Cut rows of the caller and its own number of results
+                pending.result = tuple(array[start:end, :pending.n_results]
+                                       for array in result_or_status_message)
+                start = end
+        except Exception as error:
+            if len(batch) > 1:
+                # Searched one by one, only the request which caused the error gets it
+                for pending in batch:
+                    self._execute([pending])
+                return
+            batch[0].error = error
+        finally:
+            for pending in batch:
+                pending.done.set()
+
+    def _search(self, features_vectors: list or numpy.ndarray, n_requests: int,
+                **search_arguments) -> tuple or str:
+        """
+        Search in the index and record latency and size of the call
+        :param features_vectors: features vectors of the call
+        :param n_requests: number of requests sharing the call
+        :param search_arguments: number of results and search knobs
+        :return: indices of the results and distances sorted increasingly or error status
+        """
+        if self.metrics is None:
+            return self.index.search(features_vectors, **search_arguments)
+        tok = time.perf_counter()
+        result_or_status_message = self.index.search(features_vectors, **search_arguments)
+        self.faiss_seconds.observe(time.perf_counter() - tok)
+        self.batch_vectors.observe(len(features_vectors))
+        self.batch_requests.observe(n_requests)
+
+        return result_or_status_message
@@ -0,0 +1,593 @@
+"""Faiss index split by image id across shards searched in parallel"""
+__author__ = "Vitali Muladze"
+
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client
+
+import faiss
+import numpy
+
+from models.cpu_scheduler import CpuScheduler
+from models.faiss_database import FaissIndex, sort_ranges, valid_n_results
+from models.write_ahead_log import TRAIN
+from source.configuration import messages
+
+SHARD_WORKER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                 "shard_worker.py")
+# Environment variable passing the connection key to the worker process
+SHARD_AUTHKEY_VARIABLE = "FAISS_SHARD_AUTHKEY"
+# Seconds to wait for a worker process to load its shard
+SHARD_START_TIMEOUT = 600
+
+
+def shard_path(index_path: str or None, shard: int) -> str or None:
+    """Path to the index file of a shard"""
+    return f"{index_path}.shard{shard}" if index_path is not None else None
+
+
+def serve_shard(connection, faiss_index: FaissIndex) -> None:
+    """
+    Answer calls of a ShardProcess until it disconnects
+    :param connection: connection to the parent process
+    :param faiss_index: index of the shard
+    """
+    while True:
+        try:
+            method, args, kwargs = connection.recv()
+        except (OSError, EOFError):
+            return
+        try:
+            if method == 'iterate_vectors':
+                # Chunks are streamed one by one and closed by None
+                for chunk in faiss_index.iterate_vectors(*args, **kwargs):
+                    connection.send(chunk)
+                result = None
+            else:
+                attribute = getattr(faiss_index, method)
+                result = attribute(*args, **kwargs) if callable(attribute) else attribute
+        except Exception as error:
+            result = error
+        connection.send(result)
+
+
+class ShardProcess:
+    def __init__(self, index_path: str or None, dimension: int, index_factory: str, omp_threads: int = 1,
+                 tombstones: bool = False, vectors_path: str or None = None, rerank_factor: int = 4):
+        """
+        Shard kept in a local worker process started with shard_worker.py, calls are forwarded to it
+        :param index_path: path to the index file of the shard
+        :param dimension: dimension of vector
+        :param index_factory: faiss factory string of a new index
+        :param omp_threads: threads of faiss in the worker process
+        :param tombstones: mask removed and overwritten vectors until compaction
+        :param vectors_path: file of full precision vectors of the shard for re-ranking
+        :param rerank_factor: candidates searched per requested result before re-ranking
+        """
+        self.dimension = dimension
+        self.address = os.path.join(tempfile.gettempdir(), f"faiss-shard-{uuid.uuid4().hex}.sock")
+        authkey = os.urandom(32)
+        # A new interpreter instead of multiprocessing, which would import the main module again
+        arguments = [sys.executable, SHARD_WORKER_PATH, self.address, "--dimension", str(dimension),
+                     "--index-factory", index_factory, "--omp-threads", str(omp_threads)]
+        if index_path is not None:
+            arguments += ["--index-path", index_path]
+        if tombstones:
+            arguments.append("--tombstones")
+        if vectors_path is not None:
+            arguments += ["--vectors-path", vectors_path, "--rerank-factor", str(rerank_factor)]
+        self.process = subprocess.Popen(arguments, env={**os.environ, SHARD_AUTHKEY_VARIABLE: authkey.hex()})
+        self._connection = self._connect(authkey)
+        self._lock = threading.Lock()
+
+    def _connect(self, authkey: bytes):
+        """
+        Wait until the worker process listens and connect to it
+        :param authkey: key to authenticate to the worker
+        :return: connection
+        """
+        deadline = time.monotonic() + SHARD_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Shard worker exited with code {self.process.returncode}")
+            try:
+                return Client(self.address, authkey=authkey)
+            except (FileNotFoundError, ConnectionRefusedError):
+                time.sleep(0.05)
+        self.process.kill()
+        raise RuntimeError("Shard worker did not start in time")
+
+    def _call(self, method: str, *args, **kwargs):
+        """
+        Call a FaissIndex method or read its attribute in the worker process
+        :param method: name of the method or attribute
+        :return: result of the method, exceptions are raised here
+        """
+        with self._lock:
+            self._connection.send((method, args, kwargs))
+            result = self._connection.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def __len__(self):
+        return self._call('__len__')
+
+    @property
+    def is_trained(self) -> bool:
+        return self._call('is_trained')
+
+    @property
+    def metric_type(self) -> int:
+        return self._call('metric_type')
+
+    @property
+    def dead_count(self) -> int:
+        return self._call('dead_count')
+
+    @property
+    def removable(self) -> bool:
+        return self._call('removable')
+
+    @property
+    def tombstones(self) -> bool:
+        return self._call('tombstones')
+
+    def next_free_id(self) -> int:
+        return self._call('next_free_id')
+
+    def train(self, features_vectors: numpy.ndarray) -> int or str:
+        return self._call('train', features_vectors)
+
+    def insert(self, features_vectors: numpy.ndarray, image_ids: numpy.ndarray,
+               is_updating: bool = False) -> list or str:
+        return self._call('insert', features_vectors, image_ids, is_updating=is_updating)
+
+    def update(self, features_vectors: numpy.ndarray, image_ids: numpy.ndarray) -> list or str:
+        return self._call('update', features_vectors, image_ids)
+
+    def delete(self, image_ids: numpy.ndarray) -> list or str:
+        return self._call('delete', image_ids)
+
+    def compact(self, min_dead_ratio: float = 0.0) -> int:
+        return self._call('compact', min_dead_ratio)
+
+    def apply_log_record(self, operation: int, id_array: numpy.ndarray,
+                         vector_array: numpy.ndarray or None) -> None:
+        return self._call('apply_log_record', operation, id_array, vector_array)
+
+    def search(self, features_vectors: numpy.ndarray, n_results: int = 10, **search_knobs) -> tuple or str:
+        return self._call('search', features_vectors, n_results, **search_knobs)
+
+    def range_search(self, features_vectors: numpy.ndarray, radius: float, **search_knobs) -> tuple or str:
+        return self._call('range_search', features_vectors, radius, **search_knobs)
+
+    def reconstruct(self, image_ids: numpy.ndarray) -> numpy.ndarray or str:
+        return self._call('reconstruct', image_ids)
+
+    def to_disk(self, index_path: str) -> str:
+        return self._call('to_disk', index_path)
+
+    def iterate_vectors(self, chunk_size: int = 65536):
+        """Read stored vectors of the shard chunk by chunk"""
+        with self._lock:
+            self._connection.send(('iterate_vectors', (chunk_size,), {}))
+            while True:
+                chunk = self._connection.recv()
+                if chunk is None:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+
+    def close(self) -> None:
+        """Stop the worker process, it exits when the connection is closed"""
+        self._connection.close()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class ShardedFaissIndex(FaissIndex):
+    def __init__(self, index_path: str or None, dimension: int, index_factory: str = 'IDMap,Flat',
+                 n_shards: int = 2, shard_processes: bool = False, tombstones: bool = False,
+                 load_in_background: bool = False, vectors_path: str or None = None, rerank_factor: int = 4,
+                 cpu_scheduler: CpuScheduler or None = None):
+        """
+        Index whose vectors are split by image id across shards,
+        searches go to all shards in parallel and their results are merged
+        :param index_path: path to the index file, shard number is appended for each shard
+        :param dimension: dimension of vector
+        :param index_factory: faiss factory string of new shards
+        :param n_shards: number of shards
+        :param shard_processes: keep each shard in its own worker process instead of this one
+        :param tombstones: mask removed and overwritten vectors until compaction
+        :param load_in_background: open the shards in a thread, there are none until loader.ready is set
+        :param vectors_path: file of full precision vectors, shard number is appended for each shard
+        :param rerank_factor: candidates searched per requested result before re-ranking
+        :param cpu_scheduler: threads of faiss calls of in-process shards and cores split by shard processes
+        """
+        # Dead vectors of the base class are counted over the shards
+        self.shards = []
+        # The index of the base class stays an empty placeholder, vectors live in the shards.
+        # Searches see a write to several shards whole, shards have their own locks too
+        super().__init__(None, dimension)
+        self.index_path = index_path
+        self.n_shards = n_shards
+        self._executor = ThreadPoolExecutor(max_workers=n_shards, thread_name_prefix='FaissShard')
+        self.cpu_scheduler = cpu_scheduler
+        self._metric_type = None
+        shard_options = {"tombstones": tombstones, "vectors_path": vectors_path, "rerank_factor": rerank_factor}
+        if load_in_background:
+            self.loader.start(self._open_shards, index_factory, shard_processes, shard_options)
+        else:
+            self._open_shards(index_factory, shard_processes, shard_options)
+
+    def _open_shards(self, index_factory: str, shard_processes: bool, shard_options: dict) -> None:
+        """
+        Load or create the shards
+        :param index_factory: faiss factory string of new shards
+        :param shard_processes: keep each shard in its own worker process
+        :param shard_options: tombstones, vectors path and rerank factor of the shards
+        """
+        vectors_path = shard_options["vectors_path"]
+        if shard_processes:
+            n_threads = self.cpu_scheduler.max_threads if self.cpu_scheduler else os.cpu_count() or 1
+            omp_threads = max(1, n_threads // self.n_shards)
+            # Worker processes load their shards at the same time
+            shards = list(self._executor.map(
+                lambda shard: ShardProcess(shard_path(self.index_path, shard), self.dimension, index_factory,
+                                           omp_threads, shard_options["tombstones"],
+                                           shard_path(vectors_path, shard), shard_options["rerank_factor"]),
+                range(self.n_shards)))
+        else:
+            index_paths = [shard_path(self.index_path, shard) for shard in range(self.n_shards)]
+            index_paths = [index_path if index_path is not None and os.path.isfile(index_path) else None
+                           for index_path in index_paths]
+            # Progress is counted over the files of all shards
+            self.loader.total_bytes += sum(os.path.getsize(index_path) for index_path in index_paths if index_path)
+            shards = []
+            for shard, index_path in enumerate(index_paths):
+                shard_index = FaissIndex(None, self.dimension, index_factory, shard_options["tombstones"],
+                                         vectors_path=shard_path(vectors_path, shard),
+                                         rerank_factor=shard_options["rerank_factor"])
+                # Shards searched at the same time split the threads of the worker
+                shard_index.cpu_scheduler = self.cpu_scheduler
+                if index_path is not None:
+                    with open(index_path, 'rb') as index_file:
+                        shard_index.replace_index(self.loader.read_index(index_file))
+                shards.append(shard_index)
+        self._metric_type = shards[0].metric_type
+        self.shards = shards
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    @property
+    def is_trained(self) -> bool:
+        return all(shard.is_trained for shard in self.shards)
+
+    @property
+    def metric_type(self) -> int:
+        return self._metric_type
+
+    @property
+    def dead_count(self) -> int:
+        return sum(shard.dead_count for shard in self.shards)
+
+    @dead_count.setter
+    def dead_count(self, dead_count: int) -> None:
+        """Shards count their own dead vectors, resets of the placeholder index are ignored"""
+
+    def next_free_id(self) -> int:
+        """Get the automatic image id following every id of all shards"""
+        return max(shard.next_free_id() for shard in self.shards)
+
+    def _route(self, id_array: numpy.ndarray, vector_array: numpy.ndarray) -> list:
+        """
+        Split ids and vectors by the shard owning each id
+        :param id_array: int64 image ids
+        :param vector_array: float32 features vectors, None for removals
+        :return: list of (shard, ids, vectors) of shards which got any
+        """
+        shard_numbers = id_array % self.n_shards
+        parts = []
+        for shard_number, shard in enumerate(self.shards):
+            mask = shard_numbers == shard_number
+            if mask.any():
+                parts.append((shard, id_array[mask], vector_array[mask] if vector_array is not None else None))
+
+        return parts
+
+    def _fan_out(self, calls: list) -> list:
+        """
+        Run calls on shards in parallel, faiss releases the GIL
+        :param calls: list of (function, args, kwargs)
+        :return: results in order of the calls
+        """
+        if len(calls) == 1:
+            function, args, kwargs = calls[0]
+            return [function(*args, **kwargs)]
+        futures = [self._executor.submit(function, *args, **kwargs) for function, args, kwargs in calls]
+
+        return [future.result() for future in futures]
+
+    @staticmethod
+    def _first_error(results: list) -> str or None:
+        """Get the first error status of shard results"""
+        return next((result for result in results if isinstance(result, str)), None)
+
+    def _check_shards(self, removes: bool) -> str or None:
+        """
+        Check that every shard accepts a write before any of them applies it,
+        a write refused by one shard would otherwise stay applied on the others
+        :param removes: the write removes or overwrites vectors
+        :return: error status or None
+        """
+        if not self.is_trained:
+            return messages.INDEX_NOT_TRAINED
+        if removes and not all(shard.tombstones or shard.removable for shard in self.shards):
+            return messages.REMOVE_NOT_SUPPORTED
+
+        return None
+
+    def train(self, features_vectors: list or numpy.ndarray) -> int or str:
+        """
+        Train every shard on the same sample
+        :param features_vectors: training sample as lists or float32 matrix
+        :return: number of training vectors or error status
+        """
+        # Writes go to the loaded index, not to its empty placeholder
+        if not self.loader.ready.is_set():
+            return messages.WARMING_UP
+        vector_array = self.to_vector_array(features_vectors)
+        if isinstance(vector_array, str):
+            return vector_array
+        with self.lock:
+            if len(self):
+                return messages.INDEX_NOT_EMPTY
+            results = self._fan_out([(shard.train, (vector_array,), {}) for shard in self.shards])
+            self.generation += 1
+
+        return self._first_error(results) or vector_array.shape[0]
+
+    def insert(self, features_vectors: list or numpy.ndarray,
+               image_ids: list or numpy.ndarray or None = None,
+               is_updating: bool = False) -> list or str:
+        """
+        Insert features vectors into the shards owning their ids
+        :param is_updating: If the insertion is due to update an index
+        :param features_vectors: features vectors as lists or float32 matrix
+        :param image_ids: image ids as list or int64 array
+        :return: inserted image ids or status of insertion
+        """
+        # Writes go to the loaded index, not to its empty placeholder
+        if not self.loader.ready.is_set():
+            return messages.WARMING_UP
+        vector_array = self.to_vector_array(features_vectors)
+        if isinstance(vector_array, str):
+            return vector_array
+        with self.lock:
+            n_total = len(self)
+            # If image_id is not specified
+            if image_ids is None:
+                next_id = self.next_free_id()
+                image_ids = numpy.arange(next_id, next_id + vector_array.shape[0])
+            id_array = numpy.ascontiguousarray(image_ids, dtype=numpy.int64)
+            # Check that for each vector there is an image id
+            if id_array.ndim != 1 or id_array.shape[0] != vector_array.shape[0]:
+                return messages.DIMENSION_MISMATCH
+            # Ids are checked against the whole index, shards hold only a part of it
+            if not is_updating and (id_array < n_total).any():
+                return messages.SMALLER_LENGTH_ERROR
+            status_message = self._check_shards(removes=False)
+            if status_message:
+                return status_message
+            results = self._fan_out([(shard.insert, (vectors, ids), {"is_updating": True})
+                                     for shard, ids, vectors in self._route(id_array, vector_array)])
+            self.generation += 1
+
+        return self._first_error(results) or id_array.tolist()
+
+    def update(self, features_vectors: list or numpy.ndarray,
+               image_ids: list or numpy.ndarray) -> list or str:
+        """
+        Update vectors in the shards owning their ids
+        :param image_ids: image id to change the value for
+        :param features_vectors: features vector
+        :return: updated image ids or status of update
+        """
+        # Writes go to the loaded index, not to its empty placeholder
+        if not self.loader.ready.is_set():
+            return messages.WARMING_UP
+        if image_ids is None:
+            return messages.NO_IDS_SPECIFIED
+        vector_array = self.to_vector_array(features_vectors)
+        if isinstance(vector_array, str):
+            return vector_array
+        id_array = numpy.ascontiguousarray(image_ids, dtype=numpy.int64)
+        if id_array.ndim != 1 or id_array.shape[0] != vector_array.shape[0]:
+            return messages.DIMENSION_MISMATCH
+        with self.lock:
+            status_message = self._check_shards(removes=True)
+            if status_message:
+                return status_message
+            results = self._fan_out([(shard.update, (vectors, ids), {})
+                                     for shard, ids, vectors in self._route(id_array, vector_array)])
+            self.generation += 1
+
+        return self._first_error(results) or id_array.tolist()
+
+    def delete(self, image_ids: list or numpy.ndarray) -> list or str:
+        """
+        Delete vectors of image ids from the shards owning them
+        :param image_ids: image ids as list or int64 array
+        :return: deleted image ids or status of deletion
+        """
+        # Writes go to the loaded index, not to its empty placeholder
+        if not self.loader.ready.is_set():
+            return messages.WARMING_UP
+        if image_ids is None:
+            return messages.NO_IDS_SPECIFIED
+        try:
+            id_array = numpy.ascontiguousarray(image_ids, dtype=numpy.int64)
+        except (ValueError, TypeError, OverflowError):
+            return messages.INVALID_IDS
+        if id_array.ndim != 1:
+            return messages.INVALID_IDS
+        with self.lock:
+            status_message = self._check_shards(removes=True)
+            if status_message:
+                return status_message
+            results = self._fan_out([(shard.delete, (ids,), {})
+                                     for shard, ids, _ in self._route(id_array, None)])
+            self.generation += 1
+
+        return self._first_error(results) or id_array.tolist()
+
+    def compact(self, min_dead_ratio: float = 0.0) -> int:
+        """
+        Remove dead vectors of shards whose own dead share crossed the threshold
+        :param min_dead_ratio: compact only shards with at least this share of dead vectors
+        :return: number of removed vectors
+        """
+        return sum(shard.compact(min_dead_ratio) for shard in self.shards)
+
+    def apply_log_record(self, operation: int, id_array: numpy.ndarray,
+                         vector_array: numpy.ndarray) -> None:
+        """
+        Apply a validated operation to the shards without logging it
+        :param operation: INSERT, UPDATE, REMOVE or TRAIN
+        :param id_array: int64 image ids
+        :param vector_array: float32 features vectors, None for removals
+        """
+        with self.lock:
+            if operation == TRAIN:
+                parts = [(shard, id_array, vector_array) for shard in self.shards]
+            else:
+                parts = self._route(id_array, vector_array)
+            self._fan_out([(shard.apply_log_record, (operation, ids, vectors), {})
+                           for shard, ids, vectors in parts])
+            self.generation += 1
+
+    def search(self, features_vectors: list or numpy.ndarray, n_results: int = 10,
+               **search_knobs) -> tuple or str:
+        """
+        Search all shards in parallel and merge their results into the global top results
+        :param features_vectors: features vectors as lists or float32 matrix
+        :param n_results: number of results
+        :param search_knobs: per-request search parameters e.g. nprobe, ef_search
+        :return: indices of the results and distances sorted increasingly or error status
+        """
+        if not valid_n_results(n_results):
+            return messages.INVALID_N_RESULTS
+        vector_array = self.to_vector_array(features_vectors)
+        if isinstance(vector_array, str):
+            return vector_array
+        with self.lock.read():
+            results = self._fan_out([(shard.search, (vector_array,), {"n_results": n_results, **search_knobs})
+                                     for shard in self.shards])
+        error = self._first_error(results)
+        if error:
+            return error
+        result_indices = numpy.hstack([indices for indices, _ in results])
+        distances = numpy.hstack([shard_distances for _, shard_distances in results])
+        # Missing results have -1 ids and the farthest possible distance, they sort last
+        sort_keys = -distances if self.metric_type == faiss.METRIC_INNER_PRODUCT else distances
+        order = numpy.argsort(sort_keys, axis=1, kind='stable')[:, :n_results]
+
+        return (numpy.take_along_axis(result_indices, order, axis=1),
+                numpy.take_along_axis(distances, order, axis=1))
+
+    def range_search(self, features_vectors: list or numpy.ndarray, radius: float,
+                     **search_knobs) -> tuple or str:
+        """
+        Search all shards in parallel for vectors within a radius and merge their results
+        :param features_vectors: features vectors as lists or float32 matrix
+        :param radius: L2 distances below or inner products above it are results
+        :param search_knobs: per-request search parameters e.g. nprobe, allow_ids
+        :return: lims, indices and distances of the results or error status,
+                 results of query i are at lims[i]:lims[i + 1] sorted from the closest
+        """
+        vector_array = self.to_vector_array(features_vectors)
+        if isinstance(vector_array, str):
+            return vector_array
+        with self.lock.read():
+            results = self._fan_out([(shard.range_search, (vector_array, radius), search_knobs)
+                                     for shard in self.shards])
+        error = self._first_error(results)
+        if error:
+            return error
+        n_queries = vector_array.shape[0]
+        # Results of every shard are grouped by query again
+        query_numbers = numpy.concatenate([numpy.repeat(numpy.arange(n_queries), numpy.diff(lims))
+                                           for lims, _, _ in results])
+        order = numpy.argsort(query_numbers, kind='stable')
+        lims = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(query_numbers, minlength=n_queries))])
+        result_indices = numpy.concatenate([indices for _, indices, _ in results])[order]
+        distances = numpy.concatenate([shard_distances for _, _, shard_distances in results])[order]
+
+        return sort_ranges(lims, result_indices, distances, self.metric_type)
+
+    def reconstruct(self, image_ids: list or numpy.ndarray) -> numpy.ndarray or str:
+        """
+        Get stored vectors of image ids from the shards owning them
+        :param image_ids: image ids as list or int64 array
+        :return: float32 matrix or error status if an id is not stored
+        """
+        try:
+            id_array = numpy.ascontiguousarray(image_ids, dtype=numpy.int64)
+        except (ValueError, TypeError, OverflowError):
+            return messages.INVALID_IDS
+        if id_array.ndim != 1 or not id_array.shape[0]:
+            return messages.INVALID_IDS
+        shard_numbers = id_array % self.n_shards
+        masks = [shard_numbers == shard_number for shard_number in range(self.n_shards)]
+        parts = [(shard, mask) for shard, mask in zip(self.shards, masks) if mask.any()]
+        with self.lock.read():
+            results = self._fan_out([(shard.reconstruct, (id_array[mask],), {}) for shard, mask in parts])
+        error = self._first_error(results)
+        if error:
+            return error
+        vector_array = numpy.empty((id_array.shape[0], self.dimension), dtype=numpy.float32)
+        for (_, mask), vectors in zip(parts, results):
+            vector_array[mask] = vectors
+
+        return vector_array
+
+    def iterate_vectors(self, chunk_size: int = 65536):
+        """
+        Read stored vectors of all shards chunk by chunk
+        :param chunk_size: number of vectors in a chunk
+        :return: generator of (int64 image ids, float32 features vectors)
+        """
+        for shard in self.shards:
+            yield from shard.iterate_vectors(chunk_size)
+
+    def to_disk(self, index_path: str) -> str:
+        """
+        Write every shard next to the index path
+        :param index_path: Path to the index file, shard number is appended for each shard
+        :return: status if writing
+        """
+        # The placeholder of an index which is still loading must not replace its file
+        if not self.loader.ready.is_set():
+            return messages.WARMING_UP
+        # Shards are written one by one, the thread pool is already stopped at process exit
+        results = [shard.to_disk(shard_path(index_path, shard_number))
+                   for shard_number, shard in enumerate(self.shards)]
+
+        return next((result for result in results if result != messages.OK), messages.OK)
+
+    def close(self) -> None:
+        """Stop worker processes of the shards"""
+        for shard in self.shards:
+            if isinstance(shard, ShardProcess):
+                shard.close()
@@ -0,0 +1,251 @@
+"""Faiss index shared by all workers of a host through a memory mapped file"""
+__author__ = "Vitali Muladze"
+
+import os
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import faiss
+import numpy
+
+from models.faiss_database import FaissIndex
+from source.configuration import messages
+
+# Faiss flags to map the index file read-only instead of reading it to memory
+MMAP_FLAGS = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+# Methods which readers are allowed to forward to the writer
+WRITER_METHODS = ('insert', 'update', 'delete', 'train')
+# Publishing waits at least this many times as long as the last publish took, so writes of a large index
+# spend most of the time applied rather than waiting for the file
+PUBLISH_BACKOFF = 10
+
+
+def generation_pointer_path(index_path: str) -> str:
+    """Path to the file which holds the current generation number"""
+    return f"{index_path}.generation"
+
+
+def generation_path(index_path: str, generation: int) -> str:
+    """Path to the index file of a generation"""
+    return f"{index_path}.{generation}"
+
+
+def read_generation(index_path: str) -> int:
+    """
+    Read the current generation number
+    :param index_path: path to the index file
+    :return: generation number, 0 if nothing was published yet
+    """
+    try:
+        with open(generation_pointer_path(index_path)) as pointer:
+            return int(pointer.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def latest_index_path(index_path: str) -> str:
+    """
+    Get the path of the latest published generation
+    :param index_path: path to the index file
+    :return: path of the latest generation or the index file if nothing was published
+    """
+    generation = read_generation(index_path)
+
+    return generation_path(index_path, generation) if generation else index_path
+
+
+class SharedFaissIndex(FaissIndex):
+    def __init__(self, index_path: str, dimension: int, writer_address: str, authkey: bytes):
+        """
+        Read-only view of the index published by the writer process,
+        insertions and updates are forwarded to the writer
+        :param index_path: path to the index file
+        :param dimension: dimension of vector
+        :param writer_address: unix socket of the writer process
+        :param authkey: key to authenticate to the writer
+        """
+        # Published generations are compacted by the writer, workers don't re-rank and have no keys.
+        # Mapping a generation is cheap, the index is ready at once
+        super().__init__(None, dimension)
+        self.index_path = index_path
+        self.writer_address = writer_address
+        self.authkey = authkey
+        self.generation = None
+        self._pointer_stat = None
+        self._connection = None
+        self._connection_lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Map the latest published generation if it changed"""
+        try:
+            pointer_stat = os.stat(generation_pointer_path(self.index_path))
+        except FileNotFoundError:
+            return
+        # Cheap check on every call, the pointer file is replaced on each publish
+        stat_key = (pointer_stat.st_ino, pointer_stat.st_mtime_ns)
+        if stat_key == self._pointer_stat:
+            return
+        generation = read_generation(self.index_path)
+        if generation != self.generation:
+            # Pages of the file are shared through the page cache by all workers
+            self.index = faiss.read_index(generation_path(self.index_path, generation), MMAP_FLAGS)
+            self.generation = generation
+            self._id_positions = None
+        self._pointer_stat = stat_key
+
+    def __len__(self):
+        self.refresh()
+        return self.index.ntotal
+
+    def search(self, features_vectors: list or numpy.ndarray, n_results: int = 10,
+               **search_knobs) -> tuple or str:
+        self.refresh()
+        return super().search(features_vectors, n_results=n_results, **search_knobs)
+
+    def range_search(self, features_vectors: list or numpy.ndarray, radius: float,
+                     **search_knobs) -> tuple or str:
+        self.refresh()
+        return super().range_search(features_vectors, radius, **search_knobs)
+
+    def insert(self, features_vectors: list or numpy.ndarray,
+               image_ids: list or numpy.ndarray or None = None,
+               is_updating: bool = False) -> list or str:
+        return self._call_writer('insert', features_vectors=features_vectors,
+                                 image_ids=image_ids, is_updating=is_updating)
+
+    def update(self, features_vectors: list or numpy.ndarray,
+               image_ids: list or numpy.ndarray) -> list or str:
+        return self._call_writer('update', features_vectors=features_vectors, image_ids=image_ids)
+
+    def delete(self, image_ids: list or numpy.ndarray) -> list or str:
+        return self._call_writer('delete', image_ids=image_ids)
+
+    def compact(self, min_dead_ratio: float = 0.0) -> int:
+        """The writer process compacts the index"""
+        return 0
+
+    def train(self, features_vectors: list or numpy.ndarray) -> int or str:
+        return self._call_writer('train', features_vectors=features_vectors)
+
+    def to_disk(self, index_path: str) -> str:
+        """The writer process owns the index file"""
+        return messages.OK
+
+    def _call_writer(self, method: str, **kwargs) -> list or str:
+        """
+        Forward a mutation to the writer process
+        :param method: name of the FaissIndex method
+        :param kwargs: arguments of the method
+        :return: result of the method or error status
+        """
+        with self._connection_lock:
+            try:
+                if self._connection is None:
+                    self._connection = Client(self.writer_address, authkey=self.authkey)
+                self._connection.send((method, kwargs))
+                return self._connection.recv()
+            except (OSError, EOFError):
+                self._connection = None
+                return messages.WRITER_UNAVAILABLE
+
+
+class SharedIndexWriter:
+    def __init__(self, faiss_index: FaissIndex, index_path: str, writer_address: str,
+                 authkey: bytes, publish_interval: float = 1.0):
+        """
+        Process which owns mutations of the shared index and publishes its generations
+        :param faiss_index: index to mutate and publish
+        :param index_path: path to the index file
+        :param writer_address: unix socket to listen for mutations on
+        :param authkey: key readers authenticate with
+        :param publish_interval: seconds between publishing of changed index
+        """
+        self.faiss_index = faiss_index
+        self.index_path = index_path
+        self.writer_address = writer_address
+        self.authkey = authkey
+        self.publish_interval = publish_interval
+        self.generation = read_generation(index_path)
+        # Readers need a first generation to map
+        self.dirty = True
+
+    def serve_forever(self) -> None:
+        """Accept reader connections and publish the index periodically"""
+        threading.Thread(target=self._publish_periodically, name='IndexPublisher', daemon=True).start()
+        if os.path.exists(self.writer_address):
+            os.remove(self.writer_address)
+        with Listener(self.writer_address, authkey=self.authkey) as listener:
+            while True:
+                try:
+                    connection = listener.accept()
+                except (OSError, EOFError):
+                    continue
+                threading.Thread(target=self._serve_connection, args=(connection,), daemon=True).start()
+
+    def _serve_connection(self, connection) -> None:
+        """
+        Apply mutations sent by one reader
+        :param connection: reader connection
+        """
+        with connection:
+            while True:
+                try:
+                    method, kwargs = connection.recv()
+                except (OSError, EOFError):
+                    return
+                if method not in WRITER_METHODS:
+                    connection.send(messages.WRITER_UNAVAILABLE)
+                    continue
+                result_or_status_message = getattr(self.faiss_index, method)(**kwargs)
+                if not isinstance(result_or_status_message, str):
+                    self.dirty = True
+                connection.send(result_or_status_message)
+
+    def _publish_periodically(self) -> None:
+        """Publish the index whenever it changed, less often the longer publishing takes"""
+        delay = self.publish_interval
+        while True:
+            time.sleep(delay)
+            if self.dirty:
+                tik = time.time()
+                self.publish()
+                delay = max(self.publish_interval, PUBLISH_BACKOFF * (time.time() - tik))
+
+    def publish(self) -> int:
+        """
+        Write a new generation of the index and point readers to it
+        :return: published generation
+        """
+        # The placeholder of an index which is still loading is not published
+        if not self.faiss_index.loader.ready.is_set():
+            return self.generation
+        generation = self.generation + 1
+        path = generation_path(self.index_path, generation)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        while True:
+            # Dead vectors are compacted away before writing, readers get no tombstones
+            self.faiss_index.compact()
+            # Searches go on while the file is written, only writes wait for it
+            with self.faiss_index.lock.long_read():
+                # A write between compaction and writing may have left dead vectors again
+                if self.faiss_index.dead_count:
+                    continue
+                self.dirty = False
+                faiss.write_index(self.faiss_index.index, path + '.tmp')
+                break
+        os.replace(path + '.tmp', path)
+        # Switch the pointer atomically, readers map the new file on their next call
+        pointer_path = generation_pointer_path(self.index_path)
+        with open(pointer_path + '.tmp', 'w') as pointer:
+            pointer.write(str(generation))
+        os.replace(pointer_path + '.tmp', pointer_path)
+        # Keep the previous generation for readers which are opening it right now,
+        # mapped files stay valid after removal
+        stale_path = generation_path(self.index_path, generation - 2)
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+        self.generation = generation
+
+        return generation
@@ -0,0 +1,83 @@
+"""Cache of verified authorization tokens"""
+__author__ = "Vitali Muladze"
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# Snapshot of the user record, safe to share between requests and threads
+CachedUser = namedtuple('CachedUser', ['username', 'active'])
+
+
+class TokenCache:
+    def __init__(self, max_size: int = 10000, ttl: float = 60):
+        """
+        LRU cache of verified tokens with time to live
+        :param max_size: maximum number of cached tokens
+        :param ttl: seconds a verified token is trusted without checking the database
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._tokens = OrderedDict()
+        # Tokens of each user to invalidate them on user change
+        self._user_tokens = {}
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> CachedUser or None:
+        """
+        Get the user of a verified token
+        :param token: authorization token
+        :return: cached user or None if the token must be verified
+        """
+        with self._lock:
+            entry = self._tokens.get(token)
+            if entry is None:
+                return None
+            expires_at, user = entry
+            if expires_at <= time.time():
+                self._remove(token)
+                return None
+            self._tokens.move_to_end(token)
+
+            return user
+
+    def put(self, token: str, user: CachedUser, token_expiration: float or None = None) -> None:
+        """
+        Remember a verified token
+        :param token: authorization token
+        :param user: user of the token
+        :param token_expiration: expiration timestamp of the token itself
+        """
+        expires_at = time.time() + self.ttl
+        if token_expiration is not None:
+            expires_at = min(expires_at, token_expiration)
+        with self._lock:
+            self._remove(token)
+            self._tokens[token] = (expires_at, user)
+            self._user_tokens.setdefault(user.username, set()).add(token)
+            # Evict least recently used tokens
+            while len(self._tokens) > self.max_size:
+                self._remove(next(iter(self._tokens)))
+
+    def invalidate_user(self, username: str) -> None:
+        """
+        Forget all tokens of a user e.g. when the user is deactivated
+        :param username: username
+        """
+        with self._lock:
+            for token in list(self._user_tokens.get(username, ())):
+                self._remove(token)
+
+    def _remove(self, token: str) -> None:
+        """Remove a token, the lock must be held"""
+        entry = self._tokens.pop(token, None)
+        if entry is None:
+            return
+        tokens = self._user_tokens.get(entry[1].username)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._user_tokens[entry[1].username]
+
+    def __len__(self):
+        return len(self._tokens)
@@ -0,0 +1,143 @@
+"""Full precision features vectors kept on disk for exact re-ranking of compressed index results"""
+__author__ = "Vitali Muladze"
+
+import os
+import threading
+
+import numpy
+
+VECTOR_DTYPE = numpy.dtype('<f4')
+ID_DTYPE = numpy.dtype('<i8')
+
+
+def ids_path(vectors_path: str) -> str:
+    """Path to the image ids of the rows of a vectors file"""
+    return vectors_path + '.ids'
+
+
+class VectorStore:
+    def __init__(self, vectors_path: str, dimension: int):
+        """
+        Append-only file of float32 vectors with the image id of every row, read through a memory map,
+        pages of rows which are read stay in the page cache instead of the process memory
+        :param vectors_path: path to the vectors file, image ids are written next to it
+        :param dimension: dimension of vector
+        """
+        self.vectors_path = vectors_path
+        self.dimension = dimension
+        self.row_size = dimension * VECTOR_DTYPE.itemsize
+        os.makedirs(os.path.dirname(os.path.abspath(vectors_path)), exist_ok=True)
+        self._finish_rewrite()
+        self._vectors_file = open(vectors_path, 'ab')
+        self._ids_file = open(ids_path(vectors_path), 'ab')
+        # Rows written by a process which stopped during an append are dropped
+        self.n_rows = min(os.path.getsize(vectors_path) // self.row_size,
+                          os.path.getsize(ids_path(vectors_path)) // ID_DTYPE.itemsize)
+        self._vectors_file.truncate(self.n_rows * self.row_size)
+        self._ids_file.truncate(self.n_rows * ID_DTYPE.itemsize)
+        self._vectors = None
+        self._map_lock = threading.Lock()
+
+    def __len__(self):
+        return self.n_rows
+
+    def _finish_rewrite(self) -> None:
+        """Complete or drop a rewrite interrupted by a crash"""
+        temporary_path = self.vectors_path + '.tmp'
+        if not os.path.isfile(temporary_path):
+            return
+        if os.path.isfile(ids_path(temporary_path)):
+            # Neither file was replaced yet, the old files are whole
+            os.remove(temporary_path)
+            os.remove(ids_path(temporary_path))
+        else:
+            # Ids were replaced, the rewritten vectors were complete before that
+            os.replace(temporary_path, self.vectors_path)
+
+    def append(self, id_array: numpy.ndarray, vector_array: numpy.ndarray) -> numpy.ndarray:
+        """
+        Write vectors at the end of the file
+        :param id_array: int64 image ids
+        :param vector_array: float32 features vectors
+        :return: int64 rows of the vectors
+        """
+        self._vectors_file.write(numpy.ascontiguousarray(vector_array, dtype=VECTOR_DTYPE).tobytes())
+        self._ids_file.write(numpy.ascontiguousarray(id_array, dtype=ID_DTYPE).tobytes())
+        # Readers map the file again once they need the new rows
+        self._vectors_file.flush()
+        self._ids_file.flush()
+        rows = numpy.arange(self.n_rows, self.n_rows + id_array.shape[0], dtype=numpy.int64)
+        self.n_rows += id_array.shape[0]
+
+        return rows
+
+    def read(self, rows: numpy.ndarray) -> numpy.ndarray:
+        """
+        Read vectors of rows, only the pages of these rows are touched
+        :param rows: int64 rows
+        :return: float32 matrix
+        """
+        with self._map_lock:
+            if self._vectors is None or self._vectors.shape[0] < self.n_rows:
+                self._vectors = numpy.memmap(self.vectors_path, dtype=VECTOR_DTYPE, mode='r',
+                                             shape=(self.n_rows, self.dimension)) if self.n_rows else None
+            vectors = self._vectors
+        if vectors is None:
+            return numpy.empty((0, self.dimension), dtype=VECTOR_DTYPE)
+
+        return numpy.asarray(vectors[rows])
+
+    def holds(self, first_row: int, id_array: numpy.ndarray, vector_array: numpy.ndarray) -> bool:
+        """
+        Check that rows from first_row on hold exactly these image ids and vectors
+        :param first_row: first row compared
+        :param id_array: int64 image ids
+        :param vector_array: float32 features vectors
+        :return: True if every row matches
+        """
+        if first_row + id_array.shape[0] > self.n_rows:
+            return False
+        with open(ids_path(self.vectors_path), 'rb') as ids_file:
+            ids_file.seek(first_row * ID_DTYPE.itemsize)
+            row_ids = numpy.frombuffer(ids_file.read(id_array.shape[0] * ID_DTYPE.itemsize), dtype=ID_DTYPE)
+        if not numpy.array_equal(row_ids, id_array):
+            return False
+
+        return numpy.array_equal(self.read(numpy.arange(first_row, first_row + id_array.shape[0])), vector_array)
+
+    def row_ids(self) -> numpy.ndarray:
+        """Get a copy of the image id of every row"""
+        with open(ids_path(self.vectors_path), 'rb') as ids_file:
+            return numpy.frombuffer(ids_file.read(self.n_rows * ID_DTYPE.itemsize), dtype=ID_DTYPE).copy()
+
+    def rewrite(self, rows: numpy.ndarray, chunk_size: int = 65536) -> None:
+        """
+        Keep only the given rows in their order and drop the others from the files
+        :param rows: int64 rows to keep, row i of the new files is rows[i]
+        :param chunk_size: number of rows copied at once
+        """
+        row_ids = self.row_ids()
+        temporary_path = self.vectors_path + '.tmp'
+        with open(temporary_path, 'wb') as vectors_file, open(ids_path(temporary_path), 'wb') as ids_file:
+            for start in range(0, rows.shape[0], chunk_size):
+                chunk_rows = rows[start:start + chunk_size]
+                vectors_file.write(self.read(chunk_rows).tobytes())
+                ids_file.write(row_ids[chunk_rows].tobytes())
+            for rewritten_file in (vectors_file, ids_file):
+                rewritten_file.flush()
+                os.fsync(rewritten_file.fileno())
+        self._vectors_file.close()
+        self._ids_file.close()
+        with self._map_lock:
+            self._vectors = None
+        # Ids are replaced first, a crash before the vectors are replaced is finished on open
+        os.replace(ids_path(temporary_path), ids_path(self.vectors_path))
+        os.replace(temporary_path, self.vectors_path)
+        self._vectors_file = open(self.vectors_path, 'ab')
+        self._ids_file = open(ids_path(self.vectors_path), 'ab')
+        self.n_rows = rows.shape[0]
+
+    def close(self) -> None:
+        """Close the files, written rows are kept"""
+        self._vectors_file.close()
+        self._ids_file.close()
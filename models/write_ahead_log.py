@@ -0,0 +1,203 @@
+"""Append-only log of index mutations"""
+__author__ = "Vitali Muladze"
+
+import fcntl
+import os
+import struct
+import threading
+import time
+import zlib
+
+import numpy
+
+# Operations written to the log
+INSERT = 1
+UPDATE = 2
+REMOVE = 3
+TRAIN = 4
+
+# crc32, lsn, operation, number of ids, dimension of vectors
+RECORD_HEADER = struct.Struct('<IQBII')
+SEGMENT_SUFFIX = '.wal'
+LOCK_NAME = 'wal.lock'
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+class WriteAheadLog:
+    def __init__(self, path: str, fsync_policy: str = 'interval', fsync_interval_ms: float = 100):
+        """
+        Log of insertions, updates and removals split into segment files,
+        replay must be called once before appending
+        :param path: folder of the log segments
+        :param fsync_policy: 'always' to fsync before acknowledging a write (group commit),
+        'interval' to fsync in background every fsync_interval_ms, 'never' to leave it to the OS
+        :param fsync_interval_ms: milliseconds between background fsyncs
+        """
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync_policy}")
+        os.makedirs(path, exist_ok=True)
+        # Records of two owners would interleave and reuse lsns, the lock is held until close
+        self.lock_file = open(os.path.join(path, LOCK_NAME), 'w')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_file.close()
+            raise RuntimeError(f"Write-ahead log {path} is already open, only one process may own it")
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval_ms / 1000
+        self.last_lsn = 0
+        self.synced_lsn = 0
+        self.file = None
+        # Lock for appending and a separate one for fsync, so appends go on during fsync
+        self.lock = threading.Lock()
+        self.commit_lock = threading.Lock()
+        if fsync_policy == 'interval':
+            threading.Thread(target=self._sync_periodically, name='WalSync', daemon=True).start()
+
+    def segments(self) -> list:
+        """
+        Get the log segments sorted by their first lsn
+        :return: list of (first lsn, segment path)
+        """
+        segments = [(int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(self.path, name))
+                    for name in os.listdir(self.path) if name.endswith(SEGMENT_SUFFIX)]
+
+        return sorted(segments)
+
+    def append(self, operation: int, id_array: numpy.ndarray,
+               vector_array: numpy.ndarray or None = None) -> int:
+        """
+        Append an operation to the log, the record reaches the OS before returning
+        :param operation: INSERT, UPDATE, REMOVE or TRAIN
+        :param id_array: int64 image ids
+        :param vector_array: float32 features vectors, None for removals
+        :return: lsn of the record
+        """
+        if vector_array is None:
+            vector_array = numpy.empty((id_array.shape[0], 0), dtype=numpy.float32)
+        with self.lock:
+            lsn = self.last_lsn + 1
+            header = RECORD_HEADER.pack(0, lsn, operation, *vector_array.shape)[4:]
+            crc = zlib.crc32(vector_array, zlib.crc32(id_array, zlib.crc32(header)))
+            if self.file is None:
+                self.file = open(os.path.join(self.path, f"{lsn:020d}{SEGMENT_SUFFIX}"), 'ab')
+            self.file.write(struct.pack('<I', crc) + header)
+            self.file.write(id_array.data)
+            self.file.write(vector_array.data)
+            self.file.flush()
+            self.last_lsn = lsn
+
+        return lsn
+
+    def commit(self, lsn: int) -> None:
+        """
+        Wait until the record is durable if the policy asks for it,
+        one fsync covers all records appended before it
+        :param lsn: lsn of the record
+        """
+        if self.fsync_policy != 'always' or lsn <= self.synced_lsn:
+            return
+        with self.commit_lock:
+            if lsn > self.synced_lsn:
+                self._sync()
+
+    def sync(self) -> None:
+        """Fsync everything appended so far"""
+        with self.commit_lock:
+            self._sync()
+
+    def _sync(self) -> None:
+        """Fsync the current segment, commit lock must be held"""
+        with self.lock:
+            lsn = self.last_lsn
+            file = self.file
+        if file is not None:
+            os.fsync(file.fileno())
+        self.synced_lsn = max(self.synced_lsn, lsn)
+
+    def _sync_periodically(self) -> None:
+        """Fsync the log in background for the interval policy"""
+        while True:
+            time.sleep(self.fsync_interval)
+            if self.last_lsn > self.synced_lsn:
+                self.sync()
+
+    def rotate(self) -> int:
+        """
+        Close the current segment, next appends go to a new one
+        :return: last lsn in the closed segments
+        """
+        with self.commit_lock, self.lock:
+            if self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+            self.synced_lsn = self.last_lsn
+
+            return self.last_lsn
+
+    def truncate(self, lsn: int) -> None:
+        """
+        Remove segments which only hold records up to the lsn
+        :param lsn: lsn covered by a checkpoint
+        """
+        segments = self.segments()
+        for (_, path), (next_first_lsn, _) in zip(segments, segments[1:]):
+            if next_first_lsn - 1 <= lsn:
+                os.remove(path)
+        # The last segment is removed only if nothing is appended to it anymore
+        with self.lock:
+            if segments and self.file is None and self.last_lsn <= lsn:
+                os.remove(segments[-1][1])
+
+    def close(self) -> None:
+        """Fsync and close the current segment and give up the log"""
+        self.rotate()
+        self.lock_file.close()
+
+    def replay(self, after_lsn: int = 0):
+        """
+        Read records after the lsn, a torn record at the tail is cut off
+        :param after_lsn: lsn covered by the checkpoint
+        :return: generator of (lsn, operation, image ids, features vectors)
+        """
+        self.last_lsn = after_lsn
+        segments = self.segments()
+        for number, (_, path) in enumerate(segments):
+            is_last = number == len(segments) - 1
+            with open(path, 'rb') as segment:
+                segment_size = os.fstat(segment.fileno()).st_size
+                while True:
+                    offset = segment.tell()
+                    header = segment.read(RECORD_HEADER.size)
+                    if not header:
+                        break
+                    if len(header) == RECORD_HEADER.size:
+                        crc, lsn, operation, n_ids, dimension = RECORD_HEADER.unpack(header)
+                        ids_size = n_ids * 8
+                        payload_size = ids_size + n_ids * dimension * 4
+                        # A header which points past the end of the segment is torn
+                        if offset + RECORD_HEADER.size + payload_size > segment_size:
+                            payload_size = -1
+                        # Records covered by the checkpoint are skipped without reading them
+                        if 0 <= payload_size and lsn <= after_lsn:
+                            segment.seek(payload_size, os.SEEK_CUR)
+                            continue
+                        payload = segment.read(payload_size) if payload_size >= 0 else b''
+                        if (payload_size >= 0
+                                and zlib.crc32(payload, zlib.crc32(header[4:])) == crc):
+                            self.last_lsn = lsn
+                            yield (lsn, operation,
+                                   numpy.frombuffer(payload, dtype=numpy.int64, count=n_ids),
+                                   numpy.frombuffer(payload, dtype=numpy.float32,
+                                                    offset=ids_size).reshape(n_ids, dimension))
+                            continue
+                    if not is_last:
+                        raise ValueError(f"Write-ahead log segment {path} is corrupted at {offset}")
+                    # Cut the record which was being written during a crash
+                    break
+            if is_last:
+                os.truncate(path, offset)
+        self.synced_lsn = self.last_lsn
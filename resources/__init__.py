@@ -1,4 +1,12 @@
-from .auth import Register, Login
+from .auth import Register, Login, Activate
+from .bulk_insert import BulkInsert
+from .collections import Collections
+from .delete import Delete
+from .health import Liveness, Readiness
 from .insert import Insert
+from .metrics import Metrics
+from .rebuild import Rebuild
+from .replication import Replication
 from .search import Search
+from .train import Train
 from .update import Update
@@ -9,37 +9,98 @@ from jwt import encode
 from werkzeug.local import LocalProxy
 
 from apps import db
+from commons import admin_required
 from models.users import User
 from source.configuration import application_config
 
 logger = LocalProxy(lambda: current_app.logger)
 
 
+def register_user(username: str, password: str) -> dict or tuple:
+    """
+    Create a user, inactive until an administrator activates it unless ACTIVATE_USERS, needs an application context
+    :param username: username
+    :param password: password of at least 8 characters
+    :return: response body or http status code and message
+    """
+    # Check if password is short
+    if not isinstance(password, str) or len(password) < 8:
+        logger.info("username: %s tried to register with short password.", username)
+        return 401, 'Password too short.'
+    # Check if username is already taken
+    if User.query.get(username):
+        logger.info("username: %s tried to register with already taken username.", username)
+        return 402, 'Username already taken.'
+    # Create new user
+    new_user = User(username=username)
+    new_user.hash_password(password)
+    # Administrators activate the others, so they are active from the start
+    new_user.active = application_config.ACTIVATE_USERS or username in application_config.ADMIN_USERS
+    # Insert user into the database
+    db.session.add(new_user)
+    db.session.commit()
+    logger.info("username: %s registered for the service.", username)
+
+    return {'username': username}
+
+
+def login_user(username: str, password: str) -> dict or tuple:
+    """
+    Check the password and issue a token, needs an application context
+    :param username: username
+    :param password: password
+    :return: response body with the token or http status code and message
+    """
+    # Find specified username in database
+    user = User.query.get(username)
+    # If no user was found
+    if not user:
+        logger.info("username: %s tried to login with wrong username.", username)
+        return 404, 'User not found.'
+    # Verify the password
+    if not user.verify_password(password):
+        logger.info("username: %s tried to login with wrong password.", username)
+        return 406, 'Password incorrect.'
+    # Expiration date for each user
+    expiration_date = datetime.datetime.utcnow() + datetime.timedelta(hours=24 * 30)
+    # Encode user information to get a token, older pyjwt versions give bytes
+    token = encode({'username': username, 'exp': expiration_date},
+                   application_config.SECRET_KEY, algorithm='HS256')
+    token = token if isinstance(token, str) else token.decode('utf-8')
+    logger.info("username: %s logged in the system with token: %s.", username, token)
+
+    return {'username': username, 'token': token}
+
+
+def activate_user(username: str, active: bool) -> dict or tuple:
+    """
+    Activate or deactivate a user, cached tokens of the user are dropped, needs an application context
+    :param username: username
+    :param active: True to allow the user to use the service
+    :return: response body or http status code and message
+    """
+    if not isinstance(active, bool):
+        return 400, 'Active must be true or false.'
+    user = User.query.get(username)
+    if not user:
+        return 404, 'User not found.'
+    user.active = active
+    db.session.commit()
+    logger.info("username: %s was %s.", username, 'activated' if active else 'deactivated')
+
+    return {'username': username, 'active': active}
+
+
 class Register(Resource):
     """Register a user"""
 
     def post(self):
         # Get username and password from request
-        username = request.json.get('username')
-        password = request.json.get('password')
-        # Check if password is short
-        if len(password) < 8:
-            logger.info(f"username: {username} tried to register with short password.")
-            abort(http_status_code=401, message='Password too short.')
-        # Check if username is already taken
-        if User.query.get(username):
-            logger.info(f"username: {username} tried to register with already taken username.")
-            abort(http_status_code=402, message='Username already taken.')
-        # Create new user
-        new_user = User(username=username)
-        new_user.hash_password(password)
-        new_user.active = False
-        # Insert user into the database
-        db.session.add(new_user)
-        db.session.commit()
-        logger.info(f"username: {username} registered for the service.")
-
-        return {'username': username}
+        result_or_error = register_user(request.json.get('username'), request.json.get('password'))
+        if isinstance(result_or_error, tuple):
+            abort(http_status_code=result_or_error[0], message=result_or_error[1])
+
+        return result_or_error
 
 
 class Login(Resource):
@@ -47,23 +108,24 @@ class Login(Resource):
 
     def post(self):
         # Get username and password from request
-        username = request.json.get('username')
-        password = request.json.get('password')
-        # Find specified username in database
-        user = User.query.get(username)
-        # If no user was found
-        if not user:
-            logger.info(f"username: {username} tried to login with wrong username.")
-            abort(http_status_code=404, message='User not found.')
-        # Verify the password
-        if not user.verify_password(password):
-            logger.info(f"username: {username} tried to login with wrong password.")
-            abort(http_status_code=406, message='Password incorrect.')
-        # Expiration date for each user
-        expiration_date = datetime.datetime.utcnow() + datetime.timedelta(hours=24 * 30)
-        # Encode user information to get a token
-        encoded = encode({'username': username, 'exp': expiration_date},
-                         application_config.SECRET_KEY, algorithm='HS256')
-        logger.info(f"username: {username} logged in the system with token: {encoded.decode('utf-8')}.")
-
-        return {'username': username, 'token': encoded.decode('utf-8')}
+        result_or_error = login_user(request.json.get('username'), request.json.get('password'))
+        if isinstance(result_or_error, tuple):
+            abort(http_status_code=result_or_error[0], message=result_or_error[1])
+
+        return result_or_error
+
+
+class Activate(Resource):
+    """Activate or deactivate a user"""
+
+    @admin_required
+    def post(self):
+        # Get username and new state from request, users are activated unless told otherwise
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            body = {}
+        result_or_error = activate_user(body.get('username'), body.get('active', True))
+        if isinstance(result_or_error, tuple):
+            abort(http_status_code=result_or_error[0], message=result_or_error[1])
+
+        return result_or_error
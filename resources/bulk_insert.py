@@ -0,0 +1,48 @@
+"""Bulk insertion endpoints for applications"""
+__author__ = "Vitali Muladze"
+
+from flask import request, current_app
+from flask_restful import Resource, abort
+from werkzeug.local import LocalProxy
+
+from commons import collection_registry, login_required, request_collection
+from models.bulk_ingest import BulkIngest, NDJSON, NPY
+from source.configuration import files, faiss_configuration
+
+logger = LocalProxy(lambda: current_app.logger)
+
+# Stream formats by request mimetype
+STREAM_FORMATS = {"application/x-ndjson": NDJSON, "application/x-npy": NPY}
+
+
+class BulkInsert(Resource):
+    """
+    Stream vectors into faiss database chunk by chunk
+    """
+
+    @login_required
+    def put(self):
+        token = request.headers.get("Authorization")
+        # Resume the ingestion with the same id after its last committed chunk
+        ingest_id = request.args.get("ingest_id")
+        # Named collection or the default index
+        name = request.args.get("collection")
+        index = request_collection(name)
+        if type(index) == str:
+            abort(http_status_code=400, message=index)
+        # Index without write-ahead log is written where it is flushed to before its rows are committed
+        index_path = files.backup_index_path if name is None else collection_registry.specs[name].index_path
+        bulk_ingest = BulkIngest(index, files.bulk_progress_path,
+                                 faiss_configuration.bulk_chunk_size, progress=logger.info, index_path=index_path)
+        result_or_status_message = bulk_ingest.ingest(request.stream,
+                                                      STREAM_FORMATS.get(request.mimetype),
+                                                      ingest_id)
+        # Check if message was returned
+        if type(result_or_status_message) == str:
+            logger.info("token: %s send bulk insertion request with bad stream: %s.",
+                        token, result_or_status_message)
+            abort(http_status_code=400, message=result_or_status_message,
+                  committed_rows=bulk_ingest.committed_rows(ingest_id))
+
+        logger.info("token: %s bulk inserted %s rows.", token, result_or_status_message['rows'])
+        return result_or_status_message
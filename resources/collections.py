@@ -0,0 +1,18 @@
+"""Collections endpoints for applications"""
+__author__ = "Vitali Muladze"
+
+from flask_restful import Resource
+
+from commons import collection_registry, login_required
+
+
+class Collections(Resource):
+    """
+    List named collections with their settings and whether they are loaded
+    """
+
+    @login_required
+    def get(self):
+        return {"collections": collection_registry.status(),
+                "memory_bytes": collection_registry.memory_bytes,
+                "memory_budget_bytes": collection_registry.memory_budget_bytes}
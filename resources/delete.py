@@ -0,0 +1,39 @@
+"""Delete endpoints for applications"""
+__author__ = "Vitali Muladze"
+
+from flask import request, current_app
+from flask_restful import Resource, abort
+from werkzeug.local import LocalProxy
+from commons import key_arguments, login_required, request_collection
+from source.configuration import messages
+
+logger = LocalProxy(lambda: current_app.logger)
+
+
+class Delete(Resource):
+    """
+    Delete vectors from faiss database
+    """
+
+    @login_required
+    def post(self):
+        token = request.headers.get("Authorization")
+        # Check if image ids are specified
+        if not request.data or not (request.json.get("image_ids") or request.json.get("keys")):
+            logger.info("token: %s send delete request without ids.", token)
+            abort(http_status_code=400, message=messages.NO_IDS_SPECIFIED)
+        # Named collection or the default index
+        index = request_collection(request.json.get("collection", request.args.get("collection")))
+        if type(index) == str:
+            abort(http_status_code=400, message=index)
+        # String keys instead of image ids
+        keys_or_status_message = key_arguments(index, {"keys": request.json.get("keys")})
+        if type(keys_or_status_message) == str:
+            abort(http_status_code=400, message=keys_or_status_message)
+        result_or_status_message = index.delete(image_ids=request.json.get("image_ids"), **keys_or_status_message)
+        # Check if message was returned
+        if type(result_or_status_message) == str:
+            logger.info("token: %s send delete request with bad ids: %s.", token, result_or_status_message)
+            abort(http_status_code=400, message=result_or_status_message)
+        logger.info("token: %s send delete request successfully.", token)
+        return {"indices": result_or_status_message}
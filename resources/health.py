@@ -0,0 +1,26 @@
+"""Liveness and readiness endpoints for load balancers and orchestrators"""
+__author__ = "Vitali Muladze"
+
+from flask_restful import Resource
+
+from commons import faiss_index
+
+
+class Liveness(Resource):
+    """
+    Check that the process serves requests, fails only if loading of the index failed
+    """
+
+    def get(self):
+        status = faiss_index.loader.status()
+        return status, 500 if status["stage"] == 'failed' else 200
+
+
+class Readiness(Resource):
+    """
+    Check that the index is loaded, with loading progress until it is
+    """
+
+    def get(self):
+        status = faiss_index.loader.status()
+        return status, 200 if status["ready"] else 503
@@ -5,7 +5,7 @@ from flask import request, current_app
 from flask_restful import Resource, abort
 from werkzeug.local import LocalProxy
 
-from commons import faiss_index
+from commons import key_arguments, login_required, request_collection, timed_stage, wire_format
 from source.configuration import messages
 
 logger = LocalProxy(lambda: current_app.logger)
@@ -16,25 +16,52 @@ class Insert(Resource):
     Insert vectors in faiss database
     """
 
+    @login_required
     def put(self):
         token = request.headers.get('Authorization')
+        binary = wire_format.is_binary(request)
+        with timed_stage('parse'):
+            body = request.json if request.data and not binary else None
         # Check if features vector is specified
-        if not request.data or not request.json.get("features_vectors"):
-            logger.info(f"token: {token} send insertion request "
-                        f"without vector.")
-            abort(http_status_code=400, message=messages.NO_VECTOR_SPECIFIED)
-        # Check if image id is specified else image id is None
-        image_ids = request.json.get("image_ids", None)
-        # Get features vector from request and insert in faiss index
-        features_vector = request.json.get("features_vectors")
-        result_or_status_message = faiss_index.insert(
-            features_vectors=features_vector,
-            image_ids=image_ids)
+        with timed_stage('validate'):
+            if not request.data or (not binary and not body.get("features_vectors")):
+                logger.info("token: %s send insertion request without vector.", token)
+                abort(http_status_code=400, message=messages.NO_VECTOR_SPECIFIED)
+            # Named collection or the default index
+            index = request_collection(request.args.get("collection") if binary
+                                       else body.get("collection", request.args.get("collection")))
+            if type(index) == str:
+                abort(http_status_code=400, message=index)
+            # String keys and payloads instead of image ids
+            keys_or_status_message = key_arguments(index, body)
+            if type(keys_or_status_message) == str:
+                abort(http_status_code=400, message=keys_or_status_message)
+        with timed_stage('convert'):
+            if binary:
+                # Get float32 matrix and int64 ids from the body without copying them
+                parsed_or_status_message = wire_format.parse_vectors(
+                    request.get_data(), request.mimetype, index.dimension,
+                    with_ids=request.args.get("with_ids", "false") == "true")
+                if type(parsed_or_status_message) == str:
+                    abort(http_status_code=400, message=parsed_or_status_message)
+                features_vector, image_ids = parsed_or_status_message
+            else:
+                # Check if image id is specified else image id is None
+                image_ids = body.get("image_ids", None)
+                # Get features vector from request as float32 matrix
+                features_vector = index.to_vector_array(body.get("features_vectors"))
+        if type(features_vector) == str:
+            logger.info("token: %s send insertion request with bad vector: %s.", token, features_vector)
+            abort(http_status_code=400, message=features_vector)
+        with timed_stage('faiss'):
+            result_or_status_message = index.insert(
+                features_vectors=features_vector,
+                image_ids=image_ids, **keys_or_status_message)
         # Check if message was returned
         if type(result_or_status_message) == str:
-            logger.info(f"token: {token} send insertion request with "
-                        f"bad vector: {result_or_status_message}.")
-            abort(http_status_code=400, messages=result_or_status_message)
+            logger.info("token: %s send insertion request with bad vector: %s.",
+                        token, result_or_status_message)
+            abort(http_status_code=400, message=result_or_status_message)
 
-        logger.info(f"faiss index length: {len(faiss_index)}")
+        logger.info("faiss index length: %s", len(index))
         return {"indices": result_or_status_message}
@@ -0,0 +1,19 @@
+"""Metrics endpoint for applications"""
+__author__ = "Vitali Muladze"
+
+from flask import Response
+from flask_restful import Resource
+
+from commons import metrics
+
+# Content type of prometheus text format
+METRICS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metrics(Resource):
+    """
+    Export metrics of this process in prometheus text format
+    """
+
+    def get(self):
+        return Response(metrics.render(), content_type=METRICS_MIMETYPE)
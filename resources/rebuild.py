@@ -0,0 +1,41 @@
+"""Rebuild endpoints for applications"""
+__author__ = "Vitali Muladze"
+
+from flask import request, current_app
+from flask_restful import Resource, abort
+from werkzeug.local import LocalProxy
+
+from commons import admin_required, index_rebuilder
+from source.configuration import faiss_configuration, messages
+
+logger = LocalProxy(lambda: current_app.logger)
+
+
+class Rebuild(Resource):
+    """
+    Rebuild the index in background into a new index type and swap it in, or report the progress
+    """
+
+    @admin_required
+    def get(self):
+        if index_rebuilder is None:
+            abort(http_status_code=400, message=messages.REBUILD_NOT_SUPPORTED)
+        return index_rebuilder.status()
+
+    @admin_required
+    def post(self):
+        token = request.headers.get("Authorization")
+        if index_rebuilder is None:
+            abort(http_status_code=400, message=messages.REBUILD_NOT_SUPPORTED)
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            body = {}
+        # Rebuilding with the configured index factory trains and compacts the index again
+        result_or_status_message = index_rebuilder.start(body.get("index_factory", faiss_configuration.index_factory),
+                                                         body.get("n_results", 10), body.get("nprobe"),
+                                                         body.get("ef_search"))
+        if type(result_or_status_message) == str:
+            logger.info("token: %s send rebuild request: %s.", token, result_or_status_message)
+            abort(http_status_code=400, message=result_or_status_message)
+        logger.info("token: %s started rebuilding the index as %s.", token, index_rebuilder.index_factory)
+        return result_or_status_message, 202
@@ -0,0 +1,19 @@
+"""Replication endpoints for applications"""
+__author__ = "Vitali Muladze"
+
+from flask_restful import Resource, abort
+
+from commons import login_required, replication
+from source.configuration import messages
+
+
+class Replication(Resource):
+    """
+    Report the sequence of the primary and its replicas, or the lag of a replica behind the primary
+    """
+
+    @login_required
+    def get(self):
+        if replication() is None:
+            abort(http_status_code=400, message=messages.REPLICATION_DISABLED)
+        return replication().status()
@@ -1,12 +1,13 @@
 """Search endpoints for applications"""
 __author__ = "Vitali Muladze"
-import time
 
-from flask import request, current_app
+import numpy
+from flask import request, current_app, jsonify
 from flask_restful import Resource, abort
 from werkzeug.local import LocalProxy
 
-from commons import faiss_index
+from commons import (check_n_results, check_search_knobs, faiss_index, join_keys, login_required, lookup_keys,
+                     request_collection, result_cache, timed_stage, wire_format)
 from source.configuration import messages
 
 logger = LocalProxy(lambda: current_app.logger)
@@ -17,29 +18,110 @@ class Search(Resource):
     Search vectors in faiss database
     """
 
+    @login_required
     def post(self):
         token = request.headers.get('Authorization')
+        binary = wire_format.is_binary(request)
+        with timed_stage('parse'):
+            body = request.json if request.data and not binary else None
         # Check if features vector is specified
-        if not request.data or not request.json.get("features_vectors"):
-            logger.info(f"token: {token} send search request without vector.")
-            abort(http_status_code=400, message=messages.NO_VECTOR_SPECIFIED)
-        # Get features vector from request and search in the database
-        features_vector = request.json.get("features_vectors")
-        # Get number of results from request if any.
-        # If not specified then n_results = 10
-        n_results = request.json.get("n_results", 10)
-        tok = time.time()
-        result_or_status_message = faiss_index.search(features_vector,
-                                                      n_results=n_results)
-        tik = time.time()
-        logger.info(f"Time for search: {tik - tok}. Number of images {len(features_vector)}")
+        with timed_stage('validate'):
+            # Stored vectors of image ids or keys are searched instead of sent ones
+            by_ids = (request.args.get("image_ids") is not None if binary
+                      else body is not None and (body.get("image_ids") is not None or body.get("keys") is not None))
+            if not by_ids and (not request.data or (not binary and not body.get("features_vectors"))):
+                logger.info("token: %s send search request without vector.", token)
+                abort(http_status_code=400, message=messages.NO_VECTOR_SPECIFIED)
+            if binary:
+                # Invalid numbers are refused like those of json bodies instead of falling back to defaults
+                n_results = wire_format.parse_int(request.args.get("n_results"), 10)
+                search_knobs = {"nprobe": wire_format.parse_int(request.args.get("nprobe")),
+                                "ef_search": wire_format.parse_int(request.args.get("ef_search"))}
+                radius = request.args.get("radius")
+                id_filter = {"allow_ids": wire_format.parse_id_list(request.args.get("allow_ids")),
+                             "deny_ids": wire_format.parse_id_list(request.args.get("deny_ids"))}
+            else:
+                # Get number of results from request if any.
+                # If not specified then n_results = 10
+                n_results = body.get("n_results", 10)
+                # Per-request recall/latency knobs of IVF and HNSW indexes
+                search_knobs = {"nprobe": body.get("nprobe"),
+                                "ef_search": body.get("ef_search")}
+                # All results within the radius instead of the top n_results
+                radius = body.get("radius")
+                # Results restricted to or excluding image ids, filtered by faiss while scanning
+                id_filter = {"allow_ids": body.get("allow_ids"), "deny_ids": body.get("deny_ids")}
+            # Named collection or the default index
+            index = request_collection(request.args.get("collection") if binary
+                                       else body.get("collection", request.args.get("collection")))
+            if type(index) == str:
+                abort(http_status_code=400, message=index)
+            if check_n_results(n_results):
+                abort(http_status_code=400, message=messages.INVALID_N_RESULTS)
+            if check_search_knobs(search_knobs):
+                abort(http_status_code=400, message=messages.INVALID_SEARCH_KNOBS)
+            if messages.INVALID_IDS in id_filter.values():
+                abort(http_status_code=400, message=messages.INVALID_IDS)
+            id_filter = {key: image_ids for key, image_ids in id_filter.items() if image_ids is not None}
+        with timed_stage('convert'):
+            vector_array = None
+            if by_ids and binary:
+                query_ids = wire_format.parse_id_list(request.args.get("image_ids"))
+            elif by_ids and body.get("keys") is not None:
+                query_ids = lookup_keys(index, body.get("keys"))
+            elif by_ids:
+                query_ids = body.get("image_ids")
+            elif binary:
+                # Get float32 matrix from the body without copying it
+                vector_array = wire_format.parse_vectors(request.get_data(), request.mimetype,
+                                                         index.dimension)
+                if type(vector_array) != str:
+                    vector_array = vector_array[0]
+            else:
+                # Get features vector from request as float32 matrix
+                vector_array = index.to_vector_array(body.get("features_vectors"))
+        if by_ids and type(query_ids) == str:
+            logger.info("token: %s send search request with bad ids: %s.", token, query_ids)
+            abort(http_status_code=400, message=query_ids)
+        if type(vector_array) == str:
+            logger.info("token: %s send search request with bad vector: %s.", token, vector_array)
+            abort(http_status_code=400, message=vector_array)
+        with timed_stage('faiss'):
+            if by_ids:
+                # Vectors are read from the index, results exclude the queried ids themselves
+                result_or_status_message = index.search_by_ids(query_ids, n_results=n_results, radius=radius,
+                                                               **search_knobs, **id_filter)
+            elif radius is not None:
+                result_or_status_message = index.range_search(vector_array, radius, **search_knobs, **id_filter)
+            elif id_filter or index is not faiss_index:
+                # Filtered searches can't share batches or cached results with other requests,
+                # batches and the cache belong to the default index
+                result_or_status_message = index.search(vector_array, n_results=n_results,
+                                                        **search_knobs, **id_filter)
+            else:
+                result_or_status_message = result_cache.search(vector_array,
+                                                               n_results=n_results,
+                                                               **search_knobs)
         # Check if status code is returned from search
         if type(result_or_status_message) == str:
-            logger.info(
-                f"token: {token} send search request with bad vector: "
-                f"{result_or_status_message}.")
+            logger.info("token: %s send search request with bad vector: %s.", token, result_or_status_message)
             abort(http_status_code=400, message=result_or_status_message)
 
-        logger.info(f"faiss index length: {len(faiss_index)}")
-        return {"indices": result_or_status_message[0].tolist(),
-                "distances": result_or_status_message[1].tolist()}
+        logger.info("faiss index length: %s", len(index))
+        with timed_stage('serialize'):
+            # Send results in binary if the client accepts it
+            mimetype = wire_format.response_mimetype(request)
+            if radius is not None:
+                lims, result_indices, distances = result_or_status_message
+                if mimetype:
+                    return wire_format.range_results_response(lims, result_indices, distances, mimetype)
+                # Every query has its own number of results
+                return jsonify({"indices": [row.tolist() for row in numpy.split(result_indices, lims[1:-1])],
+                                "distances": [row.tolist() for row in numpy.split(distances, lims[1:-1])],
+                                **join_keys(index, result_indices, lims)})
+            if mimetype:
+                return wire_format.results_response(*result_or_status_message, mimetype)
+            # Keys and payloads of the results are read from the key store at once
+            return jsonify({"indices": result_or_status_message[0].tolist(),
+                            "distances": result_or_status_message[1].tolist(),
+                            **join_keys(index, result_or_status_message[0])})
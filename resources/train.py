@@ -0,0 +1,47 @@
+"""Training endpoints for applications"""
+__author__ = "Vitali Muladze"
+
+from flask import request, current_app
+from flask_restful import Resource, abort
+from werkzeug.local import LocalProxy
+
+from commons import login_required, request_collection, wire_format
+from source.configuration import messages
+
+logger = LocalProxy(lambda: current_app.logger)
+
+
+class Train(Resource):
+    """
+    Train an empty IVF or PQ index on sample vectors
+    """
+
+    @login_required
+    def post(self):
+        token = request.headers.get("Authorization")
+        # Check if features vector is specified
+        if not request.data or (not wire_format.is_binary(request)
+                                and not request.json.get("features_vectors")):
+            logger.info("token: %s send train request without vector.", token)
+            abort(http_status_code=400, message=messages.NO_VECTOR_SPECIFIED)
+        # Named collection or the default index
+        index = request_collection(request.args.get("collection") if wire_format.is_binary(request)
+                                   else request.json.get("collection", request.args.get("collection")))
+        if type(index) == str:
+            abort(http_status_code=400, message=index)
+        if wire_format.is_binary(request):
+            # Get float32 matrix from the body without copying it
+            parsed_or_status_message = wire_format.parse_vectors(request.get_data(), request.mimetype,
+                                                                 index.dimension)
+            if type(parsed_or_status_message) == str:
+                abort(http_status_code=400, message=parsed_or_status_message)
+            features_vector = parsed_or_status_message[0]
+        else:
+            features_vector = request.json.get("features_vectors")
+        result_or_status_message = index.train(features_vector)
+        # Check if message was returned
+        if type(result_or_status_message) == str:
+            logger.info("token: %s send train request with bad vector: %s.", token, result_or_status_message)
+            abort(http_status_code=400, message=result_or_status_message)
+        logger.info("token: %s trained the index on %s vectors.", token, result_or_status_message)
+        return {"n_vectors": result_or_status_message, "is_trained": index.is_trained}
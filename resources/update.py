@@ -4,7 +4,7 @@ __author__ = "Vitali Muladze"
 from flask import request, current_app
 from flask_restful import Resource, abort
 from werkzeug.local import LocalProxy
-from commons import faiss_index
+from commons import key_arguments, login_required, request_collection, wire_format
 from source.configuration import messages
 
 logger = LocalProxy(lambda: current_app.logger)
@@ -15,20 +15,41 @@ class Update(Resource):
     Update vectors in faiss database
     """
 
+    @login_required
     def post(self):
         token = request.headers.get("Authorization")
         # Check if features vector is specified
-        if not request.data or not request.json.get("features_vectors"):
-            logger.info(f"token: {token} send update request without vector.")
+        if not request.data or (not wire_format.is_binary(request)
+                                and not request.json.get("features_vectors")):
+            logger.info("token: %s send update request without vector.", token)
             abort(http_status_code=400, message=messages.NO_VECTOR_SPECIFIED)
-        # Check if image id is specified else image id is None
-        image_ids = request.json.get("image_ids", None)
-        # Get features vector from request and update in faiss index
-        features_vector = request.json.get("features_vectors")
-        result_or_status_message = faiss_index.update(features_vectors=features_vector, image_ids=image_ids)
+        # Named collection or the default index
+        index = request_collection(request.args.get("collection") if wire_format.is_binary(request)
+                                   else request.json.get("collection", request.args.get("collection")))
+        if type(index) == str:
+            abort(http_status_code=400, message=index)
+        # String keys instead of image ids and new payloads
+        keys_or_status_message = key_arguments(index, None if wire_format.is_binary(request) else request.json)
+        if type(keys_or_status_message) == str:
+            abort(http_status_code=400, message=keys_or_status_message)
+        if wire_format.is_binary(request):
+            # Get float32 matrix and int64 ids from the body without copying them
+            parsed_or_status_message = wire_format.parse_vectors(
+                request.get_data(), request.mimetype, index.dimension,
+                with_ids=request.args.get("with_ids", "false") == "true")
+            if type(parsed_or_status_message) == str:
+                abort(http_status_code=400, message=parsed_or_status_message)
+            features_vector, image_ids = parsed_or_status_message
+        else:
+            # Check if image id is specified else image id is None
+            image_ids = request.json.get("image_ids", None)
+            # Get features vector from request and update in faiss index
+            features_vector = request.json.get("features_vectors")
+        result_or_status_message = index.update(features_vectors=features_vector, image_ids=image_ids,
+                                                **keys_or_status_message)
         # Check if message was returned
         if type(result_or_status_message) == str:
-            logger.info(f"token: {token} send update request with bad vector: {result_or_status_message}.")
-            abort(http_status_code=400, messages=result_or_status_message)
-        logger.info(f"token: {token} send update request successfully.")
+            logger.info("token: %s send update request with bad vector: %s.", token, result_or_status_message)
+            abort(http_status_code=400, message=result_or_status_message)
+        logger.info("token: %s send update request successfully.", token)
         return {"indices": result_or_status_message}
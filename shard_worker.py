@@ -0,0 +1,42 @@
+"""Worker process holding one shard of a sharded index, started by ShardProcess"""
+__author__ = "Vitali Muladze"
+
+import argparse
+import os
+from multiprocessing.connection import Listener
+
+import faiss
+
+from models.faiss_database import FaissIndex
+from models.sharded_index import SHARD_AUTHKEY_VARIABLE, serve_shard
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("address", help="unix socket to listen on")
+    parser.add_argument("--index-path", help="index file of the shard")
+    parser.add_argument("--dimension", type=int, required=True)
+    parser.add_argument("--index-factory", default="IDMap,Flat")
+    parser.add_argument("--omp-threads", type=int, default=1)
+    parser.add_argument("--tombstones", action="store_true")
+    parser.add_argument("--vectors-path", help="full precision vectors of the shard for re-ranking")
+    parser.add_argument("--rerank-factor", type=int, default=4)
+
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    # Shards of a host share its cores
+    faiss.omp_set_num_threads(arguments.omp_threads)
+    faiss_index = FaissIndex(arguments.index_path, arguments.dimension, arguments.index_factory,
+                             arguments.tombstones, vectors_path=arguments.vectors_path,
+                             rerank_factor=arguments.rerank_factor)
+    with Listener(arguments.address, authkey=bytes.fromhex(os.environ[SHARD_AUTHKEY_VARIABLE])) as listener:
+        # One parent per worker, the worker exits when the parent disconnects
+        with listener.accept() as connection:
+            serve_shard(connection, faiss_index)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,12 @@
 import source.configuration.messages as messages
-from models.config import (Files, OracleDatabase, Application, MailConfiguration, FaissConfiguration)
+from models.config import (Files, OracleDatabase, Application, MailConfiguration, FaissConfiguration,
+                           LoggerConfiguration, CollectionsConfiguration)
 
 files = Files()
 oracle_database = OracleDatabase()
 mail_config = MailConfiguration()
+logger_config = LoggerConfiguration()
 application_config = Application
 messages = messages
 faiss_configuration = FaissConfiguration()
+collections_configuration = CollectionsConfiguration()
@@ -5,3 +5,40 @@ DIMENSION_ERROR: str = "Dimension of the vector doesn't equal to the index dimen
 DIMENSION_MISMATCH: str = "There are size mismatches between image IDs and image vectors"
 NO_IDS_SPECIFIED: str = "No IDs Specified"
 NO_VECTOR_SPECIFIED: str = "Features vector not specified"
+BAD_BINARY_BODY: str = "Binary body is not a valid float32 matrix"
+WRITER_UNAVAILABLE: str = "Index writer process is not available"
+INDEX_NOT_TRAINED: str = "Index is not trained yet"
+INDEX_NOT_EMPTY: str = "Index with vectors can not be trained"
+NOT_FINITE_VECTOR: str = "Features vector contains NaN or infinite values"
+DUPLICATE_IDS: str = "Image IDs are not unique"
+UNKNOWN_STREAM_FORMAT: str = "Stream format must be application/x-ndjson or application/x-npy"
+BAD_STREAM: str = "Stream can not be parsed"
+INVALID_IDS: str = "Image IDs must be a list of integers"
+INVALID_RADIUS: str = "Radius must be a number"
+INVALID_N_RESULTS: str = "Number of results must be a positive integer within the allowed maximum"
+INVALID_SEARCH_KNOBS: str = "nprobe and ef_search must be positive integers"
+FILTER_NOT_SUPPORTED: str = "Index type does not support filtered search"
+TOO_MANY_DEAD: str = "Too many dead vectors among the results, retry after compaction"
+RANGE_SEARCH_NOT_SUPPORTED: str = "Index type does not support range search"
+WARMING_UP: str = "Index is warming up, retry later"
+SERVER_BUSY: str = "Server is busy, retry later"
+BAD_JSON_BODY: str = "Body is not a valid JSON object"
+UNKNOWN_COLLECTION: str = "Collection is not configured"
+INVALID_KEYS: str = "Keys must be a list of unique non-empty strings within the key size"
+INVALID_PAYLOADS: str = "Payloads must be a list of strings within the payload size, one per vector"
+KEYS_EXIST: str = "Keys are already stored"
+UNKNOWN_KEYS: str = "Keys are not stored"
+KEY_STORE_DISABLED: str = "Key store is not enabled"
+KEYS_WITH_IDS: str = "Either keys or image IDs can be given"
+UNKNOWN_IDS: str = "Image IDs are not stored"
+IDS_NOT_ALLOCATED: str = "Image IDs beyond the stored ones are allocated by the key store, insert without IDs"
+KEY_STORE_GAP: str = "Stored image IDs are too far beyond the key store records to allocate after them"
+RECONSTRUCT_NOT_SUPPORTED: str = "Index type does not support reading stored vectors"
+REMOVE_NOT_SUPPORTED: str = "Index type does not support removing or updating vectors"
+REBUILD_RUNNING: str = "Index rebuild is already running"
+REBUILD_NOT_SUPPORTED: str = "Sharded or shared indexes can not be rebuilt"
+INVALID_INDEX_FACTORY: str = "Index factory is not a valid faiss factory string"
+INVALID_REBUILD: str = "Number of results must be a positive integer"
+NOT_ADMIN: str = "User is not an administrator"
+READ_ONLY_REPLICA: str = "Replica is read-only, writes go to the primary"
+REPLICATION_DISABLED: str = "Replication is not enabled"
@@ -0,0 +1,36 @@
+"""Shared setup of the tests, the configuration is read from config.ini of the working directory on import"""
+__author__ = "Vitali Muladze"
+
+import os
+import sys
+import tempfile
+
+CONFIG = """[DATABASE]
+URI = {folder}/media/users.db
+[APPLICATION]
+SECRET_KEY = secret
+SQLALCHEMY_TRACK_MODIFICATIONS = false
+SQLALCHEMY_ECHO = false
+[FILES]
+MEDIA_PATH = {folder}/media
+FAISS_INDEX_PATH = {folder}/media/index/faiss.index
+BACKUP_INDEX_PATH = {folder}/media/index/faiss_backup.index
+[LOGGER]
+LOG_FILE_INFO = {folder}/media/logs/info.log
+LOG_FILE_ERROR = {folder}/media/logs/error.log
+SEND_MAIL_TO = tests@localhost
+[MAIL]
+HOST = localhost
+PORT = 25
+FROM = tests@localhost
+[FAISS_DATABASE]
+INDEX_DIMENSION = 8
+"""
+
+# Tests run in a scratch folder so they never touch config.ini or media of a deployment, paths are absolute
+# as the index is backed up at exit, after pytest went back to the folder it was started in
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+FOLDER = tempfile.mkdtemp(prefix='faiss_server_tests')
+os.chdir(FOLDER)
+with open("config.ini", "w") as config_file:
+    config_file.write(CONFIG.format(folder=FOLDER))
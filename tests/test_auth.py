@@ -0,0 +1,53 @@
+"""Tests of authorization: inactive users are refused until an administrator activates them"""
+__author__ = "Vitali Muladze"
+
+import pytest
+
+from apps import create_app, db
+from commons import authenticate
+from models.token_cache import CachedUser
+from resources.auth import activate_user, login_user, register_user
+from source.configuration import application_config
+
+
+@pytest.fixture
+def application(monkeypatch):
+    monkeypatch.setattr(application_config, 'ACTIVATE_USERS', False)
+    monkeypatch.setattr(application_config, 'ADMIN_USERS', ['admin'])
+    application_config.create_all_folders()
+    application = create_app(application_config)
+    with application.app_context():
+        db.drop_all()
+        db.create_all()
+        yield application
+
+
+def test_inactive_user_is_refused(application):
+    register_user('user', 'password')
+    token = login_user('user', 'password')['token']
+
+    assert authenticate(token) == (403, 'User inactive.')
+
+
+def test_activated_user_is_accepted(application):
+    register_user('user', 'password')
+    token = login_user('user', 'password')['token']
+    authenticate(token)
+
+    assert activate_user('user', True) == {'username': 'user', 'active': True}
+    # Activation drops the cached inactive user
+    assert authenticate(token) == CachedUser('user', True)
+    assert activate_user('missing', True)[0] == 404
+
+
+def test_administrators_are_active_on_registration(application):
+    register_user('admin', 'password')
+
+    assert isinstance(authenticate(login_user('admin', 'password')['token']), CachedUser)
+
+
+def test_users_are_active_unless_configured(application, monkeypatch):
+    monkeypatch.setattr(application_config, 'ACTIVATE_USERS', True)
+    register_user('user', 'password')
+
+    assert isinstance(authenticate(login_user('user', 'password')['token']), CachedUser)
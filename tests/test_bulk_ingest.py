@@ -0,0 +1,60 @@
+"""Tests of bulk ingestion: .npy streams in chunks and progress only of durable rows"""
+__author__ = "Vitali Muladze"
+
+import io
+import json
+
+import numpy
+
+from models.bulk_ingest import BulkIngest, NPY
+from models.faiss_database import FaissIndex
+
+DIMENSION = 8
+
+
+def npy_stream(*arrays) -> io.BytesIO:
+    stream = io.BytesIO()
+    for array in arrays:
+        numpy.save(stream, array)
+    stream.seek(0)
+
+    return stream
+
+
+def test_npy_matrices_are_read_in_chunks(tmp_path):
+    random = numpy.random.default_rng(0)
+    first, second = random.random((25, DIMENSION), dtype=numpy.float32), random.random((7, DIMENSION),
+                                                                                        dtype=numpy.float32)
+    bulk_ingest = BulkIngest(FaissIndex(None, DIMENSION), str(tmp_path / "progress.json"), chunk_size=10)
+
+    chunks = list(bulk_ingest.read_chunks(npy_stream(first, numpy.arange(100, 125), second), NPY, skip_rows=3))
+
+    assert [vectors.shape[0] for vectors, _ in chunks] == [10, 10, 2, 7]
+    numpy.testing.assert_array_equal(numpy.concatenate([vectors for vectors, _ in chunks[:3]]), first[3:])
+    numpy.testing.assert_array_equal(numpy.concatenate([ids for _, ids in chunks[:3]]), numpy.arange(103, 125))
+    assert chunks[3][1] is None
+
+
+def test_progress_is_recorded_only_for_durable_rows(tmp_path):
+    progress_path = str(tmp_path / "progress.json")
+    index_path = str(tmp_path / "faiss.index")
+    vector_array = numpy.random.default_rng(1).random((30, DIMENSION), dtype=numpy.float32)
+
+    # Without write-ahead log or index file nothing makes the rows durable
+    faiss_index = FaissIndex(None, DIMENSION)
+    BulkIngest(faiss_index, progress_path, chunk_size=10).ingest(npy_stream(vector_array), NPY, "vectors")
+    assert BulkIngest(faiss_index, progress_path).committed_rows("vectors") == 0
+
+    faiss_index = FaissIndex(None, DIMENSION)
+    report = BulkIngest(faiss_index, progress_path, chunk_size=10, index_path=index_path).ingest(
+        npy_stream(vector_array), NPY, "vectors")
+    assert report["rows"] == 30
+    with open(progress_path) as progress_file:
+        assert json.load(progress_file)["vectors"]["rows"] == 30
+    assert len(FaissIndex(index_path, DIMENSION)) == 30
+
+    # A resumed ingestion skips the committed rows
+    report = BulkIngest(faiss_index, progress_path, chunk_size=10, index_path=index_path).ingest(
+        npy_stream(vector_array), NPY, "vectors")
+    assert report["skipped_rows"] == 30
+    assert len(faiss_index) == 30
@@ -0,0 +1,73 @@
+"""Tests of the faiss index: removals the index can't apply never poison the write-ahead log"""
+__author__ = "Vitali Muladze"
+
+import numpy
+
+from models.checkpointer import Checkpointer
+from models.faiss_database import FaissIndex
+from models.write_ahead_log import INSERT, REMOVE, WriteAheadLog
+
+DIMENSION = 8
+
+
+def random_vectors(n_vectors: int, seed: int = 0) -> numpy.ndarray:
+    return numpy.random.default_rng(seed).random((n_vectors, DIMENSION), dtype=numpy.float32)
+
+
+def test_hnsw_removals_are_masked():
+    faiss_index = FaissIndex(None, DIMENSION, 'IDMap,HNSW32')
+    vector_array = random_vectors(50)
+    faiss_index.insert(vector_array, numpy.arange(50))
+
+    # HNSW can't remove vectors, they are kept as tombstones instead of failing after logging
+    assert not faiss_index.removable
+    assert faiss_index.tombstones
+    assert not isinstance(faiss_index.delete(numpy.arange(5)), str)
+    assert not isinstance(faiss_index.update(vector_array[5:6] + 1, numpy.array([5])), str)
+
+    indices, _ = faiss_index.search(vector_array[:10], n_results=5)
+    assert not numpy.isin(indices, numpy.arange(5)).any()
+    assert len(faiss_index) == 45
+
+
+def logged_index(tmp_path, index_factory: str) -> tuple:
+    """Index with an attached write-ahead log and its checkpointer"""
+    wal = WriteAheadLog(str(tmp_path / "wal"), 'never')
+    faiss_index = FaissIndex(None, DIMENSION, index_factory)
+    checkpointer = Checkpointer(faiss_index, wal, str(tmp_path / "faiss.checkpoint"))
+    checkpointer.recover()
+    faiss_index.wal = wal
+
+    return faiss_index, checkpointer
+
+
+def test_logged_hnsw_removals_replay(tmp_path):
+    faiss_index, checkpointer = logged_index(tmp_path, 'IDMap,HNSW32')
+    faiss_index.insert(random_vectors(20), numpy.arange(20))
+    faiss_index.delete(numpy.arange(3))
+    checkpointer.close()
+
+    recovered_index, checkpointer = logged_index(tmp_path, 'IDMap,HNSW32')
+
+    assert len(recovered_index) == 17
+    assert recovered_index.wal.last_lsn == 2
+    checkpointer.close()
+
+
+def test_replay_skips_records_the_index_refuses(tmp_path):
+    wal_path = str(tmp_path / "wal")
+    wal = WriteAheadLog(wal_path, 'never')
+    list(wal.replay())
+    wal.append(INSERT, numpy.arange(4, dtype=numpy.int64), random_vectors(4))
+    wal.append(REMOVE, numpy.array([0], dtype=numpy.int64))
+    wal.close()
+
+    # Inverted lists which are not trained refuse the insertion, the removal still applies
+    faiss_index = FaissIndex(None, DIMENSION, 'IVF4,Flat')
+    wal = WriteAheadLog(wal_path, 'never')
+    report = Checkpointer(faiss_index, wal, str(tmp_path / "faiss.checkpoint")).recover()
+
+    assert report["skipped_lsns"] == [1]
+    assert report["replayed_records"] == 2
+    assert wal.last_lsn == 2
+    wal.close()
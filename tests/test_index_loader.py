@@ -0,0 +1,54 @@
+"""Tests of background loading: the placeholder of a loading index takes no writes and never replaces its file"""
+__author__ = "Vitali Muladze"
+
+import faiss
+import numpy
+import pytest
+
+from models.faiss_database import FaissIndex
+from source.configuration import messages
+
+DIMENSION = 8
+
+
+def random_vectors(n_vectors: int, seed: int = 0) -> numpy.ndarray:
+    return numpy.random.default_rng(seed).random((n_vectors, DIMENSION), dtype=numpy.float32)
+
+
+@pytest.fixture
+def loading_index(tmp_path) -> tuple:
+    """Index whose file is not loaded yet, with the file it would be written to"""
+    index_path = str(tmp_path / "faiss.index")
+    saved_index = FaissIndex(None, DIMENSION)
+    saved_index.insert(random_vectors(10), numpy.arange(10))
+    assert saved_index.to_disk(index_path) == messages.OK
+    faiss_index = FaissIndex(None, DIMENSION)
+    faiss_index.loader.ready.clear()
+
+    return faiss_index, index_path
+
+
+def test_writes_are_refused_while_loading(loading_index):
+    faiss_index, _ = loading_index
+
+    assert faiss_index.insert(random_vectors(2), numpy.arange(100, 102)) == messages.WARMING_UP
+    assert faiss_index.update(random_vectors(1), numpy.arange(1)) == messages.WARMING_UP
+    assert faiss_index.delete(numpy.arange(1)) == messages.WARMING_UP
+    assert faiss_index.train(random_vectors(2)) == messages.WARMING_UP
+    assert faiss_index.index.ntotal == 0
+
+
+def test_placeholder_does_not_replace_the_index_file(loading_index):
+    faiss_index, index_path = loading_index
+
+    assert faiss_index.to_disk(index_path) == messages.WARMING_UP
+    assert faiss.read_index(index_path).ntotal == 10
+
+
+def test_loaded_index_accepts_writes(loading_index):
+    faiss_index, index_path = loading_index
+    faiss_index.load(index_path)
+    faiss_index.loader.ready.set()
+
+    assert not isinstance(faiss_index.insert(random_vectors(2), numpy.arange(100, 102)), str)
+    assert len(faiss_index) == 12
@@ -0,0 +1,42 @@
+"""Tests of the online rebuild: writes made during the build are replayed into the swapped in index"""
+__author__ = "Vitali Muladze"
+
+import numpy
+import pytest
+
+from models.faiss_database import FaissIndex
+from models.index_rebuilder import IndexRebuilder
+
+DIMENSION = 8
+
+
+@pytest.mark.parametrize("index_factory", ['IDMap,Flat', 'HNSW16'])
+def test_writes_during_the_build_are_replayed(index_factory):
+    random = numpy.random.default_rng(0)
+    vector_array = random.random((2000, DIMENSION), dtype=numpy.float32)
+    faiss_index = FaissIndex(None, DIMENSION)
+    faiss_index.insert(vector_array, numpy.arange(2000))
+    rebuilder = IndexRebuilder(faiss_index, train_size=500, chunk_size=300, n_eval_queries=10)
+    read_vectors = rebuilder._read_vectors
+    new_vectors = random.random((2, DIMENSION), dtype=numpy.float32)
+
+    def read_vectors_while_writing(id_array):
+        # Writes arrive after the snapshot of ids was taken
+        if rebuilder.stage == 'building' and rebuilder.n_added == 0:
+            faiss_index.delete(numpy.array([5, 6, 7]))
+            faiss_index.update(new_vectors[:1], numpy.array([8]))
+            faiss_index.insert(new_vectors[1:], numpy.array([5000]))
+        return read_vectors(id_array)
+
+    rebuilder._read_vectors = read_vectors_while_writing
+    assert not isinstance(rebuilder.start(index_factory), str)
+    rebuilder._thread.join()
+
+    assert rebuilder.stage == 'done', rebuilder.error
+    assert rebuilder.n_replayed == 3
+    assert len(faiss_index) == 1998
+    indices, distances = faiss_index.search(vector_array[[5, 6, 7, 8]], n_results=5)
+    assert not numpy.isin(indices, [5, 6, 7]).any()
+    # The old vector of the updated id is gone, the new one is found
+    assert indices[3, 0] != 8 or distances[3, 0] > 0
+    assert faiss_index.search(new_vectors, n_results=1)[0][:, 0].tolist() == [8, 5000]
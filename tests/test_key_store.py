@@ -0,0 +1,66 @@
+"""Tests of the key store: keys and payloads of automatic ids, joined into results and never reused"""
+__author__ = "Vitali Muladze"
+
+import os
+
+import numpy
+import pytest
+
+from models.faiss_database import FaissIndex
+from models.key_store import MAX_SKIPPED_IDS, KeyStore
+from source.configuration import messages
+
+DIMENSION = 8
+
+
+def random_vectors(n_vectors: int, seed: int = 0) -> numpy.ndarray:
+    return numpy.random.default_rng(seed).random((n_vectors, DIMENSION), dtype=numpy.float32)
+
+
+@pytest.fixture
+def keyed_index(tmp_path) -> FaissIndex:
+    faiss_index = FaissIndex(None, DIMENSION)
+    faiss_index.key_store = KeyStore(str(tmp_path / "faiss.keys"), key_size=16, payload_size=16)
+    yield faiss_index
+    faiss_index.key_store.close()
+
+
+def test_keys_are_looked_up_and_joined(keyed_index):
+    vector_array = random_vectors(3)
+    assert keyed_index.insert(vector_array, keys=["a.jpg", "b.jpg", "c.jpg"], payloads=["1", "2", "3"]) == [0, 1, 2]
+
+    numpy.testing.assert_array_equal(keyed_index.key_store.lookup(["c.jpg", "x.jpg"]), [2, -1])
+    assert keyed_index.insert(vector_array[:1], keys=["a.jpg"]) == messages.KEYS_EXIST
+    assert keyed_index.key_store.join(numpy.array([[1, -1]])) == {"keys": [["b.jpg", None]],
+                                                                  "payloads": [["2", None]]}
+
+
+def test_ids_of_deleted_keys_are_not_reused(keyed_index, tmp_path):
+    keyed_index.insert(random_vectors(2), keys=["a.jpg", "b.jpg"])
+    assert keyed_index.delete(keys=["b.jpg"]) == [1]
+
+    assert keyed_index.insert(random_vectors(1), keys=["b.jpg"]) == [2]
+    keyed_index.key_store.close()
+    # Allocated ids survive a restart
+    keyed_index.key_store = KeyStore(str(tmp_path / "faiss.keys"), key_size=16, payload_size=16)
+    numpy.testing.assert_array_equal(keyed_index.key_store.lookup(["a.jpg", "b.jpg"]), [0, 2])
+
+
+def test_ids_beyond_the_key_store_are_refused(keyed_index):
+    keyed_index.insert(random_vectors(2), keys=["a.jpg", "b.jpg"])
+    file_size = os.path.getsize(keyed_index.key_store.store_path)
+
+    assert keyed_index.insert(random_vectors(1), [10 ** 13]) == messages.IDS_NOT_ALLOCATED
+    assert keyed_index.update(random_vectors(1), [5_000_000]) == messages.IDS_NOT_ALLOCATED
+    assert keyed_index.insert(random_vectors(1), keys=["c.jpg"]) == [2]
+    assert os.path.getsize(keyed_index.key_store.store_path) == file_size + keyed_index.key_store.record_dtype.itemsize
+    # Stored ids can be updated by id
+    assert keyed_index.update(random_vectors(1), [1]) == [1]
+
+
+def test_far_stored_ids_are_not_padded(tmp_path):
+    key_store = KeyStore(str(tmp_path / "faiss.keys"))
+
+    assert key_store.allocate(1, ["a.jpg"], first_id=MAX_SKIPPED_IDS + 1) == messages.KEY_STORE_GAP
+    assert len(key_store) == 0
+    key_store.close()
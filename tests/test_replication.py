@@ -0,0 +1,96 @@
+"""Tests of replication: replicas bootstrap from a snapshot and catch up with the writes of the primary"""
+__author__ = "Vitali Muladze"
+
+import socket
+import time
+from multiprocessing.connection import Client
+
+import numpy
+
+from models.faiss_database import FaissIndex
+from models.replication import ReplicaFaissIndex, ReplicationPrimary, parse_address
+from models.write_ahead_log import INSERT
+
+DIMENSION = 8
+AUTHKEY = b'secret'
+
+
+def free_address() -> str:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return f"127.0.0.1:{probe.getsockname()[1]}"
+
+
+def wait_until(condition, timeout: float = 10) -> bool:
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def started_primary(index_factory: str = 'IDMap,Flat', backlog_bytes: int = 2 ** 20) -> ReplicationPrimary:
+    faiss_index = FaissIndex(None, DIMENSION, index_factory)
+    faiss_index.insert(numpy.random.default_rng(0).random((100, DIMENSION), dtype=numpy.float32), numpy.arange(100))
+    primary = ReplicationPrimary(faiss_index, free_address(), AUTHKEY, backlog_bytes)
+    primary.start()
+    return primary
+
+
+def assert_same_results(faiss_index: FaissIndex, replica: ReplicaFaissIndex) -> None:
+    queries = numpy.random.default_rng(1).random((10, DIMENSION), dtype=numpy.float32)
+    numpy.testing.assert_array_equal(replica.search(queries, n_results=5)[0],
+                                     faiss_index.search(queries, n_results=5)[0])
+
+
+def test_replica_bootstraps_from_snapshot_with_tombstones():
+    primary = started_primary('IDMap,HNSW16')
+    # HNSW only masks removed vectors, the replica must mask them as well
+    primary.faiss_index.delete(numpy.arange(10))
+    replica = ReplicaFaissIndex(DIMENSION, 'IDMap,Flat', primary.address, AUTHKEY)
+
+    assert replica.loader.ready.wait(10)
+    assert replica.snapshots == 1
+    assert replica.sequence == primary.sequence
+    assert len(replica) == len(primary.faiss_index) == 90
+    assert_same_results(primary.faiss_index, replica)
+
+
+def test_replica_catches_up_with_writes():
+    primary = started_primary()
+    replica = ReplicaFaissIndex(DIMENSION, 'IDMap,Flat', primary.address, AUTHKEY)
+    assert replica.loader.ready.wait(10)
+    random = numpy.random.default_rng(2)
+
+    primary.faiss_index.insert(random.random((20, DIMENSION), dtype=numpy.float32), numpy.arange(100, 120))
+    primary.faiss_index.update(random.random((5, DIMENSION), dtype=numpy.float32), numpy.arange(5))
+    primary.faiss_index.delete(numpy.arange(5, 10))
+
+    assert wait_until(lambda: replica.sequence == primary.sequence)
+    # Writes arrived as records, not as another snapshot
+    assert replica.snapshots == 1
+    assert replica.lag_writes == 0
+    assert len(replica) == len(primary.faiss_index) == 115
+    assert_same_results(primary.faiss_index, replica)
+
+
+def test_reconnecting_replica_gets_kept_writes_or_snapshot():
+    # Room for the last two writes of one vector only
+    primary = started_primary(backlog_bytes=100)
+    random = numpy.random.default_rng(3)
+    for image_id in range(100, 110):
+        primary.faiss_index.insert(random.random((1, DIMENSION), dtype=numpy.float32), numpy.array([image_id]))
+
+    with Client(parse_address(primary.address), authkey=AUTHKEY) as connection:
+        connection.send((primary.stream_id, primary.sequence - 2))
+        kind, primary_sequence, records = connection.recv()
+    assert (kind, primary_sequence) == ('records', primary.sequence)
+    assert [record[:2] for record in records] == [(primary.sequence - 1, INSERT), (primary.sequence, INSERT)]
+
+    # The first writes are no longer kept, and an earlier process of the primary had other writes
+    for stream_id, sequence in ((primary.stream_id, 1), ('earlier', primary.sequence)):
+        with Client(parse_address(primary.address), authkey=AUTHKEY) as connection:
+            connection.send((stream_id, sequence))
+            kind, primary_sequence, state = connection.recv()
+            assert (kind, primary_sequence, state["stream_id"]) == ('snapshot', primary.sequence, primary.stream_id)
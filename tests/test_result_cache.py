@@ -0,0 +1,51 @@
+"""Tests of the result cache: writes to the index invalidate cached results"""
+__author__ = "Vitali Muladze"
+
+import numpy
+
+from models.faiss_database import FaissIndex
+from models.result_cache import ResultCache
+
+DIMENSION = 8
+
+
+def cached_index(max_bytes: int = 2 ** 20) -> tuple:
+    faiss_index = FaissIndex(None, DIMENSION)
+    faiss_index.insert(numpy.random.default_rng(0).random((50, DIMENSION), dtype=numpy.float32), numpy.arange(50))
+    return faiss_index, ResultCache(faiss_index, faiss_index, max_bytes)
+
+
+def test_repeated_queries_are_served_from_cache():
+    faiss_index, result_cache = cached_index()
+    queries = numpy.random.default_rng(1).random((3, DIMENSION), dtype=numpy.float32)
+
+    first = result_cache.search(queries, n_results=5)
+    second = result_cache.search(queries, n_results=5)
+
+    assert (result_cache.hits, result_cache.misses) == (3, 3)
+    numpy.testing.assert_array_equal(first[0], second[0])
+    numpy.testing.assert_array_equal(second[0], faiss_index.search(queries, n_results=5)[0])
+
+
+def test_write_invalidates_cached_results():
+    faiss_index, result_cache = cached_index()
+    query = numpy.random.default_rng(2).random((1, DIMENSION), dtype=numpy.float32)
+    result_cache.search(query, n_results=1)
+
+    # The query vector itself becomes the nearest result
+    faiss_index.insert(query, numpy.array([100]))
+    indices, _ = result_cache.search(query, n_results=1)
+
+    assert indices[0, 0] == 100
+    assert result_cache.hits == 0
+    assert result_cache.stats()["generation"] == faiss_index.generation
+
+
+def test_results_over_memory_cap_are_evicted():
+    _, result_cache = cached_index(max_bytes=1000)
+    queries = numpy.random.default_rng(3).random((20, DIMENSION), dtype=numpy.float32)
+
+    result_cache.search(queries, n_results=5)
+
+    assert result_cache.evictions > 0
+    assert result_cache.size_bytes <= 1000
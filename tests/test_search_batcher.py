@@ -0,0 +1,99 @@
+"""Tests of cross-request batching: every caller gets its own rows and only its own errors"""
+__author__ = "Vitali Muladze"
+
+import threading
+
+import numpy
+import pytest
+
+from models.faiss_database import FaissIndex
+from models.search_batcher import SearchBatcher
+from source.configuration import messages
+
+DIMENSION = 8
+
+
+@pytest.fixture
+def faiss_index() -> FaissIndex:
+    faiss_index = FaissIndex(None, DIMENSION)
+    random = numpy.random.default_rng(0)
+    faiss_index.insert(random.random((200, DIMENSION), dtype=numpy.float32), numpy.arange(200))
+    return faiss_index
+
+
+def search_concurrently(batcher: SearchBatcher, requests: list) -> list:
+    """Send (features vectors, n_results) requests from threads at once and collect results or exceptions"""
+    results = [None] * len(requests)
+    barrier = threading.Barrier(len(requests))
+
+    def search(number: int, features_vectors: numpy.ndarray, n_results: int) -> None:
+        barrier.wait()
+        try:
+            results[number] = batcher.search(features_vectors, n_results=n_results)
+        except Exception as error:
+            results[number] = error
+
+    threads = [threading.Thread(target=search, args=(number, *request)) for number, request in enumerate(requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def test_batched_results_match_direct_searches(faiss_index, monkeypatch):
+    batcher = SearchBatcher(faiss_index, max_wait_ms=50, max_batch_size=256)
+    search = faiss_index.search
+    n_calls = []
+
+    def counted_search(features_vectors, **search_arguments):
+        n_calls.append(len(features_vectors))
+        return search(features_vectors, **search_arguments)
+
+    monkeypatch.setattr(faiss_index, 'search', counted_search)
+    random = numpy.random.default_rng(1)
+    # Requests of different sizes and numbers of results share batches
+    requests = [(random.random((1 + number % 3, DIMENSION), dtype=numpy.float32), 1 + number % 5)
+                for number in range(16)]
+
+    results = search_concurrently(batcher, requests)
+
+    # Requests shared faiss calls
+    assert len(n_calls) < len(requests)
+    for (features_vectors, n_results), result in zip(requests, results):
+        expected_indices, expected_distances = search(features_vectors, n_results=n_results)
+        indices, distances = result
+        assert indices.shape == (features_vectors.shape[0], n_results)
+        numpy.testing.assert_array_equal(indices, expected_indices)
+        numpy.testing.assert_allclose(distances, expected_distances, rtol=1e-5)
+
+
+def test_bad_requests_are_refused_before_batching(faiss_index):
+    batcher = SearchBatcher(faiss_index, max_wait_ms=50)
+    features_vectors = numpy.zeros((1, DIMENSION), dtype=numpy.float32)
+
+    assert batcher.search(features_vectors, n_results=0) == messages.INVALID_N_RESULTS
+    assert batcher.search(features_vectors, n_results=2.5) == messages.INVALID_N_RESULTS
+    assert isinstance(batcher.search(numpy.zeros((1, DIMENSION + 1), dtype=numpy.float32)), str)
+
+
+def test_error_reaches_only_the_request_which_caused_it(faiss_index, monkeypatch):
+    batcher = SearchBatcher(faiss_index, max_wait_ms=50)
+    poisoned = numpy.full((1, DIMENSION), -1, dtype=numpy.float32)
+    search = faiss_index.search
+
+    def failing_search(features_vectors, **search_arguments):
+        if (numpy.asarray(features_vectors) == -1).all(axis=1).any():
+            raise RuntimeError("poisoned query")
+        return search(features_vectors, **search_arguments)
+
+    monkeypatch.setattr(faiss_index, 'search', failing_search)
+    random = numpy.random.default_rng(2)
+    requests = [(random.random((1, DIMENSION), dtype=numpy.float32), 3) for _ in range(7)] + [(poisoned, 3)]
+
+    results = search_concurrently(batcher, requests)
+
+    assert isinstance(results[-1], RuntimeError)
+    for (features_vectors, n_results), result in zip(requests[:-1], results[:-1]):
+        numpy.testing.assert_array_equal(result[0], search(features_vectors, n_results=n_results)[0])
@@ -0,0 +1,83 @@
+"""Tests of the sharded index: merged top results equal those of a single index"""
+__author__ = "Vitali Muladze"
+
+import numpy
+
+from models.faiss_database import FaissIndex
+from models.sharded_index import ShardedFaissIndex
+from source.configuration import messages
+
+DIMENSION = 8
+
+
+def filled_indexes(index_factory: str, n_vectors: int = 500) -> tuple:
+    """Single index and sharded index with the same vectors"""
+    random = numpy.random.default_rng(0)
+    vector_array = random.random((n_vectors, DIMENSION), dtype=numpy.float32)
+    id_array = random.permutation(10 * n_vectors)[:n_vectors].astype(numpy.int64)
+    faiss_index = FaissIndex(None, DIMENSION, index_factory)
+    sharded_index = ShardedFaissIndex(None, DIMENSION, index_factory, n_shards=3)
+    for index in (faiss_index, sharded_index):
+        assert not isinstance(index.insert(vector_array, id_array), str)
+
+    return faiss_index, sharded_index
+
+
+def test_merged_top_results_equal_single_index():
+    faiss_index, sharded_index = filled_indexes('IDMap,Flat')
+    queries = numpy.random.default_rng(1).random((20, DIMENSION), dtype=numpy.float32)
+
+    for n_results in (1, 10, 50):
+        indices, distances = sharded_index.search(queries, n_results=n_results)
+        expected_indices, expected_distances = faiss_index.search(queries, n_results=n_results)
+        numpy.testing.assert_array_equal(indices, expected_indices)
+        numpy.testing.assert_allclose(distances, expected_distances, rtol=1e-5)
+
+
+def test_missing_results_sort_last():
+    faiss_index, sharded_index = filled_indexes('IDMap,Flat', n_vectors=5)
+    queries = numpy.random.default_rng(2).random((3, DIMENSION), dtype=numpy.float32)
+
+    indices, distances = sharded_index.search(queries, n_results=8)
+
+    assert indices.shape == (3, 8)
+    assert (indices[:, 5:] == -1).all()
+    numpy.testing.assert_array_equal(indices[:, :5], faiss_index.search(queries, n_results=5)[0])
+
+
+def test_removed_vectors_are_not_merged():
+    faiss_index, sharded_index = filled_indexes('IDMap,Flat')
+    queries = numpy.random.default_rng(3).random((5, DIMENSION), dtype=numpy.float32)
+    removed = numpy.unique(faiss_index.search(queries, n_results=3)[0])
+    for index in (faiss_index, sharded_index):
+        assert not isinstance(index.delete(removed), str)
+
+    indices, _ = sharded_index.search(queries, n_results=10)
+
+    assert not numpy.isin(indices, removed).any()
+    numpy.testing.assert_array_equal(indices, faiss_index.search(queries, n_results=10)[0])
+    assert len(sharded_index) == len(faiss_index)
+
+
+def test_invalid_n_results_is_refused():
+    _, sharded_index = filled_indexes('IDMap,Flat', n_vectors=5)
+
+    assert sharded_index.search(numpy.zeros((1, DIMENSION), dtype=numpy.float32), n_results=0) == \
+        messages.INVALID_N_RESULTS
+
+
+def test_write_refused_by_one_shard_is_applied_by_none():
+    faiss_index, sharded_index = filled_indexes('IDMap,Flat', n_vectors=30)
+    id_array = numpy.arange(30, dtype=numpy.int64)
+    sharded_index.insert(numpy.zeros((30, DIMENSION), dtype=numpy.float32), id_array + 1000)
+    # One shard holds a layout which can neither remove vectors nor mask them
+    sharded_index.shards[1].removable = sharded_index.shards[1].tombstones = False
+    before = sharded_index.search(numpy.zeros((1, DIMENSION), dtype=numpy.float32), n_results=60)
+
+    assert sharded_index.update(numpy.ones((3, DIMENSION), dtype=numpy.float32), [1000, 1001, 1002]) == \
+        messages.REMOVE_NOT_SUPPORTED
+    assert sharded_index.delete([1000, 1001, 1002]) == messages.REMOVE_NOT_SUPPORTED
+
+    after = sharded_index.search(numpy.zeros((1, DIMENSION), dtype=numpy.float32), n_results=60)
+    numpy.testing.assert_array_equal(numpy.sort(after[0]), numpy.sort(before[0]))
+    assert len(sharded_index) == len(faiss_index) + 30
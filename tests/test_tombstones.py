@@ -0,0 +1,59 @@
+"""Tests of tombstoned removals: dead vectors stay masked until compaction, also after a restart"""
+__author__ = "Vitali Muladze"
+
+import numpy
+
+from models.checkpointer import Checkpointer
+from models.faiss_database import FaissIndex
+from models.write_ahead_log import WriteAheadLog
+
+DIMENSION = 8
+
+
+def random_vectors(n_vectors: int, seed: int = 0) -> numpy.ndarray:
+    return numpy.random.default_rng(seed).random((n_vectors, DIMENSION), dtype=numpy.float32)
+
+
+def nearest_ids(faiss_index: FaissIndex, vector_array: numpy.ndarray) -> numpy.ndarray:
+    return faiss_index.search(vector_array, n_results=1)[0][:, 0]
+
+
+def test_removed_and_overwritten_vectors_are_masked():
+    faiss_index = FaissIndex(None, DIMENSION, tombstones=True)
+    vector_array = random_vectors(10)
+    faiss_index.insert(vector_array, numpy.arange(10))
+
+    faiss_index.delete(numpy.array([2]))
+    faiss_index.update(vector_array[:1] + 10, numpy.array([0]))
+
+    assert faiss_index.dead_count == 2
+    assert len(faiss_index) == 9
+    assert 2 not in nearest_ids(faiss_index, vector_array)
+    assert nearest_ids(faiss_index, vector_array[:1] + 10)[0] == 0
+    assert faiss_index.compact() == 2
+    numpy.testing.assert_array_equal(nearest_ids(faiss_index, vector_array[3:]), numpy.arange(3, 10))
+
+
+def test_restored_dead_vectors_stay_masked_without_configured_tombstones(tmp_path):
+    vector_array = random_vectors(10)
+    wal = WriteAheadLog(str(tmp_path / "wal"), 'never')
+    faiss_index = FaissIndex(None, DIMENSION, tombstones=True)
+    checkpointer = Checkpointer(faiss_index, wal, str(tmp_path / "faiss.checkpoint"))
+    checkpointer.recover()
+    faiss_index.wal = wal
+    faiss_index.insert(vector_array, numpy.arange(10))
+    faiss_index.delete(numpy.array([2]))
+    checkpointer.checkpoint()
+    wal.close()
+
+    # Restarted without tombstones, the checkpoint still holds the dead vector
+    restored_index = FaissIndex(None, DIMENSION, tombstones=False)
+    wal = WriteAheadLog(str(tmp_path / "wal"), 'never')
+    Checkpointer(restored_index, wal, str(tmp_path / "faiss.checkpoint")).recover()
+    restored_index.update(vector_array[:1] + 10, numpy.array([0]))
+
+    assert restored_index.tombstones
+    assert len(restored_index) == 9
+    assert 2 not in nearest_ids(restored_index, vector_array)
+    numpy.testing.assert_array_equal(nearest_ids(restored_index, vector_array[3:]), numpy.arange(3, 10))
+    wal.close()
@@ -0,0 +1,38 @@
+"""Tests of the vector store: replaying the log on restart doesn't append its vectors again"""
+__author__ = "Vitali Muladze"
+
+import numpy
+
+from models.checkpointer import open_durable_index
+
+DIMENSION = 8
+
+
+def open_index(tmp_path) -> tuple:
+    """Durable index with a vector store, recovered from the files of earlier runs"""
+    faiss_index, checkpointer, _ = open_durable_index(
+        None, DIMENSION, 'IDMap,Flat', str(tmp_path / "wal"), str(tmp_path / "faiss.checkpoint"),
+        fsync_policy='never', vectors_path=str(tmp_path / "vectors"))
+    return faiss_index, checkpointer
+
+
+def test_restarts_reuse_stored_rows(tmp_path):
+    random = numpy.random.default_rng(0)
+    vector_array = random.random((20, DIMENSION), dtype=numpy.float32)
+    faiss_index, checkpointer = open_index(tmp_path)
+    faiss_index.insert(vector_array[:10], numpy.arange(10))
+    checkpointer.checkpoint()
+    faiss_index.insert(vector_array[10:], numpy.arange(10, 20))
+    faiss_index.update(vector_array[:2] + 1, numpy.arange(2))
+    n_rows = len(faiss_index.vector_store)
+    faiss_index.vector_store.close()
+    checkpointer.close()
+
+    for _ in range(3):
+        faiss_index, checkpointer = open_index(tmp_path)
+
+        assert len(faiss_index.vector_store) == n_rows
+        numpy.testing.assert_array_equal(faiss_index.reconstruct(numpy.arange(2)), vector_array[:2] + 1)
+        numpy.testing.assert_array_equal(faiss_index.reconstruct(numpy.arange(2, 20)), vector_array[2:])
+        faiss_index.vector_store.close()
+        checkpointer.close()
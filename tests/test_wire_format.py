@@ -0,0 +1,27 @@
+"""Tests of binary search arguments: invalid numbers are refused instead of falling back to defaults"""
+__author__ = "Vitali Muladze"
+
+from commons import check_n_results, check_search_knobs, wire_format
+from source.configuration import messages
+
+
+def test_integer_arguments_are_parsed():
+    assert wire_format.parse_int(None, 10) == 10
+    assert wire_format.parse_int("5", 10) == 5
+    assert wire_format.parse_int(None) is None
+
+
+def test_invalid_integer_arguments_are_refused():
+    n_results = wire_format.parse_int("ten", 10)
+    search_knobs = {"nprobe": wire_format.parse_int("1.5"), "ef_search": None}
+
+    assert n_results == "ten"
+    assert check_n_results(n_results) == messages.INVALID_N_RESULTS
+    assert check_search_knobs(search_knobs) == messages.INVALID_SEARCH_KNOBS
+
+
+def test_search_knobs_must_be_positive():
+    assert check_search_knobs({"nprobe": None, "ef_search": None}) is None
+    assert check_search_knobs({"nprobe": 8, "ef_search": 64}) is None
+    assert check_search_knobs({"nprobe": 0, "ef_search": None}) == messages.INVALID_SEARCH_KNOBS
+    assert check_search_knobs({"nprobe": True, "ef_search": None}) == messages.INVALID_SEARCH_KNOBS
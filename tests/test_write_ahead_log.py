@@ -0,0 +1,141 @@
+"""Tests of the write-ahead log: checksums, recovery of a torn tail, group commit and ownership"""
+__author__ = "Vitali Muladze"
+
+import os
+import threading
+import time
+
+import numpy
+import pytest
+
+from models.write_ahead_log import INSERT, REMOVE, RECORD_HEADER, WriteAheadLog
+
+
+def append_inserts(wal: WriteAheadLog, n_records: int, dimension: int = 4) -> list:
+    """Append insertions of one vector each and return their lsns"""
+    return [wal.append(INSERT, numpy.array([image_id], dtype=numpy.int64),
+                       numpy.full((1, dimension), image_id, dtype=numpy.float32))
+            for image_id in range(n_records)]
+
+
+@pytest.fixture
+def wal_path(tmp_path) -> str:
+    return str(tmp_path / "wal")
+
+
+def test_replay_returns_appended_records(wal_path):
+    wal = WriteAheadLog(wal_path, 'never')
+    assert list(wal.replay()) == []
+    lsns = append_inserts(wal, 3)
+    wal.append(REMOVE, numpy.array([1], dtype=numpy.int64))
+    wal.close()
+
+    wal = WriteAheadLog(wal_path, 'never')
+    records = list(wal.replay())
+    assert [lsn for lsn, *_ in records] == lsns + [4]
+    assert [operation for _, operation, *_ in records] == [INSERT] * 3 + [REMOVE]
+    numpy.testing.assert_array_equal(records[2][2], [2])
+    numpy.testing.assert_array_equal(records[2][3], numpy.full((1, 4), 2, dtype=numpy.float32))
+    assert records[3][3].shape == (1, 0)
+    # Records covered by a checkpoint are skipped
+    assert [lsn for lsn, *_ in wal.replay(after_lsn=2)] == [3, 4]
+    assert wal.last_lsn == 4
+
+
+def test_torn_tail_is_cut_and_appends_continue(wal_path):
+    wal = WriteAheadLog(wal_path, 'never')
+    list(wal.replay())
+    append_inserts(wal, 3)
+    wal.close()
+    segment_path = wal.segments()[-1][1]
+    # Crash in the middle of writing the last record
+    os.truncate(segment_path, os.path.getsize(segment_path) - 10)
+
+    wal = WriteAheadLog(wal_path, 'never')
+    assert [lsn for lsn, *_ in wal.replay()] == [1, 2]
+    assert wal.append(INSERT, numpy.array([7], dtype=numpy.int64), numpy.ones((1, 4), dtype=numpy.float32)) == 3
+    wal.close()
+
+    wal = WriteAheadLog(wal_path, 'never')
+    records = list(wal.replay())
+    assert [lsn for lsn, *_ in records] == [1, 2, 3]
+    numpy.testing.assert_array_equal(records[-1][2], [7])
+
+
+def test_crc_mismatch_at_tail_is_cut(wal_path):
+    wal = WriteAheadLog(wal_path, 'never')
+    list(wal.replay())
+    append_inserts(wal, 2)
+    wal.close()
+    segment_path = wal.segments()[-1][1]
+    # Flip a byte of the vector of the last record
+    with open(segment_path, 'r+b') as segment:
+        segment.seek(-1, os.SEEK_END)
+        last_byte = segment.read(1)
+        segment.seek(-1, os.SEEK_END)
+        segment.write(bytes([last_byte[0] ^ 0xFF]))
+
+    wal = WriteAheadLog(wal_path, 'never')
+    assert [lsn for lsn, *_ in wal.replay()] == [1]
+
+
+def test_corruption_before_the_last_segment_fails_replay(wal_path):
+    wal = WriteAheadLog(wal_path, 'never')
+    list(wal.replay())
+    append_inserts(wal, 2)
+    wal.rotate()
+    append_inserts(wal, 1)
+    wal.close()
+    first_segment_path = wal.segments()[0][1]
+    with open(first_segment_path, 'r+b') as segment:
+        segment.seek(RECORD_HEADER.size)
+        segment.write(b'\xff' * 8)
+
+    wal = WriteAheadLog(wal_path, 'never')
+    with pytest.raises(ValueError):
+        list(wal.replay())
+
+
+def test_group_commit_shares_fsyncs(wal_path, monkeypatch):
+    fsync = os.fsync
+    n_fsyncs = []
+
+    def slow_fsync(file_descriptor):
+        n_fsyncs.append(file_descriptor)
+        time.sleep(0.005)
+        fsync(file_descriptor)
+
+    monkeypatch.setattr(os, 'fsync', slow_fsync)
+    wal = WriteAheadLog(wal_path, 'always')
+    list(wal.replay())
+    n_threads, n_appends = 8, 20
+    not_durable = []
+
+    def write():
+        for image_id in range(n_appends):
+            lsn = wal.append(INSERT, numpy.array([image_id], dtype=numpy.int64),
+                             numpy.ones((1, 4), dtype=numpy.float32))
+            wal.commit(lsn)
+            # Acknowledged writes are durable
+            if wal.synced_lsn < lsn:
+                not_durable.append(lsn)
+
+    threads = [threading.Thread(target=write) for _ in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not not_durable
+    assert wal.last_lsn == n_threads * n_appends
+    # Concurrent writers wait for one fsync instead of each doing their own
+    assert len(n_fsyncs) < n_threads * n_appends
+    wal.close()
+
+
+def test_second_owner_is_refused(wal_path):
+    wal = WriteAheadLog(wal_path, 'never')
+    with pytest.raises(RuntimeError):
+        WriteAheadLog(wal_path, 'never')
+    wal.close()
+    WriteAheadLog(wal_path, 'never').close()
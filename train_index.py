@@ -0,0 +1,75 @@
+"""Build a trained index of the configured type from existing or bulk-loaded vectors"""
+__author__ = "Vitali Muladze"
+
+import argparse
+import time
+
+import numpy
+
+from models.faiss_database import FaissIndex
+from source.configuration import files, faiss_configuration
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("source", help="existing faiss index file or .npy float32 matrix of vectors")
+    parser.add_argument("--ids", help=".npy int64 image ids of the vectors of a .npy source")
+    parser.add_argument("--output", default=files.index_path, help="path of the new index")
+    parser.add_argument("--index-factory", default=faiss_configuration.index_factory)
+    parser.add_argument("--train-size", type=int, default=faiss_configuration.train_size)
+    parser.add_argument("--train-only", action="store_true",
+                        help="only train the new index, vectors are inserted later")
+    parser.add_argument("--chunk-size", type=int, default=65536)
+
+    return parser.parse_args()
+
+
+def iterate_npy(vectors_path: str, ids_path: str or None, chunk_size: int):
+    """
+    Read a memory mapped .npy matrix chunk by chunk
+    :param vectors_path: .npy float32 matrix
+    :param ids_path: .npy int64 image ids, positions are used if not specified
+    :param chunk_size: number of vectors in a chunk
+    :return: generator of (image ids, features vectors)
+    """
+    vector_array = numpy.load(vectors_path, mmap_mode="r")
+    id_array = numpy.load(ids_path, mmap_mode="r") if ids_path else None
+    for start in range(0, vector_array.shape[0], chunk_size):
+        stop = min(start + chunk_size, vector_array.shape[0])
+        chunk_ids = id_array[start:stop] if id_array is not None else numpy.arange(start, stop)
+        yield chunk_ids, vector_array[start:stop]
+
+
+def main():
+    arguments = parse_arguments()
+    dimension = faiss_configuration.dimension
+    tok = time.time()
+    if arguments.source.endswith(".npy"):
+        vector_array = numpy.load(arguments.source, mmap_mode="r")
+        n_samples = min(arguments.train_size, vector_array.shape[0])
+        # Sorted positions keep reads from the memory mapped file sequential
+        positions = numpy.sort(numpy.random.RandomState(1234).choice(
+            vector_array.shape[0], n_samples, replace=False))
+        sample = numpy.ascontiguousarray(vector_array[positions], dtype=numpy.float32)
+        chunks = iterate_npy(arguments.source, arguments.ids, arguments.chunk_size)
+    else:
+        source = FaissIndex(arguments.source, dimension)
+        sample = source.sample_vectors(arguments.train_size)
+        chunks = source.iterate_vectors(arguments.chunk_size)
+    target = FaissIndex(None, dimension, arguments.index_factory)
+    status = target.train(sample)
+    if isinstance(status, str):
+        raise SystemExit(status)
+    print(f"Trained {arguments.index_factory} on {status} vectors in {time.time() - tok:.1f}s")
+    if not arguments.train_only:
+        for id_array, chunk_vectors in chunks:
+            status = target.insert(chunk_vectors, id_array, is_updating=True)
+            if isinstance(status, str):
+                raise SystemExit(status)
+            print(f"Added {len(target)} vectors in {time.time() - tok:.1f}s")
+    target.to_disk(arguments.output)
+    print(f"Index with {len(target)} vectors written to {arguments.output}")
+
+
+if __name__ == '__main__':
+    main()